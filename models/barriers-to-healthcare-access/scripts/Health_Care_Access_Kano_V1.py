@@ -56,11 +56,18 @@ import folium
 from folium.plugins import MarkerCluster
 from openrouteservice import client
 
-import time
+import numpy as np
 import pandas as pd
 import fiona as fn
 from shapely.geometry import shape, mapping
-from shapely.ops import cascaded_union
+
+import sys
+sys.path.append('../../../utils')
+from ideamaps.isochrones import IsochroneCache, IsochroneClient, ORS_API_URL
+from ideamaps.coverage import within_any
+from ideamaps.grid import load_reference_grid
+from ideamaps.storage import IntermediateStore
+from ideamaps.union import CascadedUnion, write_polygons
 # -
 
 
@@ -87,6 +94,8 @@ ors = client.Client(key=api_key)
 # Define directories
 data_inputs = '../scripts/data_inputs/'
 data_temp = '../scripts/data_temp/'
+# Intermediate layers are stored as GeoParquet in data_temp
+temp_store = IntermediateStore(data_temp)
 data_outputs = '../scripts/data_outputs/'
 
 # Define file paths correctly
@@ -161,123 +170,45 @@ map_outline
 # Due to the limited road networks in the slum areas of these three cities, the accessibility of hospitals within a 10-minute range is of significant concern. Therefore, isochrones with 10 minutes walk range and 10 minutes car drive range around each hospital were created with the open source tool [OpenRouteService](https://openrouteservice.org/). This might take several minutes depending on the number of health facilities (currently we can send 40 requests per minute).
 
 # +
-# request isochrones from ORS api for car
-request_counter = 0
-iso_car = []
-for facility_id in facilities_dictionary.keys():
-    loc = facilities_dictionary[facility_id]
-    try:
-        iso_params = {'locations': [loc['geometry']['coordinates']],
-            'profile': 'driving-car',
-            'range_type': 'time',
-            'range': [1800],  # 1800 seconds = 30mins
-            'attributes': ['total_pop', 'area']}
-        request = ors.isochrones(**iso_params)
-
-        request_counter += 1
-        lon, lat = loc['geometry']['coordinates']
-        iso_car.append(shape(request['features'][0]['geometry']))
-        if len(iso_car) % 35 == 0: 
-            time.sleep(60) # try 20 here
-        if len(iso_car) > 1000: # try 50
-            break
-    except Exception as err:
-        print("there was an error and being skiped: " + str(err))
-        pass
-print('requested %s isochrones for car from ORS API' % request_counter)
-
-# generate cascaded union of all isochrones,new package is unary_union
-from shapely.ops import unary_union
-iso_union_car = unary_union(iso_car)
-print('Computed unary union of all isochrones')
-
-# save isochrones to shapefiles
-schema = {'geometry': 'Polygon',
-          'properties': {'id': 'int'}}
-index = 0
-
-output_path = os.path.join(data_temp, "iso_car_30mins.shp")
-
-with fn.open(output_path, 'w', 'ESRI Shapefile', schema) as c:
-    if iso_union_car.geom_type == 'Polygon':
-        # If the result is a single Polygon
-        c.write({
-            'geometry': mapping(iso_union_car),
-            'properties': {'id': 1}
-        })
-    elif iso_union_car.geom_type == 'MultiPolygon':
-        # If the result is a MultiPolygon
-        for poly in iso_union_car.geoms:
-            index += 1
-            c.write({
-                'geometry': mapping(poly),
-                'properties': {'id': index}
-            })
-print('saved isochrones as shapefiles for car.')
+# request isochrones from ORS api for car and pedestrian: the facilities are sent in batches of 5 locations
+# and the requests of both profiles share the workers and the rate limit of the API
+locations = [facilities_dictionary[facility_id]['geometry']['coordinates'] for facility_id in facilities_dictionary]
+iso_client = IsochroneClient(ORS_API_URL, api_key, cache=IsochroneCache(data_temp + 'isochrone-cache.sqlite'))
+
+# the isochrones of each batch are merged in a cascaded union as they arrive, instead of one union of the whole list
+iso_union_car = CascadedUnion()
+iso_union_foot = CascadedUnion()
+for spec_index, isochrones in iso_client.iter_specs(locations, [
+    ('driving-car', 'time', [1800], ['total_pop', 'area']),  # 1800 seconds = 30mins
+    ('foot-walking', 'time', [900], ['total_pop', 'area']),  # 900 seconds = 15 mins walk
+]):
+    [iso_union_car, iso_union_foot][spec_index].extend(isochrones.geometry)
+for failed in iso_client.failed:
+    print("there was an error and being skiped: " + failed[-1])
+print('requested %s isochrones for car and %s for foot from ORS API' % (iso_union_car.count, iso_union_foot.count))
+# -
+
+# +
+iso_union_car = iso_union_car.result()
+print('Computed cascaded union of all isochrones')
+
+# save the polygons of the union to a GeoParquet file of the temporary folder in a single write
+write_polygons(iso_union_car, temp_store.path('iso_car_30mins'))
+print('saved isochrones as GeoParquet for car.')
 
 
 # + tags=[]
-# request isochrones from ORS api for pedestrian
-request_counter = 0
-iso_foot = []
-for facility_id in facilities_dictionary.keys():
-    loc = facilities_dictionary[facility_id]
-    try:
-        iso_params = {'locations': [loc['geometry']['coordinates']],
-            'profile': 'foot-walking',
-            'range_type': 'time',
-            'range': [900],  # 900 seconds = 15 mins walk 
-            'attributes': ['total_pop', 'area']}
-        request = ors.isochrones(**iso_params)
-        request_counter += 1
-
-        lon, lat = loc['geometry']['coordinates']
-        iso_foot.append(shape(request['features'][0]['geometry']))
-        if len(iso_foot) % 35 == 0: 
-            time.sleep(60) # try 20 here
-        if len(iso_foot) > 1000: # try 50
-            break
-    except Exception as err:
-        pass
-print('requested %s isochrones for foot from ORS API' % request_counter)
-
-# generate cascaded union of all isochrones
-from shapely.ops import unary_union
-iso_union_foot = unary_union(iso_foot)
-print('Computed unary union of all isochrones')
-
-# Save isochrones to shapefiles
-schema = {'geometry': 'Polygon',
-          'properties': {'id': 'int'}}
-index = 0
-
-output_path = os.path.join(data_temp, "iso_foot_15mins.shp")
-
-with fn.open(output_path, 'w', 'ESRI Shapefile', schema) as c:
-    if iso_union_foot.geom_type == 'Polygon':
-        # If the result is a single Polygon
-        c.write({
-            'geometry': mapping(iso_union_foot),
-            'properties': {'id': 1}
-        })
-    elif iso_union_foot.geom_type == 'MultiPolygon':
-        # If the result is a MultiPolygon
-        for poly in iso_union_foot.geoms:
-            index += 1
-            c.write({
-                'geometry': mapping(poly),
-                'properties': {'id': index}
-            })
-
-print('Saved isochrones as shapefiles for pedestrian.')
+iso_union_foot = iso_union_foot.result()
+print('Computed cascaded union of all isochrones')
+
+# save the polygons of the union to a GeoParquet file of the temporary folder in a single write
+write_polygons(iso_union_foot, temp_store.path('iso_foot_15mins'))
+print('Saved isochrones as GeoParquet for pedestrian.')
 # -
 
 # ### Spatial joins for the grid and isochrone layers using geopandas
 # This study employed the GeoPandas library to perform a spatial join between isochrone data and 100x100m grid cells, which allowed for the analysis and evaluation of accessibility for each grid cell within the study area in these three cities, across different time intervals (specifically by walking or driving). Accessibility was classified as three levels: high, medium and low. The analysis results were exported in GeoPackage format to ensure both the persistent storage and reusability of the data. Additionally, all spatial datasets were maintained in the same coordinate reference system (EPSG:4326), which ensured consistency and accuracy in the spatial joins and subsequent analyses.
 
-# Spatial join analysis in GeoPandas
-import geopandas as gpd
-
 # +
 import fiona
 
@@ -286,11 +217,11 @@ with fiona.Env():
     grid_layer_name = layers[0]
 
 # +
-# Read grid cells and isochrones from the GeoPackage file
+# Read grid cells from the GeoPackage file (through its reference grid) and isochrones from the temporary folder
 # Ensure both GeoDataFrames have the same CRS (EPSG:4326)
-grid_gdf = gpd.read_file(data_inputs + "100mGrid.gpkg", layer=grid_layer_name)
-isochrones_foot_gdf = gpd.read_file(data_temp + 'iso_foot_15mins.shp')
-isochrones_car_gdf = gpd.read_file(data_temp + 'iso_car_30mins.shp')
+grid_gdf = load_reference_grid(data_inputs + "100mGrid.gpkg", layer=grid_layer_name).cells
+isochrones_foot_gdf = temp_store.read('iso_foot_15mins')
+isochrones_car_gdf = temp_store.read('iso_car_30mins')
 
 # Ensure both GeoDataFrames have the same CRS
 if isochrones_foot_gdf.crs is None:
@@ -309,25 +240,15 @@ else:
     isochrones_car_gdf = isochrones_car_gdf.to_crs(grid_gdf.crs)
 # -
 
-# Perform spatial join based on intersection
-# To estimate whether isochrones are completely contained within grid cells using the within predicate
-grid_isocar_gdf = gpd.sjoin(grid_gdf, isochrones_car_gdf, how="left", predicate="within") 
-grid_isocar_gdf.rename(columns={'index_right': 'index_car', 'id': 'id_car'}, inplace=True)
-# Save the result to a new GeoPackage file
-grid_isocar_gdf.to_file(data_temp + "grid_iso_car_output.gpkg", layer="joined_layer", driver="GPKG")
-print('join grid and isochrones car done')
-
-grid_isocarfoot_gdf = gpd.sjoin(grid_isocar_gdf, isochrones_foot_gdf, how="left", predicate="within")
-grid_isocarfoot_gdf.rename(columns={'index_right': 'index_foot', 'id': 'id_foot'}, inplace=True)
-grid_isocarfoot_gdf.to_file(data_temp + "grid_iso_car_output.gpkg", layer="joined_layer", driver="GPKG")
-print('join grid and isochrones car and isochrones foot done')
-
-# add a new column to the GeoDataFrame and set it to 2
-grid_isocarfoot_gdf = grid_isocarfoot_gdf.assign(result=2)
-# for values in the 'joined' column that are coming from the isochones by car set them to 1
-grid_isocarfoot_gdf.loc[grid_isocarfoot_gdf['index_car'].notnull(), 'result'] = 1
-# for values in the 'joined' column that are coming from the isochones by foot set them to 0
-grid_isocarfoot_gdf.loc[grid_isocarfoot_gdf['index_foot'].notnull(), 'result'] = 0
+# Membership of the grid cells in both isochrone coverages, from one bulk query per coverage
+# To estimate whether grid cells are completely contained within the isochrones (within predicate)
+within_car = within_any(grid_gdf.geometry.values, isochrones_car_gdf.geometry.values)
+within_foot = within_any(grid_gdf.geometry.values, isochrones_foot_gdf.geometry.values)
+print('grid cells within isochrones car: %s, isochrones foot: %s' % (within_car.sum(), within_foot.sum()))
+
+# grid cells within the isochrones by foot are set to 0, by car to 1 and all the other grid cells to 2
+grid_isocarfoot_gdf = grid_gdf.assign(within_car=within_car.astype(int), within_foot=within_foot.astype(int),
+                                      result=np.select([within_foot, within_car], [0, 1], default=2))
 grid_isocarfoot_gdf.to_file(data_outputs + "grid_iso_car_foot_output.gpkg", layer="joined_layer", driver="GPKG")
 
 # ### Save Output as CSV file
@@ -73,7 +73,19 @@ from rasterio.mask import mask
 from shapely.geometry import Point
 
 from pathlib import Path
-from shapely.geometry import Polygon
+from emoc.raster import read_tif
+from emoc.population import disaggregate_population
+from emoc.matrix import MatrixClient, ORS_API_URL, nearest_destinations
+from emoc.od_cache import ODCache
+from emoc.routing import RoadNetwork, nearest_facilities
+from emoc.selection import k_smallest
+from emoc.e2sfca import accessibility_index, gaussian_weights
+from emoc.output import classify, focus_areas, model_output, write_model_output
+
+import sys
+sys.path.append('../../../utils')
+from ideamaps.grid import load_reference_grid
+from ideamaps.storage import IntermediateStore
 
 import requests
 import math
@@ -122,6 +134,8 @@ client = openrouteservice.Client(key=api_key)
 # Define directories
 data_inputs = '../scripts/Kano/data-inputs/'
 data_temp = '../scripts/Kano/data-temp/'
+# Intermediate layers are stored as GeoParquet in data-temp, the final outputs as GeoPackage and CSV
+temp_store = IntermediateStore(data_temp)
 model_outputs = '../kano/'
 
 # %% [markdown]
@@ -185,7 +199,7 @@ grid_df["rowid"] = range(1, len(grid_df) + 1)
 population_centroids_gdf = gpd.GeoDataFrame(grid_df, geometry=[Point(xy) for xy in zip(grid_df["longitude"], grid_df["latitude"])])
 population_centroids_gdf.set_crs("EPSG:4326", inplace=True)
 
-population_centroids_gdf.to_file(data_temp + "population_centroids.gpkg", driver="GPKG")
+temp_store.write(population_centroids_gdf, 'population_centroids')
 
 # %%
 population_centroids_gdf
@@ -194,54 +208,13 @@ population_centroids_gdf
 # ### Adding population data at 1km grid to 100m grid
 
 # %%
-# reading in geotiff file as numpy array
-def read_tif(file: Path):
-    if not file.exists():
-        raise FileNotFoundError(f'File {file} not found')
-
-    with rasterio.open(file) as dataset:
-        arr = dataset.read()  # (bands X height X width)
-        nodata = dataset.nodata
-        transform = dataset.transform
-        crs = dataset.crs
-
-    # Replace NoData value with NaN
-    if nodata is not None:
-        arr[arr == nodata] = np.nan
-
-    return arr.transpose((1, 2, 0)), transform, crs
-
-def raster2vector(arr, transform, crs) -> gpd.GeoDataFrame:
-    height, width, bands = arr.shape
-
-    # Generate pixel coordinates
-    geometries = []
-    pixel_values = []
-
-    for row in range(height):
-        for col in range(width):
-            x_min, y_max = transform * (col, row)  # Top-left corner
-            x_max, y_min = transform * (col + 1, row + 1)  # Bottom-right corner
-
-            pixel_value = arr[row, col].tolist()[0]  # Convert numpy array to list
-            polygon = Polygon([(x_min, y_max), (x_max, y_max), (x_max, y_min), (x_min, y_min)])
-
-            geometries.append(polygon)
-            pixel_values.append(pixel_value)
-
-    # Convert to DataFrame
-    gdf = gpd.GeoDataFrame({'pop_grid_pop': pixel_values, 'geometry': geometries}, crs=crs)
-
-    return gdf
-
-epsg = 'EPSG:32632'
+# Reference grid with stable grid ids (built once from the grid file, see ideamaps.grid) and the UTM zone of the city
+reference_grid = load_reference_grid(data_inputs + '100mGrid.gpkg')
+epsg = f'EPSG:{reference_grid.utm_epsg}'
 
 # %%
 # Preparing grid
-grid_file = data_inputs + '100mGrid.gpkg'
-grid = gpd.read_file(grid_file)
-grid = grid.to_crs(epsg)
-grid['grid_id'] = range(len(grid))
+grid = reference_grid.cells.to_crs(epsg)
 grid = grid[['grid_id', 'geometry','rowid', 'latitude', 'lat_min', 'lat_max', 'longitude', 'lon_min','lon_max']].set_geometry('geometry')
 grid
 
@@ -283,42 +256,16 @@ data_path = Path(data_inputs)
 pop_file = data_path / 'kano_nga_f_15_49_2015_1km.tif'
 pop_raster, transform, crs = read_tif(pop_file)
 
-# Converting the raster grid to vector data
-pop_grid = raster2vector(pop_raster, transform, crs)
-pop_grid = pop_grid.to_crs(epsg)
-pop_grid['pop_grid_id'] = range(len(pop_grid))
-# pop_grid.to_parquet(data_path / 'sanity_check_pop.parquet')
-
-# Assign coarse population data to finer grid based on the centroid locations of the finer grid cells
-grid['centroid'] = grid['geometry'].centroid
-grid = gpd.sjoin(grid.set_geometry('centroid'), pop_grid, how='left', predicate='within')
-print(grid.columns)
-grid = grid[['grid_id', 'bcount', 'pop_grid_id', 'geometry','rowid', 'latitude', 'lat_min', 'lat_max',
-       'longitude', 'lon_min', 'lon_max']]
-grid.head()
-
-# %%
-# Calculate population weight (fraction of total population count that should be assigned to cell based on its building count)
-grid_grouped_pop = grid.groupby('pop_grid_id')
-building_count_pop = grid_grouped_pop['bcount'].sum().rename('pop_grid_bcount')
-grid = grid.merge(building_count_pop, on='pop_grid_id', how='left')
-grid['pop_weight'] = grid['bcount'] / grid['pop_grid_bcount']
-
-# Compute disaggregated population count based on weight and building count at coarser cell level
-grid = grid.merge(pop_grid, on='pop_grid_id', how='left')
-grid['pop'] = grid['pop_grid_pop'] * grid['pop_weight']
+# Assign coarse population data to finer grid based on the centroid locations of the finer grid cells.
+# The parent 1km pixel of each cell follows from the raster transform, and the population of the pixel is
+# weighted by the share of the cell in the building count of the pixel (pop_weight)
+grid = grid.join(disaggregate_population(grid, pop_raster, transform, crs))
 grid.head()
 
 # %%
 # Saving to file
-grid = grid.drop(columns=["geometry_y"])
-grid.head()
-
-
-# %%
-grid = grid.set_geometry("geometry_x")
 grid = grid.to_crs(4326)
-grid.to_file(data_temp + 'pop-grid-kano-centroids.gpkg', driver='GPKG')
+temp_store.write(grid, 'pop-grid-kano-centroids')
 
 # %% [markdown]
 # ## 2. Spatial Analysis Pipeline
@@ -342,63 +289,32 @@ origins = list(zip(origin_gdf.geometry.x, origin_gdf.geometry.y))
 destinations = list(zip(destination_gdf.geometry.x, destination_gdf.geometry.y))
 
 # %%
-locations = origins + destinations
+# The matrix is split into requests under the ORS limits (max_routes = sources x destinations), which are
+# sent concurrently and retried with backoff. For a local ORS instance, use its url (e.g. 'http://localhost:8080/ors')
+# and the maximum_routes of its configuration. Travel times are cached in the temp folder, so that reruns only
+# request pairs of new centroids or facilities
+od_cache = ODCache(data_temp + 'od-cache.sqlite')
+matrix_client = MatrixClient(ORS_API_URL, api_key=api_key, profile='driving-car', max_routes=3500, workers=4,
+                             cache=od_cache)
+od_matrix = matrix_client.compute(origins, destinations, metrics=['distance', 'duration'])
 
 # %%
-origins_index = list(range(0, len(origins)))
-destinations_index = list(range(len(origins), len(locations)))
-
-# %%
-body = {'locations': locations,
-       'destinations': destinations_index,
-       'sources': origins_index,
-       'metrics': ['distance', 'duration']}
-
-headers = {
-    'Accept': 'application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8',
-    'Authorization': api_key,
-    'Content-Type': 'application/json; charset=utf-8'
-}
-
-response = requests.post('https://api.openrouteservice.org/v2/matrix/driving-car', json=body, headers=headers)
-
-# %%
-distances = response.json().get('distances', [])
-durations = response.json().get('durations', [])
-
-# %%
-distances_duration_matrix = []
-
-# Iterate over each origin (grid)
-for origin_index, origin in origin_gdf.iterrows():
-    origin_name = origin[origin_name_column]
-    origin_x = origin.geometry.x
-    origin_y = origin.geometry.y
-    origin_distances = distances[origin_index]
-    origin_durations = durations[origin_index]
-
-    # find the minimum duration and the index of the minimum duration
-    min_duration = min(origin_durations)
-    min_index = origin_durations.index(min_duration)
-    destination_index = destinations_index[min_index]
-    dest_x, dest_y = locations[destination_index]
-    filtered = healthcare_facilities_validated[(destination_gdf.geometry.x == dest_x) & (destination_gdf.geometry.y == dest_y) ]
-    destination_row = filtered.iloc[0]
-    dest_name = destination_row[destination_name_column]
-
-        # Append both the distance and duration for this origin-destination pair
-    distances_duration_matrix.append([
-            origin_name, origin_y, origin_x,
-            dest_name, dest_y, dest_x,
-            min_duration
-        ])
+# Nearest facility of each origin (grid), found for all origins at once. Origins without any route get a NaN duration
+nearest_index, min_duration = nearest_destinations(od_matrix.durations)
+routed = nearest_index >= 0
+nearest_facility = destination_gdf.iloc[np.where(routed, nearest_index, 0)]
 
 # %%
 # Convert the results into a DataFrame
-matrix_df = pd.DataFrame(distances_duration_matrix, columns=[
-    'grid_code','origin_lat', 'origin_lon',
-    'destination_name', 'dest_lat', 'dest_lon','min_duration'
-])
+matrix_df = pd.DataFrame({
+    'grid_code': origin_gdf[origin_name_column].to_numpy(),
+    'origin_lat': origin_gdf.geometry.y.to_numpy(),
+    'origin_lon': origin_gdf.geometry.x.to_numpy(),
+    'destination_name': np.where(routed, nearest_facility[destination_name_column].to_numpy(), None),
+    'dest_lat': np.where(routed, nearest_facility.geometry.y.to_numpy(), np.nan),
+    'dest_lon': np.where(routed, nearest_facility.geometry.x.to_numpy(), np.nan),
+    'min_duration': min_duration,
+})
 
 # %%
 # Save to CSV
@@ -412,8 +328,7 @@ merged_df
 geometry = [Point(xy) for xy in zip(merged_df['dest_lon'], merged_df['dest_lat'])]
 gdf = gpd.GeoDataFrame(merged_df, geometry=geometry, crs="EPSG:4326")
 
-gpkg_path = data_temp + 'distance_duration_matrix_temp.gpkg'
-gdf.to_file(gpkg_path, layer="duration_matrix", driver="GPKG")
+temp_store.write(gdf, 'distance_duration_matrix_temp')
 
 # %% [markdown]
 # ### Option 2: Using a local ORS service
@@ -438,6 +353,24 @@ gdf.to_file(gpkg_path, layer="duration_matrix", driver="GPKG")
 # 
 # ### Diego please add description here
 
+# %% [markdown]
+# ### Option 3: Using the built-in routing engine
+# Travel times can also be computed offline on the OSM road network of the study area (e.g. extracted with
+# `osm_roads_download.py -p <extract.osm.pbf>` of the morphological informality model), without an ORS service.
+# Road speeds follow the ORS defaults of the profile, and grid cells or facilities further than 350 m from a road are not routed.
+# It is off by default: set `use_local_routing = True` to run it, the result is then written to `OD-matrix-kano-local.csv`
+# and processed below instead of the ORS OD matrix.
+
+# %%
+use_local_routing = False
+
+if use_local_routing:
+    road_network = RoadNetwork.from_parquet(data_inputs + 'roads.parquet', profile='driving-car')
+    grid_centroids = temp_store.read('pop-grid-kano-centroids')
+    matrix_df = nearest_facilities(road_network, grid_centroids, healthcare_facilities_validated.dropna(subset=['geometry']),
+                                   'rowid', 'hcf_id', category_column='Local_Validation', k=3)
+    matrix_df.to_csv(data_temp + 'OD-matrix-kano-local.csv', index=False)
+
 # %% [markdown]
 # ## Processing OD Matrix
 
@@ -446,12 +379,13 @@ gdf.to_file(gpkg_path, layer="duration_matrix", driver="GPKG")
 
 # %%
 # If not loaded yet, read from the temporary folder
-centroids_df = gpd.read_file(data_temp +'pop-grid-kano-centroids.gpkg')
+centroids_df = temp_store.read('pop-grid-kano-centroids')
 centroids_df
 
 # %%
 # If not loaded yet, read from the temporary folder
-matrix_df = pd.read_csv(data_temp +'OD-matrix-kano-access-emoc.csv')
+od_matrix_file = 'OD-matrix-kano-local.csv' if use_local_routing else 'OD-matrix-kano-access-emoc.csv'
+matrix_df = pd.read_csv(data_temp + od_matrix_file)
 matrix_df
 
 # %% [markdown]
@@ -525,44 +459,15 @@ distances_duration_matrix = distances_duration_matrix[
 distances_duration_matrix
 
 # %%
-# creat subsets based on categories of 'Validation of HCFs Categorization'
-categories = {
-    "public_comprehensive_EmOC": ["Public Comprehensive EmOC"],
-    "private_comprehensive_EmOC": ["Private Comprehensive EmOC"],
-    "private_basic_EmOC": ["Private Basic EmOC"],
-    "public_basic_EmOC": ["Public Basic EmOC"]
-}
-
-subsets = {
-    key: distances_duration_matrix[
-        distances_duration_matrix['Local_Validation'].str.contains('|'.join(values), na=False)
-    ]
-    for key, values in categories.items()
-}
-
-public_CEmOC = subsets["public_comprehensive_EmOC"]
-private_CEmOC = subsets["private_comprehensive_EmOC"]
-public_BEmOC = subsets["public_basic_EmOC"]
-private_BEmOC = subsets["private_basic_EmOC"]
-
-# %%
-# Step 2: Define a function to get 3 smallest duration_seconds per grid_id for each category
-def get_closest_3(df, n=3):
-    return df.groupby('grid_id').apply(lambda x: x.nsmallest(n, 'duration_seconds')).reset_index(drop=True)
+# Categories of 'Validation of HCFs Categorization' and number of closest facilities selected per grid cell and category
+categories = ['Public Comprehensive EmOC', 'Private Comprehensive EmOC', 'Private Basic EmOC', 'Public Basic EmOC']
+k_closest = 3
 
 # %%
-# Step 3: If the subsets are already created for each category, we apply the function to each subset:
-public_CEmOC_closest_3 = get_closest_3(public_CEmOC)
-private_CEmOC_closest_3 = get_closest_3(private_CEmOC)
-public_BEmOC_closest_3 = get_closest_3(public_BEmOC)
-private_BEmOC_closest_3 = get_closest_3(private_BEmOC)
-
-# %%
-# Step 4: Concatenate the filtered results into a single DataFrame
-distances_duration_matrix = pd.concat([
-    public_CEmOC_closest_3, private_CEmOC_closest_3,
-    public_BEmOC_closest_3, private_BEmOC_closest_3
-])
+# The k closest facilities of each category for every grid cell, selected for all cells and categories at once
+distances_duration_matrix = k_smallest(
+    distances_duration_matrix[distances_duration_matrix['Local_Validation'].isin(categories)],
+    ['grid_id', 'Local_Validation'], 'duration_seconds', k=k_closest)
 distances_duration_matrix
 
 # %%
@@ -570,8 +475,7 @@ geometry = [Point(xy) for xy in zip(distances_duration_matrix['origin_lon'], dis
 gdf = gpd.GeoDataFrame(distances_duration_matrix, geometry=geometry, crs="EPSG:4326")
 
 # %%
-gpkg_path = data_temp + 'distances_duration_3_closet_Emoc.gpkg'
-gdf.to_file(gpkg_path, layer="distances_duration_3_closet_Emoc", driver="GPKG")
+temp_store.write(gdf, 'distances_duration_3_closet_Emoc')
 
 # %%
 # Review and remove
@@ -585,6 +489,7 @@ origin_dest = distances_duration_matrix
 from math import *
 d = 10 * 60 # try max duration 5/10mins/15mins/20 car, under estimation of travel time and traffic condition realted to the selected data sourse 
 W = 0.01
+catchment_sizes = [5 * 60, 10 * 60, 15 * 60, 20 * 60]  # sensitivity analysis of d
 beta = - d ** 2 / log(W)
 print(beta)
 
@@ -607,35 +512,7 @@ origin_dest_acc = origin_dest  # Backup
 # facilities based on the travel duration. d is the travel time and beta is the decay 
 # parameter previously calculated.
 # The weight decreases as the duration increases, meaning facilities that are further away have less impact.
-origin_dest_acc['Weight'] = origin_dest_acc['duration_seconds'].apply(lambda d: round(math.exp(-d**2/beta), 8))
-
-# %%
-# Compute the Weighted Population (Pop_W), the population of each grid cell is multiplied 
-# by the corresponding weight to calculate the weighted population.
-origin_dest_acc['Pop_W'] = origin_dest_acc['population'] * origin_dest_acc['Weight']
-
-# %%
-origin_dest_acc
-
-# %%
-# Sum the Weighted Population
-origin_dest_sum = origin_dest_acc.groupby(by='hcf_id')['Pop_W'].sum().reset_index()
-
-# %%
-origin_dest_sum
-
-# %%
-# Merge the Sum of Weighted Population Back into the Original Data
-origin_dest_acc = origin_dest_acc.merge(origin_dest_sum, on='hcf_id')
-
-# %%
-origin_dest_acc
-
-# %%
-# supply value is set to 1 for simplicity (capacity of HCF)
-# supply = 1
-# in the future, we will link supply with ownership and EmOC service level
-origin_dest_acc = origin_dest_acc.rename(columns={'Pop_W_y': 'Pop_W_S'})  # Pop_W_S: Population Weight Sum
+origin_dest_acc['Weight'] = gaussian_weights(origin_dest_acc['duration_seconds'], d, W)
 
 # %%
 supply_map = {
@@ -646,17 +523,13 @@ supply_map = {
 }
 
 # %%
-origin_dest_acc['supply'] = origin_dest_acc['Local_Validation'].map(supply_map)
-origin_dest_acc['supply_demand_ratio'] = origin_dest_acc['supply'] / origin_dest_acc['Pop_W_S']
-origin_dest_acc['supply_demand_ratio'].replace([np.inf, -np.inf, np.nan], 0, inplace=True)
-
-# %%
-# Calculate Rj * Weight for Each Grid Cell
-origin_dest_acc['supply_W'] = origin_dest_acc['supply_demand_ratio'] * origin_dest_acc.Weight
-
-# %%
-# Compute Accessibility Index (Ai) for Each Grid Cell
-origin_dest_acc['Accessibility'] = origin_dest_acc.groupby('grid_id')['supply_W'].transform('sum')
+# Compute the Accessibility Index (Ai) for each grid cell: the population weighted by the travel time to each facility
+# gives its supply-demand ratio (Rj), and the ratios of the facilities reached from a grid cell are summed with the
+# same weights. The index is computed for all catchment sizes at once, d is used for the results.
+accessibility = accessibility_index(origin_dest_acc, 'grid_id', 'hcf_id', 'duration_seconds', 'population',
+                                    'Local_Validation', supply_map, d=catchment_sizes, w=W)
+origin_dest_acc['Accessibility'] = origin_dest_acc['grid_id'].map(accessibility[d])
+accessibility
 
 # %%
 # Normalize
@@ -671,16 +544,15 @@ max(origin_dest_acc.Accessibility_standard)
 
 # %%
 gdf = gpd.GeoDataFrame(origin_dest_acc, geometry='geometry', crs="EPSG:4326")
-gpkg_path = data_temp + 'acc_score_3closest.gpkg'
-gdf.to_file(gpkg_path, layer="acc_score_3closest", driver="GPKG")
+temp_store.write(gdf, 'acc_score_3closest')
 
 # %% [markdown]
 # # 4. Grouping by grid ID to prepare the final output file
 # There is a need to update this part of the code
 
 # %%
-# Read the GeoPackage file (if starting from this section)
-results_grid = gpd.read_file(data_temp + 'aacc_score_3closest.gpkg')
+# Read the intermediate layer (if starting from this section)
+results_grid = temp_store.read('acc_score_3closest')
 
 # %%
 results_grid = results_grid[['grid_id', 'origin_lon', 'origin_lat', 'origin_lon_min', 'origin_lat_min', 'origin_lon_max', 'origin_lat_max', 'Accessibility_standard', 'geometry']]
@@ -707,10 +579,9 @@ results_grid
 # Note: For Kano, we excluded grid cells with index values below 0.000001 that indicated very low population and a small number of buildings.  
 
 # %%
-results_grid['result'] = -1
-results_grid.loc[results_grid['Accessibility_standard'] > 0.000001, 'result'] = 2
-results_grid.loc[results_grid['Accessibility_standard'] > 0.005, 'result'] = 1
-results_grid.loc[results_grid['Accessibility_standard'] > 0.02, 'result'] = 0
+# Thresholds of the result classes (High, Medium and Low), cells with values up to the first threshold are excluded
+result_thresholds = [0.000001, 0.005, 0.02]
+results_grid['result'] = classify(results_grid['Accessibility_standard'], result_thresholds)
 
 # %%
 category_counts = results_grid['result'].value_counts()
@@ -722,42 +593,31 @@ print(category_counts)
 # We defined the focus areas based on values for the different thresholds. We aim at participants helping us to confirm the selection of the city-specific thresholds.
 
 # %%
-category_counts = results_grid['focused'].value_counts()
-print(category_counts)
-
-# %%
-results_grid['focused'] = 0
-# Focus areas between the Low category and the excluded cells due to low population or no buildings
-results_grid.loc[(results_grid['Accessibility_standard'] > 0.000001) & (results_grid['Accessibility_standard'] < 0.0000015), 'focused'] = 1
-# Focus areas between the Medium and High categories
-results_grid.loc[(results_grid['Accessibility_standard'] > 0.003) & (results_grid['Accessibility_standard'] < 0.006), 'focused'] = 1
-# Focus areas between the Low and Medium categories
-results_grid.loc[(results_grid['Accessibility_standard'] > 0.019) & (results_grid['Accessibility_standard'] < 0.03), 'focused'] = 1
-
-# %%
-results_grid = results_grid.loc[results_grid['result'] != -1]
+focus_intervals = [
+    (0.000001, 0.0000015),  # Between the Low category and the excluded cells due to low population or no buildings
+    (0.003, 0.006),  # Between the Medium and High categories
+    (0.019, 0.03),  # Between the Low and Medium categories
+]
+results_grid['focused'] = focus_areas(results_grid['Accessibility_standard'], focus_intervals)
 
 # %%
-results_grid = results_grid.rename(columns={
-    'origin_lon': 'longitude',
-    'origin_lat': 'latitude',
-    'origin_lon_min': 'lon_min',
-    'origin_lat_min': 'lat_min',
-    'origin_lon_max': 'lon_max',
-    'origin_lat_max': 'lat_max'
-})
+category_counts = results_grid['focused'].value_counts()
+print(category_counts)
 
 # %%
-results_grid
+# Cell centroids and bounds, focus areas and classes in the format required by the IDEAMAPS data ecosystem.
+# Excluded cells are dropped
+results_table = model_output(results_grid, 'Accessibility_standard', result_thresholds, focus_intervals)
+results_table
 
 # %%
 # Save the results to a new GeoPackage file
+results_grid = results_grid[['grid_id', 'Accessibility_standard', 'geometry']].join(results_table, how='inner')
 output_gpkg_path = data_temp + 'emergency-maternal-care-deprivation-access-class.gpkg'
 results_grid.to_file(output_gpkg_path, layer='emergency-maternal-care-deprivation-access-class', driver='GPKG')
 
 # %%
 # Save the results to a CSV file in the format required by the IDEAMAPS data ecosystem
-results_table = results_grid.drop(columns=['Accessibility_standard', 'grid_id', 'geometry'])
-results_table.to_csv(model_outputs + 'model-output.csv', index=False)
+write_model_output(results_table, model_outputs + 'model-output.csv')
 
 
@@ -73,7 +73,18 @@ from rasterio.mask import mask
 from shapely.geometry import Point
 
 from pathlib import Path
-from shapely.geometry import Polygon
+from emoc.raster import read_tif
+from emoc.population import disaggregate_population
+from emoc.matrix import MatrixClient, ORS_API_URL, nearest_destinations
+from emoc.od_cache import ODCache
+from emoc.routing import RoadNetwork, nearest_facilities
+from emoc.e2sfca import accessibility_index, gaussian_weights
+from emoc.output import classify, focus_areas, model_output, write_model_output
+
+import sys
+sys.path.append('../../../utils')
+from ideamaps.grid import load_reference_grid
+from ideamaps.storage import IntermediateStore
 
 import requests
 import math
@@ -123,6 +134,8 @@ client = openrouteservice.Client(key=api_key)
 # Define directories
 data_inputs = '../scripts/Lagos/data-inputs/'
 data_temp = '../scripts/Lagos/data-temp/'
+# Intermediate layers are stored as GeoParquet in data-temp, the final outputs as GeoPackage and CSV
+temp_store = IntermediateStore(data_temp)
 model_outputs = '../lagos/'
 
 # %% [markdown]
@@ -206,7 +219,7 @@ grid_df["rowid"] = range(1, len(grid_df) + 1)
 population_centroids_gdf = gpd.GeoDataFrame(grid_df, geometry=[Point(xy) for xy in zip(grid_df["longitude"], grid_df["latitude"])])
 population_centroids_gdf.set_crs("EPSG:4326", inplace=True)
 
-population_centroids_gdf.to_file(data_temp + "population_centroids.gpkg", driver="GPKG")
+temp_store.write(population_centroids_gdf, 'population_centroids')
 
 # %%
 population_centroids_gdf
@@ -215,54 +228,13 @@ population_centroids_gdf
 # ### Adding population data at 1km grid to 100m grid
 
 # %%
-# reading in geotiff file as numpy array
-def read_tif(file: Path):
-    if not file.exists():
-        raise FileNotFoundError(f'File {file} not found')
-
-    with rasterio.open(file) as dataset:
-        arr = dataset.read()  # (bands X height X width)
-        nodata = dataset.nodata
-        transform = dataset.transform
-        crs = dataset.crs
-
-    # Replace NoData value with NaN
-    if nodata is not None:
-        arr[arr == nodata] = np.nan
-
-    return arr.transpose((1, 2, 0)), transform, crs
-
-def raster2vector(arr, transform, crs) -> gpd.GeoDataFrame:
-    height, width, bands = arr.shape
-
-    # Generate pixel coordinates
-    geometries = []
-    pixel_values = []
-
-    for row in range(height):
-        for col in range(width):
-            x_min, y_max = transform * (col, row)  # Top-left corner
-            x_max, y_min = transform * (col + 1, row + 1)  # Bottom-right corner
-
-            pixel_value = arr[row, col].tolist()[0]  # Convert numpy array to list
-            polygon = Polygon([(x_min, y_max), (x_max, y_max), (x_max, y_min), (x_min, y_min)])
-
-            geometries.append(polygon)
-            pixel_values.append(pixel_value)
-
-    # Convert to DataFrame
-    gdf = gpd.GeoDataFrame({'pop_grid_pop': pixel_values, 'geometry': geometries}, crs=crs)
-
-    return gdf
-
-epsg = 'EPSG:32632'
+# Reference grid with stable grid ids (built once from the grid file, see ideamaps.grid) and the UTM zone of the city
+reference_grid = load_reference_grid(data_inputs + '100mGrid.gpkg')
+epsg = f'EPSG:{reference_grid.utm_epsg}'
 
 # %%
 # Preparing grid
-grid_file = data_inputs + '100mGrid.gpkg'
-grid = gpd.read_file(grid_file)
-grid = grid.to_crs(epsg)
-grid['grid_id'] = range(len(grid))
+grid = reference_grid.cells.to_crs(epsg)
 grid = grid[['grid_id', 'geometry','rowid', 'latitude', 'lat_min', 'lat_max', 'longitude', 'lon_min','lon_max']].set_geometry('geometry')
 grid
 
@@ -304,42 +276,16 @@ data_path = Path(data_inputs)
 pop_file = data_path / 'lagos_nga_f_15_49_2015_1km.tif'
 pop_raster, transform, crs = read_tif(pop_file)
 
-# Converting the raster grid to vector data
-pop_grid = raster2vector(pop_raster, transform, crs)
-pop_grid = pop_grid.to_crs(epsg)
-pop_grid['pop_grid_id'] = range(len(pop_grid))
-# pop_grid.to_parquet(data_path / 'sanity_check_pop.parquet')
-
-# Assign coarse population data to finer grid based on the centroid locations of the finer grid cells
-grid['centroid'] = grid['geometry'].centroid
-grid = gpd.sjoin(grid.set_geometry('centroid'), pop_grid, how='left', predicate='within')
-print(grid.columns)
-grid = grid[['grid_id', 'bcount', 'pop_grid_id', 'geometry','rowid', 'latitude', 'lat_min', 'lat_max',
-       'longitude', 'lon_min', 'lon_max']]
-grid.head()
-
-# %%
-# Calculate population weight (fraction of total population count that should be assigned to cell based on its building count)
-grid_grouped_pop = grid.groupby('pop_grid_id')
-building_count_pop = grid_grouped_pop['bcount'].sum().rename('pop_grid_bcount')
-grid = grid.merge(building_count_pop, on='pop_grid_id', how='left')
-grid['pop_weight'] = grid['bcount'] / grid['pop_grid_bcount']
-
-# Compute disaggregated population count based on weight and building count at coarser cell level
-grid = grid.merge(pop_grid, on='pop_grid_id', how='left')
-grid['pop'] = grid['pop_grid_pop'] * grid['pop_weight']
+# Assign coarse population data to finer grid based on the centroid locations of the finer grid cells.
+# The parent 1km pixel of each cell follows from the raster transform, and the population of the pixel is
+# weighted by the share of the cell in the building count of the pixel (pop_weight)
+grid = grid.join(disaggregate_population(grid, pop_raster, transform, crs))
 grid.head()
 
 # %%
 # Saving to file
-grid = grid.drop(columns=["geometry_y"])
-grid.head()
-
-
-# %%
-grid = grid.set_geometry("geometry_x")
 grid = grid.to_crs(4326)
-grid.to_file(data_temp + 'pop_grid-lagos-centroids.gpkg', driver='GPKG')
+temp_store.write(grid, 'pop_grid-lagos-centroids')
 
 # %% [markdown]
 # ## 2. Spatial Analysis Pipeline 
@@ -363,63 +309,32 @@ origins = list(zip(origin_gdf.geometry.x, origin_gdf.geometry.y))
 destinations = list(zip(destination_gdf.geometry.x, destination_gdf.geometry.y))
 
 # %%
-locations = origins + destinations
-
-# %%
-origins_index = list(range(0, len(origins)))
-destinations_index = list(range(len(origins), len(locations)))
-
-# %%
-body = {'locations': locations,
-       'destinations': destinations_index,
-       'sources': origins_index,
-       'metrics': ['distance', 'duration']}
-
-headers = {
-    'Accept': 'application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8',
-    'Authorization': api_key,
-    'Content-Type': 'application/json; charset=utf-8'
-}
-
-response = requests.post('https://api.openrouteservice.org/v2/matrix/driving-car', json=body, headers=headers)
-
-# %%
-distances = response.json().get('distances', [])
-durations = response.json().get('durations', [])
+# The matrix is split into requests under the ORS limits (max_routes = sources x destinations), which are
+# sent concurrently and retried with backoff. For a local ORS instance, use its url (e.g. 'http://localhost:8080/ors')
+# and the maximum_routes of its configuration. Travel times are cached in the temp folder, so that reruns only
+# request pairs of new centroids or facilities
+od_cache = ODCache(data_temp + 'od-cache.sqlite')
+matrix_client = MatrixClient(ORS_API_URL, api_key=api_key, profile='driving-car', max_routes=3500, workers=4,
+                             cache=od_cache)
+od_matrix = matrix_client.compute(origins, destinations, metrics=['distance', 'duration'])
 
 # %%
-distances_duration_matrix = []
-
-# Iterate over each origin (grid)
-for origin_index, origin in origin_gdf.iterrows():
-    origin_name = origin[origin_name_column]
-    origin_x = origin.geometry.x
-    origin_y = origin.geometry.y
-    origin_distances = distances[origin_index]
-    origin_durations = durations[origin_index]
-
-    # find the minimum duration and the index of the minimum duration
-    min_duration = min(origin_durations)
-    min_index = origin_durations.index(min_duration)
-    destination_index = destinations_index[min_index]
-    dest_x, dest_y = locations[destination_index]
-    filtered = healthcare_facilities_validated[(destination_gdf.geometry.x == dest_x) & (destination_gdf.geometry.y == dest_y) ]
-    destination_row = filtered.iloc[0]
-    dest_name = destination_row[destination_name_column]
-
-        # Append both the distance and duration for this origin-destination pair
-    distances_duration_matrix.append([
-            origin_name, origin_y, origin_x,
-            dest_name, dest_y, dest_x,
-            min_duration
-        ])
+# Nearest facility of each origin (grid), found for all origins at once. Origins without any route get a NaN duration
+nearest_index, min_duration = nearest_destinations(od_matrix.durations)
+routed = nearest_index >= 0
+nearest_facility = destination_gdf.iloc[np.where(routed, nearest_index, 0)]
 
 # %%
 # Convert the results into a DataFrame
-matrix_df = pd.DataFrame(distances_duration_matrix, columns=[
-    'grid_code','origin_lat', 'origin_lon',
-    'destination_name', 'dest_lat', 'dest_lon','min_duration'
-])
+matrix_df = pd.DataFrame({
+    'grid_code': origin_gdf[origin_name_column].to_numpy(),
+    'origin_lat': origin_gdf.geometry.y.to_numpy(),
+    'origin_lon': origin_gdf.geometry.x.to_numpy(),
+    'destination_name': np.where(routed, nearest_facility[destination_name_column].to_numpy(), None),
+    'dest_lat': np.where(routed, nearest_facility.geometry.y.to_numpy(), np.nan),
+    'dest_lon': np.where(routed, nearest_facility.geometry.x.to_numpy(), np.nan),
+    'min_duration': min_duration,
+})
 
 # %%
 # Save to CSV
@@ -433,8 +348,7 @@ merged_df
 geometry = [Point(xy) for xy in zip(merged_df['dest_lon'], merged_df['dest_lat'])]
 gdf = gpd.GeoDataFrame(merged_df, geometry=geometry, crs="EPSG:4326")
 
-gpkg_path = data_temp + 'distance_duration_matrix_temp.gpkg'
-gdf.to_file(gpkg_path, layer="duration_matrix", driver="GPKG")
+temp_store.write(gdf, 'distance_duration_matrix_temp')
 
 # %% [markdown]
 # ### Option 2: Using a local ORS service
@@ -460,6 +374,27 @@ gdf.to_file(gpkg_path, layer="duration_matrix", driver="GPKG")
 # 
 # ### Diego please add description here
 
+# %% [markdown]
+# ### Option 3: Using the built-in routing engine
+# Travel times can also be computed offline on the OSM road network of the study area (e.g. extracted with
+# `osm_roads_download.py -p <extract.osm.pbf>` of the morphological informality model), without an ORS service.
+# Road speeds follow the ORS defaults of the profile, and grid cells or facilities further than 350 m from a road are not routed.
+# It is off by default: set `use_local_routing = True` to run it, the result is then written to `OD-matrix-lagos-local.csv`
+# and processed below instead of the ORS OD matrix.
+
+# %%
+use_local_routing = False
+
+if use_local_routing:
+    road_network = RoadNetwork.from_parquet(data_inputs + 'roads.parquet', profile='driving-car')
+    grid_centroids = temp_store.read('pop_grid-lagos-centroids')
+    facilities = healthcare_facilities_validated.dropna(subset=['geometry'])
+    matrix_df = nearest_facilities(road_network, grid_centroids, facilities, 'rowid', 'hcf_id',
+                                   category_column='validation', k=3)
+    # The facility class is kept in the OD matrix file
+    matrix_df['validation'] = matrix_df['origin_id'].map(facilities.set_index('hcf_id')['validation'])
+    matrix_df.to_csv(data_temp + 'OD-matrix-lagos-local.csv', index=False)
+
 # %% [markdown]
 # ## Processing OD Matrix
 
@@ -468,12 +403,13 @@ gdf.to_file(gpkg_path, layer="duration_matrix", driver="GPKG")
 
 # %%
 # If not loaded yet, read from the temporary folder
-centroids_df = gpd.read_file(data_temp +'pop-grid-nairobi-centroids.gpkg')
+centroids_df = temp_store.read('pop_grid-lagos-centroids')
 centroids_df
 
 # %%
 # If not loaded yet, read from the temporary folder, selected ten closest healthcare facilities.
-matrix_df = pd.read_csv(data_temp + 'OD-matrix-lagos-access-emoc.csv')
+od_matrix_file = 'OD-matrix-lagos-local.csv' if use_local_routing else 'OD-matrix-lagos-access-emoc.csv'
+matrix_df = pd.read_csv(data_temp + od_matrix_file)
 matrix_df
 
 # %% [markdown]
@@ -529,8 +465,7 @@ geometry = [Point(xy) for xy in zip(distances_duration_matrix['origin_lon'], dis
 gdf = gpd.GeoDataFrame(distances_duration_matrix, geometry=geometry, crs="EPSG:4326")
 
 # %%
-gpkg_path = data_temp + 'distances_duration_10_closet_Emoc.gpkg'
-gdf.to_file(gpkg_path, layer="distances_duration_10_closet_Emoc", driver="GPKG")
+temp_store.write(gdf, 'distances_duration_10_closet_Emoc')
 
 # %%
 # Review and remove
@@ -543,6 +478,7 @@ origin_dest = distances_duration_matrix
 # Function
 d = 10 * 60 # try max duration 5/10mins/15mins/20 car, under estimation of travel time and traffic condition realted to the selected data sourse 
 W = 0.01
+catchment_sizes = [5 * 60, 10 * 60, 15 * 60, 20 * 60]  # sensitivity analysis of d
 beta = - d ** 2 / log(W)
 print(beta)
 
@@ -565,35 +501,7 @@ origin_dest_acc = origin_dest  # Backup
 # facilities based on the travel duration. d is the travel time and beta is the decay 
 # parameter previously calculated.
 # The weight decreases as the duration increases, meaning facilities that are further away have less impact.
-origin_dest_acc['Weight'] = origin_dest_acc['duration_seconds'].apply(lambda d: round(math.exp(-d**2/beta), 8))
-
-# %%
-# Compute the Weighted Population (Pop_W), the population of each grid cell is multiplied 
-# by the corresponding weight to calculate the weighted population.
-origin_dest_acc['Pop_W'] = origin_dest_acc['population'] * origin_dest_acc['Weight']
-
-# %%
-origin_dest_acc
-
-# %%
-# Sum the Weighted Population
-origin_dest_sum = origin_dest_acc.groupby(by='hcf_id')['Pop_W'].sum().reset_index()
-
-# %%
-origin_dest_sum
-
-# %%
-# Merge the Sum of Weighted Population Back into the Original Data
-origin_dest_acc = origin_dest_acc.merge(origin_dest_sum, on='hcf_id')
-
-# %%
-origin_dest_acc
-
-# %%
-# supply value is set to 1 for simplicity (capacity of HCF)
-# supply = 1
-# in the future, we will link supply with ownership and EmOC service level
-origin_dest_acc = origin_dest_acc.rename(columns={'Pop_W_y': 'Pop_W_S'})  # Pop_W_S: Population Weight Sum
+origin_dest_acc['Weight'] = gaussian_weights(origin_dest_acc['duration_seconds'], d, W)
 
 # %%
 supply_map = {
@@ -602,17 +510,13 @@ supply_map = {
 }
 
 # %%
-origin_dest_acc['supply'] = origin_dest_acc['validation'].map(supply_map)
-origin_dest_acc['supply_demand_ratio'] = origin_dest_acc['supply'] / origin_dest_acc['Pop_W_S']
-origin_dest_acc['supply_demand_ratio'].replace([np.inf, -np.inf, np.nan], 0, inplace=True)
-
-# %%
-# Calculate Rj * Weight for Each Grid Cell
-origin_dest_acc['supply_W'] = origin_dest_acc['supply_demand_ratio'] * origin_dest_acc.Weight
-
-# %%
-# Compute Accessibility Index (Ai) for Each Grid Cell
-origin_dest_acc['Accessibility'] = origin_dest_acc.groupby('grid_id')['supply_W'].transform('sum')
+# Compute the Accessibility Index (Ai) for each grid cell: the population weighted by the travel time to each facility
+# gives its supply-demand ratio (Rj), and the ratios of the facilities reached from a grid cell are summed with the
+# same weights. The index is computed for all catchment sizes at once, d is used for the results.
+accessibility = accessibility_index(origin_dest_acc, 'grid_id', 'hcf_id', 'duration_seconds', 'population',
+                                    'validation', supply_map, d=catchment_sizes, w=W)
+origin_dest_acc['Accessibility'] = origin_dest_acc['grid_id'].map(accessibility[d])
+accessibility
 
 # %%
 # Normalize
@@ -627,15 +531,14 @@ max(origin_dest_acc.Accessibility_standard)
 
 # %%
 gdf = gpd.GeoDataFrame(origin_dest_acc, geometry='geometry', crs="EPSG:4326")
-gpkg_path = data_temp + 'acc_score_3closest.gpkg'
-gdf.to_file(gpkg_path, layer="acc_score_3closest", driver="GPKG")
+temp_store.write(gdf, 'acc_score_3closest')
 
 # %% [markdown]
 # # 4. Grouping by grid ID to prepare the final output file
 
 # %%
-# Read the GeoPackage file (if starting from this section)
-results_grid = gpd.read_file(data_temp + 'acc_score_3closest.gpkg')
+# Read the intermediate layer (if starting from this section)
+results_grid = temp_store.read('acc_score_3closest')
 
 # %%
 results_grid = results_grid[['grid_id', 'origin_lon', 'origin_lat', 'origin_lon_min', 'origin_lat_min', 'origin_lon_max', 'origin_lat_max', 'Accessibility_standard', 'geometry']]
@@ -657,10 +560,9 @@ results_grid
 # Note: For Lagos, we excluded grid cells with index values below 0 that indicated very low population and a small number of buildings.  
 
 # %%
-results_grid['result'] = -1
-results_grid.loc[results_grid['Accessibility_standard'] >= 0, 'result'] = 2
-results_grid.loc[results_grid['Accessibility_standard'] > 0.007, 'result'] = 1
-results_grid.loc[results_grid['Accessibility_standard'] > 0.015, 'result'] = 0
+# Thresholds of the result classes (High, Medium and Low), no cells are excluded (index values >= 0)
+result_thresholds = [-np.inf, 0.007, 0.015]
+results_grid['result'] = classify(results_grid['Accessibility_standard'], result_thresholds)
 
 # %%
 category_counts = results_grid['result'].value_counts()
@@ -672,41 +574,32 @@ print(category_counts)
 # We defined the focus areas based on values for the different thresholds. We aim at participants helping us to confirm the selection of the city-specific thresholds.
 
 # %%
-results_grid['focused'] = 0
-# Focus areas between the Low category and city expansion areas
-# results_grid.loc[(results_grid['Accessibility_standard'] > 0.000001) & (results_grid['Accessibility_standard'] < 0.0000015), 'focused'] = 1
-# Focus areas between the Medium and High categories
-results_grid.loc[(results_grid['Accessibility_standard'] > 0.005) & (results_grid['Accessibility_standard'] < 0.009), 'focused'] = 1
-# Focus areas between the Low and Medium categories
-results_grid.loc[(results_grid['Accessibility_standard'] > 0.014) & (results_grid['Accessibility_standard'] < 0.016), 'focused'] = 1
-
-# %%
-results_grid
+focus_intervals = [
+    # (0.000001, 0.0000015),  # Between the Low category and city expansion areas
+    (0.005, 0.009),  # Between the Medium and High categories
+    (0.014, 0.016),  # Between the Low and Medium categories
+]
+results_grid['focused'] = focus_areas(results_grid['Accessibility_standard'], focus_intervals)
 
 # %%
-results_grid = results_grid.loc[results_grid['result'] != -1]
+category_counts = results_grid['focused'].value_counts()
+print(category_counts)
 
 # %%
-results_grid = results_grid.rename(columns={
-    'origin_lon': 'longitude',
-    'origin_lat': 'latitude',
-    'origin_lon_min': 'lon_min',
-    'origin_lat_min': 'lat_min',
-    'origin_lon_max': 'lon_max',
-    'origin_lat_max': 'lat_max'
-})
-
-results_grid
+# Cell centroids and bounds, focus areas and classes in the format required by the IDEAMAPS data ecosystem.
+# Excluded cells are dropped
+results_table = model_output(results_grid, 'Accessibility_standard', result_thresholds, focus_intervals)
+results_table
 
 # %%
 # Save the results to a new GeoPackage file
+results_grid = results_grid[['grid_id', 'Accessibility_standard', 'geometry']].join(results_table, how='inner')
 output_gpkg_path = data_temp + 'emergency-maternal-care-deprivation-access-class.gpkg'
 results_grid.to_file(output_gpkg_path, layer='emergency-maternal-care-deprivation-access-class', driver='GPKG')
 
 # %%
 # Save the results to a CSV file in the format required by the IDEAMAPS data ecosystem
-results_table = results_grid.drop(columns=['Accessibility_standard', 'grid_id', 'geometry'])
-results_table.to_csv(model_outputs + 'model-output.csv', index=False)
+write_model_output(results_table, model_outputs + 'model-output.csv')
 
 # %%
 results_table
@@ -0,0 +1,5 @@
+from pathlib import Path
+import sys
+
+# Shared modules of the models (ideamaps, see utils/ at the root of the repository)
+sys.path.append(str(Path(__file__).resolve().parents[4] / 'utils'))
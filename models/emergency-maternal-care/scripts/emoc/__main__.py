@@ -0,0 +1,37 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
+
+from dotenv import load_dotenv
+
+from emoc.config import CityConfig
+from emoc.pipeline import run_city
+
+
+def argument_parser():
+    # https://docs.python.org/3/library/argparse.html#the-add-argument-method
+    parser = argparse.ArgumentParser(description="Run the EmOC access deprivation model for one or more cities")
+    parser.add_argument('configs', nargs='+', help="city config files (e.g. emoc/configs/kano.json)")
+    parser.add_argument('-j', '--jobs', dest='jobs', default=1, type=int, help="number of cities run in parallel")
+    parser.add_argument('--api-key', dest='api_key', default=None,
+                        help="openrouteservice API key for the ors routing engine "
+                             "(default OPENROUTESERVICE_API_KEY from the environment or a .env file)")
+    return parser
+
+
+def run(config_file: str, api_key: str):
+    return run_city(CityConfig.from_json(config_file), api_key)
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_known_args()[0]
+    load_dotenv()
+    api_key = args.api_key or os.getenv('OPENROUTESERVICE_API_KEY')
+
+    if args.jobs == 1:
+        for config_file in args.configs:
+            run(config_file, api_key)
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            for output_file in executor.map(run, args.configs, [api_key] * len(args.configs)):
+                print(f'Finished {output_file}.')
@@ -0,0 +1,86 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+import json
+
+import numpy as np
+from pandas import DataFrame, Series
+
+from ideamaps.rules import evaluate_rules
+
+
+def categorize(facilities: DataFrame, rules: List[dict], default: str = 'Other') -> Series:
+    """
+    EmOC category of each facility from ordered rules, the first matching rule assigns the category.
+
+    Each rule has a category and conditions on facility columns (see ideamaps.rules.rule_condition), e.g.
+    {"category": "Public Basic EmOC", "where": {"Ownership": {"in": ["MoH"]}, "Level": {"eq": "BMOC"}}}
+    """
+    return evaluate_rules(facilities, [{'value': rule['category'], 'where': rule['where']} for rule in rules],
+                          default=default, name='category')
+
+
+@dataclass
+class RoutingConfig:
+    """
+    Source of the travel times between grid cells and facilities.
+
+    - engine: 'file' (precomputed OD matrix csv with origin_id, destination_id, duration_seconds and distance_km
+      columns, e.g. the ORS OD matrix of the notebooks), 'local' (built-in routing on a road network) or 'ors'
+      (openrouteservice matrix endpoint)
+    """
+    engine: str = 'file'
+    profile: str = 'driving-car'
+    road_file: Optional[str] = None
+    base_url: Optional[str] = None
+    max_routes: int = 3500
+    workers: int = 4
+    od_matrix_file: Optional[str] = None
+    grid_id_column: str = 'grid_id'  # grid column the ids of the OD matrix file refer to
+    grid_origin: bool = False  # grid cells are the origins of the OD matrix file
+
+
+@dataclass
+class CityConfig:
+    """
+    Parameters of the EmOC access deprivation model for a city, see configs/ for examples.
+
+    Relative paths are resolved against the directory of the config file.
+    """
+    name: str
+    data_inputs: Path
+    data_temp: Path
+    model_outputs: Path
+    grid_file: str
+    population_file: str
+    buildings_file: str
+    facilities_file: str
+    facility_id_column: str
+    category_rules: List[dict]
+    categories: List[str]
+    supply_map: Optional[Dict[str, float]] = None  # unit supply if not set
+    d: float = 600
+    w: float = 0.01
+    catchment_sizes: List[float] = field(default_factory=list)
+    k: int = 3
+    result_thresholds: List[float] = field(default_factory=list)
+    focus_intervals: List[Tuple[float, float]] = field(default_factory=list)
+    routing: RoutingConfig = field(default_factory=RoutingConfig)
+
+    @classmethod
+    def from_json(cls, file: Union[str, Path]) -> 'CityConfig':
+        file = Path(file)
+        params = json.loads(file.read_text())
+        for key in ('data_inputs', 'data_temp', 'model_outputs'):
+            params[key] = (file.parent / params[key]).resolve()
+        # Thresholds can be given as null for -inf (no excluded cells)
+        params['result_thresholds'] = [-np.inf if t is None else t for t in params.get('result_thresholds', [])]
+        params['focus_intervals'] = [tuple(interval) for interval in params.get('focus_intervals', [])]
+        params['routing'] = RoutingConfig(**params.get('routing', {}))
+        config = cls(**params)
+        if config.d not in config.catchment_sizes:
+            config.catchment_sizes = sorted(config.catchment_sizes + [config.d])
+        return config
+
+    def input_path(self, file: str) -> Path:
+        return self.data_inputs / file
@@ -0,0 +1,85 @@
+from typing import Dict, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+
+def gaussian_beta(d: float, w: float = 0.01) -> float:
+    """Decay parameter of the Gaussian weight, such that the weight at the catchment size d (s) is w."""
+    return -d ** 2 / np.log(w)
+
+
+def gaussian_weights(durations: np.ndarray, d: float, w: float = 0.01) -> np.ndarray:
+    """Gaussian decay weights of travel durations (s), rounded to 8 decimals as in the original scripts."""
+    return np.round(np.exp(-np.asarray(durations, dtype=np.float64) ** 2 / gaussian_beta(d, w)), 8)
+
+
+def e2sfca(origin_index: np.ndarray, facility_index: np.ndarray, durations: np.ndarray, population: np.ndarray,
+           supply: Optional[np.ndarray] = None, d: Union[float, Sequence[float]] = 600, w: float = 0.01,
+           n_origins: Optional[int] = None, n_facilities: Optional[int] = None) -> np.ndarray:
+    """
+    Enhanced two-step floating catchment area (E2SFCA) accessibility index on a sparse OD matrix.
+
+    Parameters:
+    - origin_index, facility_index, durations: origin-facility pairs (COO format), durations in seconds
+    - population: demand of each origin (n_origins)
+    - supply: supply of each facility (n_facilities), default 1
+    - d: catchment size(s) (s) of the Gaussian decay, one index is computed for each
+    - w: weight at the catchment size
+
+    Returns:
+    - accessibility of each origin, (n_origins) for a single d or (len(d) X n_origins)
+    """
+    origin_index, facility_index = np.asarray(origin_index), np.asarray(facility_index)
+    n_origins = n_origins if n_origins is not None else int(origin_index.max(initial=-1)) + 1
+    n_facilities = n_facilities if n_facilities is not None else int(facility_index.max(initial=-1)) + 1
+    population = np.asarray(population, dtype=np.float64)
+    supply = np.ones(n_facilities) if supply is None else np.nan_to_num(np.asarray(supply, dtype=np.float64))
+
+    catchments = np.atleast_1d(d)
+    accessibility = np.zeros((len(catchments), n_origins))
+    for i, catchment in enumerate(catchments):
+        weights = gaussian_weights(durations, catchment, w)
+
+        # Step 1: supply-demand ratio of each facility, from the weighted population of its catchment
+        demand = np.bincount(facility_index, weights=population[origin_index] * weights, minlength=n_facilities)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(demand > 0, supply / demand, 0)
+
+        # Step 2: accessibility of each origin, the weighted sum of the ratios of the facilities it reaches
+        accessibility[i] = np.bincount(origin_index, weights=ratio[facility_index] * weights, minlength=n_origins)
+    return accessibility if np.ndim(d) > 0 else accessibility[0]
+
+
+def accessibility_index(od: DataFrame, origin_column: str, facility_column: str, duration_column: str,
+                        population_column: str, supply_column: Optional[str] = None,
+                        supply_map: Optional[Dict[str, float]] = None, d: Union[float, Sequence[float]] = 600,
+                        w: float = 0.01) -> DataFrame:
+    """
+    E2SFCA accessibility index of each origin of a long OD table (one row per origin-facility pair).
+
+    Parameters:
+    - od: OD table with the origin and facility ids, travel durations (s) and the population of the origins
+    - supply_column, supply_map: facility column mapped to the facility supply (e.g. by EmOC category), default 1
+    - d: catchment size(s) (s), see e2sfca
+
+    Returns:
+    - DataFrame indexed by origin id with one accessibility column per catchment size
+    """
+    od = od.dropna(subset=[duration_column])
+    origin_index, origin_ids = pd.factorize(od[origin_column])
+    facility_index, facility_ids = pd.factorize(od[facility_column])
+
+    # Population of each origin and supply of each facility, missing values count as 0
+    population = np.zeros(len(origin_ids))
+    population[origin_index] = np.nan_to_num(od[population_column].to_numpy(dtype=np.float64))
+    supply = None
+    if supply_map is not None:
+        supply = np.zeros(len(facility_ids))
+        supply[facility_index] = od[supply_column].map(supply_map).to_numpy(dtype=np.float64)
+
+    catchments = np.atleast_1d(d)
+    accessibility = e2sfca(origin_index, facility_index, od[duration_column].to_numpy(), population, supply,
+                           catchments, w, len(origin_ids), len(facility_ids))
+    return DataFrame(accessibility.T, index=pd.Index(origin_ids, name=origin_column), columns=catchments.tolist())
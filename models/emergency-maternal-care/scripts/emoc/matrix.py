@@ -0,0 +1,188 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+import time
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from emoc.od_cache import ODCache
+
+ORS_API_URL = 'https://api.openrouteservice.org'
+
+# HTTP status codes worth retrying (rate limit, server overload)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class ODMatrix:
+    """Dense origin-destination matrices (sources X destinations), NaN where no route was found."""
+    durations: Optional[np.ndarray] = None  # seconds
+    distances: Optional[np.ndarray] = None  # metres
+
+
+def matrix_tiles(n_sources: int, n_destinations: int, max_routes: int,
+                 max_locations: Optional[int] = None) -> List[Tuple[slice, slice]]:
+    """
+    Split a sources X destinations matrix into blocks that respect the limits of the matrix endpoint.
+
+    All destinations are kept in a block whenever possible, since facilities are far fewer than origins.
+    """
+    max_locations = max_locations or max_routes
+    n_dst = max(min(n_destinations, max_routes, max_locations - 1), 1)
+    n_src = max(min(max_routes // n_dst, max_locations - n_dst, n_sources), 1)
+    return [(slice(i, min(i + n_src, n_sources)), slice(j, min(j + n_dst, n_destinations)))
+            for i in range(0, n_sources, n_src) for j in range(0, n_destinations, n_dst)]
+
+
+def missing_blocks(missing: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Group the missing pairs of a matrix into blocks (source indices, destination indices) to request.
+
+    Destinations missing for all sources (e.g. a new facility) form one block, the remaining missing pairs
+    (e.g. new origins) are requested as one block of the affected sources and destinations.
+    """
+    blocks = []
+    new_destinations = missing.all(axis=0)
+    if new_destinations.any():
+        blocks.append((np.arange(missing.shape[0]), np.flatnonzero(new_destinations)))
+    remaining = missing & ~new_destinations[None, :]
+    if remaining.any():
+        blocks.append((np.flatnonzero(remaining.any(axis=1)), np.flatnonzero(remaining.any(axis=0))))
+    return blocks
+
+
+def nearest_destinations(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Nearest destination of each source (row) of an OD matrix.
+
+    Returns:
+    - destination positions (-1 for sources without any route) and their values (NaN without route)
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    routed = ~np.isnan(matrix).all(axis=1)
+    nearest = np.argmin(np.where(np.isnan(matrix), np.inf, matrix), axis=1)
+    values = np.where(routed, matrix[np.arange(len(matrix)), nearest], np.nan)
+    return np.where(routed, nearest, -1), values
+
+
+class MatrixClient:
+    """
+    Client for the openrouteservice matrix endpoint (public API or a local ORS instance) that tiles large
+    matrices into requests under the configured limits and sends them concurrently, retrying with
+    exponential backoff.
+
+    Parameters:
+    - base_url: ORS base url, e.g. https://api.openrouteservice.org or http://localhost:8080/ors
+    - api_key: ORS API key (not required for local instances)
+    - profile: routing profile, e.g. driving-car or foot-walking
+    - max_routes: maximum number of sources X destinations per request (public API: 3500)
+    - max_locations: maximum number of locations per request (default max_routes)
+    - workers: number of concurrent requests
+    - retries: number of retries per request
+    - backoff: initial delay (s) between retries, doubled after each retry
+    - timeout: request timeout (s)
+    - cache: OD cache, only pairs missing from the cache are requested and the results are added to it
+    """
+
+    def __init__(self, base_url: str = ORS_API_URL, api_key: Optional[str] = None, profile: str = 'driving-car',
+                 max_routes: int = 3500, max_locations: Optional[int] = None, workers: int = 4, retries: int = 5,
+                 backoff: float = 1.0, timeout: float = 120, cache: Optional[ODCache] = None):
+        self.url = f'{base_url.rstrip("/")}/v2/matrix/{profile}'
+        self.profile = profile
+        self.max_routes = max_routes
+        self.max_locations = max_locations
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+
+        # Pooled session shared by the worker threads
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.session.headers.update({
+            'Accept': 'application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8',
+            'Content-Type': 'application/json; charset=utf-8',
+        })
+        if api_key is not None:
+            self.session.headers['Authorization'] = api_key
+
+    def post(self, body: dict) -> dict:
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, json=body, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(f'{response.status_code} from {self.url}: {response.text[:200]}',
+                                           response=response)
+                # Rate limited requests tell us how long to wait
+                retry_after = response.headers.get('Retry-After')
+                wait = float(retry_after) if retry_after is not None and retry_after.isdigit() else delay
+            except (requests.ConnectionError, requests.Timeout) as err:
+                error, wait = err, delay
+            if attempt == self.retries:
+                raise error
+            time.sleep(wait)
+            delay *= 2
+
+    def request_tile(self, sources: np.ndarray, destinations: np.ndarray,
+                     metrics: Sequence[str]) -> Dict[str, np.ndarray]:
+        body = {
+            'locations': np.concatenate([sources, destinations]).tolist(),
+            'sources': list(range(len(sources))),
+            'destinations': list(range(len(sources), len(sources) + len(destinations))),
+            'metrics': list(metrics),
+        }
+        result = self.post(body)
+        # Unreachable pairs are returned as null
+        return {metric: np.array(result[f'{metric}s'], dtype=np.float64) for metric in metrics}
+
+    def request_matrix(self, sources: np.ndarray, destinations: np.ndarray,
+                       metrics: Sequence[str]) -> Dict[str, np.ndarray]:
+        matrices = {metric: np.full((len(sources), len(destinations)), np.nan) for metric in metrics}
+        tiles = matrix_tiles(len(sources), len(destinations), self.max_routes, self.max_locations)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.request_tile, sources[rows], destinations[cols], metrics): (rows, cols)
+                       for rows, cols in tiles}
+            for future, (rows, cols) in futures.items():
+                for metric, values in future.result().items():
+                    matrices[metric][rows, cols] = values
+        return matrices
+
+    def compute(self, sources: Sequence[Tuple[float, float]], destinations: Sequence[Tuple[float, float]],
+                metrics: Sequence[str] = ('distance', 'duration')) -> ODMatrix:
+        """
+        Compute the travel durations and/or distances between all sources and destinations.
+
+        Parameters:
+        - sources, destinations: (lon, lat) coordinates
+        - metrics: 'duration' and/or 'distance'
+
+        Returns:
+        - ODMatrix with dense (len(sources) X len(destinations)) arrays for the requested metrics
+        """
+        sources = np.asarray(sources, dtype=np.float64).reshape(-1, 2)
+        destinations = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+
+        if self.cache is None:
+            matrices = self.request_matrix(sources, destinations, metrics)
+        else:
+            # Pairs missing for any metric are requested again
+            matrices, missing = {}, np.zeros((len(sources), len(destinations)), dtype=bool)
+            for metric in metrics:
+                matrices[metric], found = self.cache.get(sources, destinations, self.profile, metric)
+                missing |= ~found
+
+            for rows, cols in missing_blocks(missing):
+                block = self.request_matrix(sources[rows], destinations[cols], metrics)
+                for metric, values in block.items():
+                    matrices[metric][np.ix_(rows, cols)] = values
+                    self.cache.put(sources[rows], destinations[cols], self.profile, metric, values)
+
+        return ODMatrix(durations=matrices.get('duration'), distances=matrices.get('distance'))
@@ -0,0 +1,108 @@
+from pathlib import Path
+from typing import Tuple, Union
+import sqlite3
+
+import numpy as np
+
+# Coordinates are rounded to 1e-6 degrees (about 0.1 m) before they are used as keys
+COORDINATE_PRECISION = 6
+
+
+def coordinate_keys(coords: np.ndarray) -> np.ndarray:
+    """
+    Encode (lon, lat) coordinates as integer keys, computed for all coordinates at once.
+
+    The rounded longitude and latitude are packed into a single int64 (29 + 28 bits), so that keys are
+    exact (no hash collisions) and compact to index.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    scale = 10 ** COORDINATE_PRECISION
+    lon = np.rint((coords[:, 0] + 180) * scale).astype(np.int64)
+    lat = np.rint((coords[:, 1] + 90) * scale).astype(np.int64)
+    return (lon << 28) | lat
+
+
+def first_occurrence(keys: np.ndarray) -> np.ndarray:
+    """Index of the first occurrence of each key."""
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return first[inverse]
+
+
+class ODCache:
+    """
+    On-disk travel time/distance cache (SQLite), keyed by origin, destination, routing profile and metric.
+
+    Unreachable pairs are cached as NULL, so that they are not requested again. New origins or facilities
+    only add rows, i.e. the cache is updated incrementally.
+    """
+
+    def __init__(self, file: Union[str, Path]):
+        self.file = Path(file)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.file), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS od (
+                origin INTEGER NOT NULL,
+                destination INTEGER NOT NULL,
+                profile TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                value REAL,
+                PRIMARY KEY (profile, metric, destination, origin)
+            ) WITHOUT ROWID
+        """)
+        self.connection.commit()
+
+    def _query_keys(self, table: str, keys: np.ndarray):
+        self.connection.execute(f'CREATE TEMP TABLE IF NOT EXISTS {table} (key INTEGER PRIMARY KEY, idx INTEGER)')
+        self.connection.execute(f'DELETE FROM {table}')
+        unique_keys, first = np.unique(keys, return_index=True)
+        self.connection.executemany(f'INSERT INTO {table} VALUES (?, ?)',
+                                    zip(unique_keys.tolist(), first.tolist()))
+
+    def get(self, sources: np.ndarray, destinations: np.ndarray, profile: str,
+            metric: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Look up the cached values of all sources X destinations pairs.
+
+        Returns:
+        - values (NaN where missing or unreachable) and a mask of the pairs found in the cache
+        """
+        source_keys, destination_keys = coordinate_keys(sources), coordinate_keys(destinations)
+        values = np.full((len(source_keys), len(destination_keys)), np.nan)
+        found = np.zeros(values.shape, dtype=bool)
+        if values.size == 0:
+            return values, found
+
+        # Join the cache with the requested keys (first occurrence of each key)
+        self._query_keys('query_origins', source_keys)
+        self._query_keys('query_destinations', destination_keys)
+        result = self.connection.execute("""
+            SELECT o.idx, d.idx, od.value FROM od
+            JOIN query_destinations d ON od.destination = d.key
+            JOIN query_origins o ON od.origin = o.key
+            WHERE od.profile = ? AND od.metric = ?
+        """, (profile, metric)).fetchall()
+        if len(result) > 0:
+            source_index, destination_index, cached = (np.array(column) for column in zip(*result))
+            values[source_index, destination_index] = np.array(cached, dtype=np.float64)
+            found[source_index, destination_index] = True
+
+            # Duplicated coordinates get the values of their first occurrence
+            rows, cols = np.ix_(first_occurrence(source_keys), first_occurrence(destination_keys))
+            values, found = values[rows, cols], found[rows, cols]
+        return values, found
+
+    def put(self, sources: np.ndarray, destinations: np.ndarray, profile: str, metric: str, values: np.ndarray):
+        """Store the values of all sources X destinations pairs (NaN values are stored as unreachable)."""
+        source_keys, destination_keys = coordinate_keys(sources), coordinate_keys(destinations)
+        origin, destination = np.meshgrid(source_keys, destination_keys, indexing='ij')
+        values = np.where(np.isnan(values), None, values).astype(object)
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO od (origin, destination, profile, metric, value) VALUES (?, ?, ?, ?, ?)',
+            zip(origin.ravel().tolist(), destination.ravel().tolist(), [profile] * origin.size,
+                [metric] * origin.size, values.ravel().tolist()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,75 @@
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+
+from geopandas import GeoDataFrame
+import numpy as np
+from pandas import DataFrame
+import shapely
+
+# Columns of the model output csv of the IDEAMAPS data ecosystem
+IDEAMAPS_COLUMNS = ['longitude', 'latitude', 'lon_min', 'lat_min', 'lon_max', 'lat_max', 'focused', 'result']
+
+# Result class by number of thresholds exceeded: excluded (-1), high (2), medium (1) and low (0) deprivation
+RESULT_CLASSES = (-1, 2, 1, 0)
+
+
+def classify(values: np.ndarray, thresholds: Sequence[float], classes: Sequence[int] = RESULT_CLASSES) -> np.ndarray:
+    """
+    Class of each value by the number of (increasing) thresholds it exceeds, i.e. classes[i] for
+    thresholds[i - 1] < value <= thresholds[i]. Missing values get the first class.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    classes = np.asarray(classes)
+    exceeded = np.digitize(values, thresholds, right=True)
+    return np.where(np.isnan(values), classes[0], classes[exceeded])
+
+
+def focus_areas(values: np.ndarray, intervals: Sequence[Tuple[float, float]]) -> np.ndarray:
+    """Flag (1) the values within any of the (open, non-overlapping) intervals, e.g. around the thresholds."""
+    values = np.asarray(values, dtype=np.float64)
+    if len(intervals) == 0:
+        return np.zeros(len(values), dtype=np.int64)
+    edges = np.sort(np.ravel(intervals))
+    # Inside an interval, a value is above an odd number of edges, whether the edges are included or not
+    inside = (np.digitize(values, edges, right=True) % 2 == 1) & (np.digitize(values, edges) % 2 == 1)
+    return inside.astype(np.int64)
+
+
+def model_output(grid: GeoDataFrame, value_column: str, thresholds: Sequence[float],
+                 focus_intervals: Sequence[Tuple[float, float]] = (), classes: Sequence[int] = RESULT_CLASSES,
+                 keep_excluded: bool = False) -> DataFrame:
+    """
+    Model output table of the grid cells in the IDEAMAPS schema.
+
+    Parameters:
+    - grid: grid cells with the index values
+    - value_column: column with the (standardised) index values
+    - thresholds: increasing class thresholds, see classify
+    - focus_intervals: value intervals of the focus areas, see focus_areas
+    - keep_excluded: keep the cells of the first (excluded) class
+
+    Returns:
+    - DataFrame with the IDEAMAPS columns (cell centroid, bounds, focused, result) in WGS84, indexed as grid
+    """
+    geometry = grid.geometry.to_crs(4326).values
+    bounds = shapely.bounds(geometry)
+    centroids = shapely.get_coordinates(shapely.centroid(geometry))
+    values = grid[value_column].to_numpy(dtype=np.float64)
+
+    table = DataFrame({
+        'longitude': centroids[:, 0],
+        'latitude': centroids[:, 1],
+        'lon_min': bounds[:, 0],
+        'lat_min': bounds[:, 1],
+        'lon_max': bounds[:, 2],
+        'lat_max': bounds[:, 3],
+        'focused': focus_areas(values, focus_intervals),
+        'result': classify(values, thresholds, classes),
+    }, index=grid.index)
+    return table if keep_excluded else table[table['result'] != classes[0]]
+
+
+def write_model_output(table: DataFrame, file: Union[str, Path], columns: Optional[Sequence[str]] = None):
+    """Write the model output csv (IDEAMAPS columns by default)."""
+    Path(file).parent.mkdir(parents=True, exist_ok=True)
+    table.to_csv(file, columns=list(columns or IDEAMAPS_COLUMNS), index=False)
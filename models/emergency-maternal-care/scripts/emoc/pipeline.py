@@ -0,0 +1,150 @@
+from pathlib import Path
+from typing import Optional
+import time
+
+import geopandas as gpd
+from geopandas import GeoDataFrame
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+import shapely
+
+from emoc.config import CityConfig, categorize
+from emoc.e2sfca import accessibility_index
+from emoc.matrix import MatrixClient, ORS_API_URL
+from emoc.od_cache import ODCache
+from emoc.output import model_output, write_model_output
+from emoc.population import disaggregate_population
+from emoc.raster import read_tif
+from emoc.routing import RoadNetwork, nearest_facilities
+from emoc.selection import k_smallest, k_smallest_columns
+
+OD_COLUMNS = ['grid_id', 'facility_id', 'category', 'duration_seconds', 'distance_km']
+
+
+def load_facilities(config: CityConfig) -> GeoDataFrame:
+    """Healthcare facilities of the selected EmOC categories, categorized with the rules of the config."""
+    facilities = gpd.read_file(config.input_path(config.facilities_file)).to_crs(4326)
+    facilities = facilities.dropna(subset=['geometry'])
+    facilities['category'] = categorize(facilities, config.category_rules)
+    facilities['facility_id'] = facilities[config.facility_id_column]
+    return facilities[facilities['category'].isin(config.categories)].reset_index(drop=True)
+
+
+def population_grid(config: CityConfig) -> GeoDataFrame:
+    """
+    100 m grid cells (UTM) with their building count (bcount) and the population of the coarse raster
+    distributed to the cells proportionally to their building count (pop).
+    """
+    grid = gpd.read_file(config.input_path(config.grid_file))
+    grid = grid.to_crs(grid.estimate_utm_crs())
+    grid['grid_id'] = range(len(grid))
+
+    # Building centroids are counted per grid cell
+    buildings = gpd.read_file(config.input_path(config.buildings_file), columns=['geometry']).to_crs(grid.crs)
+    centroids = gpd.GeoDataFrame(geometry=buildings.geometry.centroid, crs=grid.crs)
+    cell = centroids.sjoin(grid[['grid_id', 'geometry']], how='inner', predicate='intersects')['grid_id']
+    grid['bcount'] = np.bincount(cell.to_numpy(), minlength=len(grid)).astype(np.float64)
+
+    pop_raster, transform, crs = read_tif(config.input_path(config.population_file))
+    return grid.join(disaggregate_population(grid, pop_raster, transform, crs))
+
+
+def od_table(config: CityConfig, grid: GeoDataFrame, facilities: GeoDataFrame,
+             api_key: Optional[str] = None) -> DataFrame:
+    """
+    Travel times and distances from each grid cell to its k closest facilities of each category.
+
+    Returns:
+    - DataFrame with one row per grid cell and facility (OD_COLUMNS)
+    """
+    routing = config.routing
+    if routing.engine == 'local':
+        network = RoadNetwork.from_parquet(config.input_path(routing.road_file), routing.profile)
+        od = nearest_facilities(network, grid, facilities, 'grid_id', 'facility_id', 'category', config.k,
+                                grid_origin=True)
+        od = od.rename(columns={'origin_id': 'grid_id', 'destination_id': 'facility_id'})
+
+    elif routing.engine == 'ors':
+        origins = shapely.get_coordinates(grid.geometry.centroid.to_crs(4326).values)
+        destinations = shapely.get_coordinates(facilities.geometry.values)
+        client = MatrixClient(routing.base_url or ORS_API_URL, api_key, routing.profile, routing.max_routes,
+                              workers=routing.workers, cache=ODCache(config.data_temp / 'od-cache.sqlite'))
+        matrix = client.compute(origins, destinations, metrics=['distance', 'duration'])
+
+        # The k closest facilities of each category, selected on the dense matrix
+        tables = []
+        for _, positions in facilities.groupby('category', sort=False).indices.items():
+            columns, durations = k_smallest_columns(matrix.durations[:, positions], config.k)
+            found = columns >= 0
+            grid_position, facility_position = np.nonzero(found)[0], positions[columns[found]]
+            tables.append(DataFrame({
+                'grid_id': grid['grid_id'].to_numpy()[grid_position],
+                'facility_id': facilities['facility_id'].to_numpy()[facility_position],
+                'duration_seconds': durations[found],
+                'distance_km': matrix.distances[grid_position, facility_position] / 1000,
+            }))
+        od = pd.concat(tables, ignore_index=True)
+
+    elif routing.engine == 'file':
+        od = pd.read_csv(config.input_path(routing.od_matrix_file))
+        grid_column, facility_column = ('origin_id', 'destination_id') if routing.grid_origin else \
+            ('destination_id', 'origin_id')
+        od = od.rename(columns={grid_column: 'grid_ref', facility_column: 'facility_id'})
+        od['grid_id'] = od['grid_ref'].map(grid.set_index(routing.grid_id_column)['grid_id'])
+        od = od.dropna(subset=['grid_id', 'duration_seconds']).astype({'grid_id': np.int64})
+
+    else:
+        raise ValueError(f'Unknown routing engine {routing.engine}.')
+
+    od['category'] = od['facility_id'].map(facilities.set_index('facility_id')['category'])
+    od = od[od['category'].isin(config.categories)]
+    return k_smallest(od, ['grid_id', 'category'], 'duration_seconds', config.k)[OD_COLUMNS]
+
+
+def accessibility(config: CityConfig, od: DataFrame, grid: GeoDataFrame) -> DataFrame:
+    """
+    E2SFCA accessibility index of the grid cells with a travel time estimate, for all catchment sizes of the
+    config (columns) and the standardised (min-max) index for the catchment size d (Accessibility_standard).
+    """
+    od = od.assign(population=od['grid_id'].map(grid.set_index('grid_id')['pop']))
+    index = accessibility_index(od, 'grid_id', 'facility_id', 'duration_seconds', 'population',
+                                'category' if config.supply_map is not None else None, config.supply_map,
+                                d=config.catchment_sizes, w=config.w)
+
+    values = index[config.d].to_numpy()
+    value_range = values.max() - values.min() if len(values) > 0 else 0
+    index['Accessibility'] = values
+    index['Accessibility_standard'] = (values - values.min()) / value_range if value_range > 0 else 0.0
+    return index
+
+
+def run_city(config: CityConfig, api_key: Optional[str] = None) -> Path:
+    """Run the whole EmOC access deprivation model for a city and write its outputs."""
+    config.data_temp.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+
+    facilities = load_facilities(config)
+    grid = population_grid(config)
+    print(f'{config.name}: {len(grid)} grid cells and {len(facilities)} facilities loaded.')
+
+    od = od_table(config, grid, facilities, api_key)
+    od.to_csv(config.data_temp / f'OD-matrix-{config.name}-access-emoc.csv', index=False)
+    print(f'{config.name}: {len(od)} origin-destination pairs ({config.routing.engine} routing).')
+
+    index = accessibility(config, od, grid)
+    index.drop(columns=['Accessibility_standard']).to_csv(config.data_temp / 'accessibility-catchment-sizes.csv')
+
+    # Grid cells with an accessibility index, in the IDEAMAPS format
+    results_grid = grid[['grid_id', 'geometry']].join(index[['Accessibility_standard']], on='grid_id', how='inner')
+    results_table = model_output(results_grid, 'Accessibility_standard', config.result_thresholds,
+                                 config.focus_intervals)
+    results_grid = results_grid.join(results_table, how='inner').to_crs(4326)
+    results_grid.to_file(config.data_temp / 'emergency-maternal-care-deprivation-access-class.gpkg',
+                         layer='emergency-maternal-care-deprivation-access-class', driver='GPKG')
+
+    output_file = config.model_outputs / 'model-output.csv'
+    write_model_output(results_table, output_file)
+    print(f'{config.name}: {len(results_table)} grid cells written to {output_file} '
+          f'({time.perf_counter() - start:.1f} s).')
+    return output_file
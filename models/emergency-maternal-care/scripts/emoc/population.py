@@ -0,0 +1,60 @@
+from geopandas import GeoDataFrame
+from pandas import DataFrame
+import numpy as np
+from affine import Affine
+
+
+def parent_pixels(x: np.ndarray, y: np.ndarray, transform: Affine, height: int, width: int) -> np.ndarray:
+    """Flat index (row * width + col) of the raster pixel containing each point, -1 for points outside the raster."""
+    # Inverse of the affine transform, applied to all points at once
+    det = transform.a * transform.e - transform.b * transform.d
+    dx, dy = x - transform.c, y - transform.f
+    cols = np.floor((transform.e * dx - transform.b * dy) / det)
+    rows = np.floor((transform.a * dy - transform.d * dx) / det)
+    inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    return np.where(inside, rows * width + cols, -1).astype(np.int64)
+
+
+def disaggregate_population(grid: GeoDataFrame, pop_raster: np.ndarray, transform: Affine, crs,
+                            weight_column: str = 'bcount') -> DataFrame:
+    """
+    Distribute the population of coarse raster pixels to the grid cells whose centroid falls within them,
+    proportionally to the building count of the cells.
+
+    Parameters:
+    - grid: fine grid cells (any projected CRS) with a building count column
+    - pop_raster, transform, crs: coarse population raster as returned by emoc.raster.read_tif
+    - weight_column: column used to weight the cells within a pixel
+
+    Returns:
+    - DataFrame aligned with the grid index with pop_grid_id (flat pixel index), pop_grid_bcount (building
+      count of the pixel), pop_weight, pop_grid_pop (population of the pixel) and pop; cells of pixels without
+      buildings get a NaN weight and population, like cells outside the raster
+    """
+    height, width = pop_raster.shape[:2]
+    values = (pop_raster[:, :, 0] if pop_raster.ndim == 3 else pop_raster).ravel().astype(np.float64)
+
+    # Parent pixel of each cell from its centroid, in the CRS of the raster
+    centroids = grid.geometry.centroid.to_crs(crs)
+    parent = parent_pixels(centroids.x.to_numpy(), centroids.y.to_numpy(), transform, height, width)
+    inside = parent >= 0
+
+    # Building count per pixel, summed over the cells of each pixel
+    weights = grid[weight_column].to_numpy(dtype=np.float64)
+    pixel_bcount = np.bincount(parent[inside], weights=weights[inside], minlength=height * width)
+
+    pop_grid_bcount = np.full(len(grid), np.nan)
+    pop_grid_bcount[inside] = pixel_bcount[parent[inside]]
+    pop_grid_pop = np.full(len(grid), np.nan)
+    pop_grid_pop[inside] = values[parent[inside]]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pop_weight = weights / pop_grid_bcount
+
+    return DataFrame({
+        'pop_grid_id': np.where(inside, parent, np.nan),
+        'pop_grid_bcount': pop_grid_bcount,
+        'pop_weight': pop_weight,
+        'pop_grid_pop': pop_grid_pop,
+        'pop': pop_grid_pop * pop_weight,
+    }, index=grid.index)
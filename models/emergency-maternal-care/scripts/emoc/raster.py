@@ -0,0 +1,63 @@
+import geopandas as gpd
+from geopandas import GeoDataFrame
+import numpy as np
+import pandas as pd
+import rasterio
+import shapely
+from affine import Affine
+from pathlib import Path
+
+
+# reading in geotiff file as numpy array
+def read_tif(file: Path):
+    if not file.exists():
+        raise FileNotFoundError(f'File {file} not found')
+
+    with rasterio.open(file) as dataset:
+        arr = dataset.read()  # (bands X height X width)
+        nodata = dataset.nodata
+        transform = dataset.transform
+        crs = dataset.crs
+
+    # Replace NoData value with NaN
+    if nodata is not None:
+        arr = arr.astype(np.float64) if np.issubdtype(arr.dtype, np.integer) else arr
+        arr[arr == nodata] = np.nan
+
+    return arr.transpose((1, 2, 0)), transform, crs
+
+
+def pixel_bounds(transform: Affine, rows: np.ndarray, cols: np.ndarray):
+    """Bounds (x_min, y_min, x_max, y_max) of the given pixels, computed for all pixels at once."""
+    # Top-left and bottom-right corners, x = a * col + b * row + c and y = d * col + e * row + f
+    x_0, y_0 = transform.a * cols + transform.b * rows + transform.c, transform.d * cols + transform.e * rows + transform.f
+    x_1, y_1 = x_0 + transform.a + transform.b, y_0 + transform.d + transform.e
+    return np.minimum(x_0, x_1), np.minimum(y_0, y_1), np.maximum(x_0, x_1), np.maximum(y_0, y_1)
+
+
+def raster2vector(arr: np.ndarray, transform: Affine, crs, value_column: str = 'pop_grid_pop',
+                  skip_nodata: bool = True) -> GeoDataFrame:
+    """
+    Convert the first band of a raster (height X width X bands) to one polygon per pixel.
+
+    Parameters:
+    - arr, transform, crs: raster as returned by read_tif (NoData values set to NaN)
+    - value_column: name of the column holding the pixel values
+    - skip_nodata: drop NaN pixels (default), otherwise all pixels are converted
+
+    Returns:
+    - GeoDataFrame indexed by the flat pixel index (row * width + col), pixels in row-major order
+    """
+    assert transform.is_rectilinear, 'Rotated rasters are not supported.'
+    height, width = arr.shape[:2]
+    values = arr[:, :, 0] if arr.ndim == 3 else arr
+
+    # Flat indices of the pixels to convert
+    pixel_index = np.arange(height * width)
+    if skip_nodata:
+        pixel_index = pixel_index[~np.isnan(values.ravel())]
+    rows, cols = np.divmod(pixel_index, width)
+
+    geometries = shapely.box(*pixel_bounds(transform, rows, cols))
+    return gpd.GeoDataFrame({value_column: values.ravel()[pixel_index]}, geometry=geometries, crs=crs,
+                            index=pd.Index(pixel_index, name='pixel_index'))
@@ -0,0 +1,274 @@
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+import argparse
+
+import geopandas as gpd
+from geopandas import GeoDataFrame, GeoSeries
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+import shapely
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+# Speeds (km/h) by OSM highway tag, following the car and foot defaults of openrouteservice (GraphHopper).
+# Highways missing from a profile are not routable with it.
+SPEED_PROFILES = {
+    'driving-car': {
+        'motorway': 100, 'motorway_link': 70, 'trunk': 70, 'trunk_link': 65, 'primary': 65, 'primary_link': 60,
+        'secondary': 60, 'secondary_link': 50, 'tertiary': 50, 'tertiary_link': 40, 'unclassified': 30,
+        'residential': 30, 'living_street': 5, 'service': 20, 'road': 20, 'track': 15,
+    },
+    'foot-walking': {
+        'trunk': 5, 'trunk_link': 5, 'primary': 5, 'primary_link': 5, 'secondary': 5, 'secondary_link': 5,
+        'tertiary': 5, 'tertiary_link': 5, 'unclassified': 5, 'residential': 5, 'living_street': 5, 'service': 5,
+        'road': 5, 'track': 5, 'pedestrian': 5, 'footway': 5, 'path': 5, 'steps': 5, 'cycleway': 5,
+        'bridleway': 5, 'corridor': 5,
+    },
+}
+
+# Locations further away from the network are not routed (openrouteservice default search radius)
+MAX_SNAP_DISTANCE = 350
+# Vertices closer than this (m) are merged into one network node
+NODE_TOLERANCE = 0.01
+# Lines are densified to vertices at most this far apart (m), so that locations beside long straight segments
+# snap to a node close to the road and not only to the far away ends of the segment
+SEGMENT_LENGTH = 50
+
+
+def argument_parser():
+    # https://docs.python.org/3/library/argparse.html#the-add-argument-method
+    parser = argparse.ArgumentParser(description="Travel times to the nearest facilities on a local road network")
+    parser.add_argument('-r', '--road-file', dest='road_file', required=True,
+                        help="GeoParquet road network with a highway column (e.g. from osm_roads_download.py)")
+    parser.add_argument('-g', '--grid-file', dest='grid_file', required=True, help="grid cells (origins)")
+    parser.add_argument('-f', '--facility-file', dest='facility_file', required=True, help="healthcare facilities")
+    parser.add_argument('-o', '--output-file', dest='output_file', required=True, help="OD matrix csv file")
+    parser.add_argument('-p', '--profile', dest='profile', default='driving-car', choices=list(SPEED_PROFILES))
+    parser.add_argument('-k', dest='k', default=3, type=int, help="number of nearest facilities per category")
+    parser.add_argument('-c', '--category-column', dest='category_column', default=None,
+                        help="facility column with the categories (default treats all facilities as one category)")
+    parser.add_argument('--grid-id-column', dest='grid_id_column', default='rowid')
+    parser.add_argument('--facility-id-column', dest='facility_id_column', default='hcf_id')
+    parser.add_argument('--max-duration', dest='max_duration', default=None, type=float,
+                        help="travel time limit (s), facilities further away are not reported")
+    parser.add_argument('--grid-origin', dest='grid_origin', action='store_true',
+                        help="report grid cells as origin_id and facilities as destination_id")
+    return parser
+
+
+def highway_class(highway: pd.Series) -> pd.Series:
+    # osmnx stores merged edges as stringified lists, e.g. "['residential', 'service']", the first value is used
+    return highway.astype(str).str.extract(r'([a-z_]+)', expand=False)
+
+
+class RoadNetwork:
+    """
+    Undirected road network in CSR format, with travel times (s) and lengths (m) as edge weights.
+
+    Parameters:
+    - roads: road lines with a highway column
+    - profile: name of a speed profile in SPEED_PROFILES
+    - speeds: speeds (km/h) by highway tag, overrides the profile
+    - crs: projected CRS used for lengths (default UTM zone of the roads)
+    - segment_length: maximum distance (m) between the vertices of the lines, see SEGMENT_LENGTH (None: the
+      vertices of the road lines)
+    """
+
+    def __init__(self, roads: GeoDataFrame, profile: str = 'driving-car', speeds: Optional[Dict[str, float]] = None,
+                 crs=None, segment_length: Optional[float] = SEGMENT_LENGTH):
+        speeds = speeds if speeds is not None else SPEED_PROFILES[profile]
+        self.crs = crs if crs is not None else roads.estimate_utm_crs()
+
+        # Routable lines and their speeds (m/s)
+        roads = roads.assign(speed=highway_class(roads['highway']).map(speeds)).dropna(subset=['speed'])
+        roads = roads.to_crs(self.crs).explode(index_parts=False)
+        roads = roads[roads.geometry.geom_type == 'LineString']
+        lines = roads.geometry.values
+        if segment_length is not None:
+            lines = shapely.segmentize(lines, segment_length)
+        coords, line_index = shapely.get_coordinates(lines, return_index=True)
+
+        # Vertices shared by lines become the same node
+        keys = np.round(coords / NODE_TOLERANCE).astype(np.int64)
+        _, first, node = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        node = node.ravel()
+        self.nodes = coords[first]
+
+        # Consecutive vertices of the same line form the edges
+        same_line = line_index[:-1] == line_index[1:]
+        u, v = node[:-1][same_line], node[1:][same_line]
+        length = np.hypot(*(coords[1:][same_line] - coords[:-1][same_line]).T)
+        duration = length / (roads['speed'].to_numpy()[line_index[:-1][same_line]] / 3.6)
+        keep = u != v
+        u, v, length, duration = u[keep], v[keep], length[keep], duration[keep]
+
+        # Both directions, keeping the fastest of parallel edges
+        u, v = np.concatenate([u, v]), np.concatenate([v, u])
+        length, duration = np.concatenate([length, length]), np.concatenate([duration, duration])
+        order = np.lexsort((duration, v, u))
+        u, v, length, duration = u[order], v[order], length[order], duration[order]
+        first_edge = np.ones(len(u), dtype=bool)
+        first_edge[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+        u, v, length, duration = u[first_edge], v[first_edge], length[first_edge], duration[first_edge]
+
+        n = len(self.nodes)
+        self.graph = csr_matrix((duration, (u, v)), shape=(n, n))
+        # Edge lengths, looked up by the sorted key u * n + v
+        self.edge_keys = u * n + v
+        self.edge_lengths = length
+        self.tree = cKDTree(self.nodes)
+
+    @classmethod
+    def from_parquet(cls, file: Union[str, Path], profile: str = 'driving-car',
+                     speeds: Optional[Dict[str, float]] = None, crs=None,
+                     segment_length: Optional[float] = SEGMENT_LENGTH) -> 'RoadNetwork':
+        return cls(gpd.read_parquet(file, columns=['highway', 'geometry']), profile, speeds, crs, segment_length)
+
+    def snap(self, points: GeoSeries, max_distance: float = MAX_SNAP_DISTANCE) -> np.ndarray:
+        """
+        Nearest network node of each point, -1 for points further than max_distance from the network. With the
+        densified lines, the nearest node is at most segment_length / 2 further away than the nearest road.
+        """
+        points = points.to_crs(self.crs)
+        distance, node = self.tree.query(shapely.get_coordinates(points.values))
+        return np.where(distance <= max_distance, node, -1)
+
+    def tree_distances(self, predecessors: np.ndarray) -> np.ndarray:
+        """
+        Length (m) of the shortest (fastest) path from the root of each shortest path tree to all nodes.
+
+        The lengths are accumulated along the predecessors by pointer jumping, i.e. in log(depth) vectorized
+        steps instead of walking the paths. predecessors has one tree per row (as returned by dijkstra).
+        """
+        predecessors = np.atleast_2d(predecessors)
+        n_trees, n = predecessors.shape
+        offsets = (np.arange(n_trees) * n)[:, None]
+        has_pred = predecessors >= 0
+
+        # Length of the edge to the predecessor, roots and unreached nodes point to themselves
+        step = np.zeros(predecessors.shape)
+        nodes = np.broadcast_to(np.arange(n), predecessors.shape)
+        step[has_pred] = self.edge_lengths[np.searchsorted(self.edge_keys,
+                                                           predecessors[has_pred] * n + nodes[has_pred])]
+        ancestor = (np.where(has_pred, predecessors, nodes) + offsets).ravel()
+        distance = step.ravel()
+
+        while True:
+            next_ancestor = ancestor[ancestor]
+            if np.array_equal(next_ancestor, ancestor):
+                break
+            distance = distance + distance[ancestor]
+            ancestor = next_ancestor
+        return distance.reshape(predecessors.shape)
+
+    def nearest(self, origin_nodes: np.ndarray, facility_nodes: np.ndarray, k: int = 1,
+                max_duration: Optional[float] = None,
+                chunk_size: int = 8) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Travel times and distances from the k nearest facilities to each origin.
+
+        Parameters:
+        - origin_nodes, facility_nodes: network nodes (see snap), -1 for locations that cannot be routed
+        - k: number of facilities per origin
+        - max_duration: travel time limit (s), limits the search of each tree
+        - chunk_size: number of facility trees computed at once (k > 1)
+
+        Returns:
+        - durations (s), distances (m) and facility positions (origins X k), sorted by duration; NaN/-1 where
+          fewer than k facilities can be reached
+        """
+        n_origins = len(origin_nodes)
+        durations = np.full((n_origins, k), np.inf)
+        distances = np.full((n_origins, k), np.nan)
+        facilities = np.full((n_origins, k), -1)
+        routable = np.flatnonzero(facility_nodes >= 0)
+        origin_routable = origin_nodes >= 0
+        limit = max_duration if max_duration is not None else np.inf
+
+        if len(routable) == 0:
+            return np.full((n_origins, k), np.nan), distances, facilities
+
+        if k == 1:
+            # One multi-source tree from all facilities at once
+            duration, predecessors, sources = dijkstra(self.graph, indices=facility_nodes[routable], limit=limit,
+                                                       min_only=True, return_predecessors=True)
+            distance = self.tree_distances(predecessors)[0]
+            facility_of_node = pd.Series(routable, index=facility_nodes[routable]).groupby(level=0).first()
+            nodes = origin_nodes[origin_routable]
+            reached = sources[nodes] >= 0
+            durations[origin_routable, 0] = np.where(reached, duration[nodes], np.inf)
+            distances[origin_routable, 0] = np.where(reached, distance[nodes], np.nan)
+            facilities[origin_routable, 0] = np.where(
+                reached, facility_of_node.reindex(sources[nodes]).fillna(-1).to_numpy(dtype=np.int64), -1)
+        else:
+            # Trees of a few facilities at a time, merged into a running top k per origin
+            nodes = origin_nodes[origin_routable]
+            for start in range(0, len(routable), chunk_size):
+                chunk = routable[start:start + chunk_size]
+                duration, predecessors = dijkstra(self.graph, indices=facility_nodes[chunk], limit=limit,
+                                                  return_predecessors=True)
+                distance = self.tree_distances(predecessors)
+
+                candidate_durations = np.hstack([durations[origin_routable], duration[:, nodes].T])
+                candidate_distances = np.hstack([distances[origin_routable], distance[:, nodes].T])
+                candidate_facilities = np.hstack([facilities[origin_routable],
+                                                  np.broadcast_to(chunk, (len(nodes), len(chunk)))])
+                best = np.argpartition(candidate_durations, k - 1, axis=1)[:, :k]
+                durations[origin_routable] = np.take_along_axis(candidate_durations, best, axis=1)
+                distances[origin_routable] = np.take_along_axis(candidate_distances, best, axis=1)
+                facilities[origin_routable] = np.take_along_axis(candidate_facilities, best, axis=1)
+
+            order = np.argsort(durations, axis=1, kind='stable')
+            durations = np.take_along_axis(durations, order, axis=1)
+            distances = np.take_along_axis(distances, order, axis=1)
+            facilities = np.take_along_axis(facilities, order, axis=1)
+
+        unreached = ~np.isfinite(durations)
+        durations[unreached], distances[unreached], facilities[unreached] = np.nan, np.nan, -1
+        return durations, distances, facilities
+
+
+def nearest_facilities(network: RoadNetwork, grid: GeoDataFrame, facilities: GeoDataFrame, grid_id_column: str,
+                       facility_id_column: str, category_column: Optional[str] = None, k: int = 3,
+                       max_duration: Optional[float] = None, grid_origin: bool = False) -> DataFrame:
+    """
+    OD matrix of the k nearest facilities of each category for every grid cell centroid.
+
+    Returns:
+    - DataFrame with the columns of the OD matrix csv files (origin_id, destination_id, duration_seconds,
+      distance_km); by default facilities are the origins and grid cells the destinations
+    """
+    origin_nodes = network.snap(grid.geometry.to_crs(network.crs).centroid)
+    facility_nodes = network.snap(facilities.geometry)
+    categories = facilities[category_column] if category_column is not None else pd.Series(0, facilities.index)
+
+    tables = []
+    for _, positions in categories.groupby(categories, sort=False).indices.items():
+        durations, distances, nearest = network.nearest(origin_nodes, facility_nodes[positions], k, max_duration)
+        found = nearest >= 0
+        grid_position = np.nonzero(found)[0]
+        facility_position = positions[nearest[found]]
+        grid_ids = grid[grid_id_column].to_numpy()[grid_position]
+        facility_ids = facilities[facility_id_column].to_numpy()[facility_position]
+        tables.append(DataFrame({
+            'origin_id': grid_ids if grid_origin else facility_ids,
+            'destination_id': facility_ids if grid_origin else grid_ids,
+            'duration_seconds': durations[found],
+            'distance_km': distances[found] / 1000,
+        }))
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_known_args()[0]
+
+    network = RoadNetwork.from_parquet(args.road_file, args.profile)
+    grid = gpd.read_file(args.grid_file)
+    facilities = gpd.read_file(args.facility_file).dropna(subset=['geometry'])
+
+    od_matrix = nearest_facilities(network, grid, facilities, args.grid_id_column, args.facility_id_column,
+                                   args.category_column, args.k, args.max_duration, args.grid_origin)
+    od_matrix.to_csv(args.output_file, index=False)
+    print(f'{len(od_matrix)} origin-destination pairs written to {args.output_file}.')
@@ -0,0 +1,44 @@
+from typing import Sequence, Tuple
+
+import numpy as np
+from pandas import DataFrame
+
+
+def k_smallest(df: DataFrame, group_columns: Sequence[str], value_column: str, k: int = 3) -> DataFrame:
+    """
+    Rows with the k smallest values of each group (e.g. the k closest facilities of each category per grid cell).
+
+    All groups are selected at once: the table is sorted once by group and value, and the first k rows of each
+    group are kept. As with DataFrame.nsmallest, missing values come last and ties keep the first row.
+    """
+    # Group codes, in order of the group columns
+    codes = df.groupby(list(group_columns), sort=True, dropna=False).ngroup().to_numpy()
+    order = np.lexsort((df[value_column].to_numpy(), codes))
+    sorted_codes = codes[order]
+
+    # Rank of each row within its group
+    group_start = np.ones(len(order), dtype=bool)
+    group_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    start_position = np.maximum.accumulate(np.where(group_start, np.arange(len(order)), 0))
+    rank = np.arange(len(order)) - start_position
+    return df.iloc[order[rank < k]].reset_index(drop=True)
+
+
+def k_smallest_columns(matrix: np.ndarray, k: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Columns with the k smallest values of each row of a dense (origins X facilities) matrix, using argpartition.
+
+    Returns:
+    - column positions and values (rows X k), sorted by value; -1/NaN where a row has fewer than k values
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    # Rows are padded with missing values when there are fewer than k columns
+    if matrix.shape[1] < k:
+        matrix = np.hstack([matrix, np.full((len(matrix), k - matrix.shape[1]), np.nan)])
+    matrix = np.where(np.isnan(matrix), np.inf, matrix)
+    columns = np.argpartition(matrix, k - 1, axis=1)[:, :k]
+    values = np.take_along_axis(matrix, columns, axis=1)
+    order = np.argsort(values, axis=1, kind='stable')
+    columns, values = np.take_along_axis(columns, order, axis=1), np.take_along_axis(values, order, axis=1)
+    missing = np.isinf(values)
+    return np.where(missing, -1, columns), np.where(missing, np.nan, values)
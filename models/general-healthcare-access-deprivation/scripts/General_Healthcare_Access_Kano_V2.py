@@ -63,7 +63,6 @@ import os
 import numpy as np
 import pandas as pd
 
-import openrouteservice
 from dotenv import load_dotenv
 import folium
 from folium.plugins import MarkerCluster
@@ -75,13 +74,21 @@ import ast
 from pathlib import Path
 from shapely.geometry import Polygon
 from shapely.geometry import shape, mapping
-from shapely.geometry import Point
 
 import requests
 from math import *
 from sklearn.preprocessing import MinMaxScaler
 import seaborn as sns
 import time
+import shapely
+
+import sys
+sys.path.append('../../../utils')
+from ideamaps.coverage import CoverageIndex, count_overlaps
+from ideamaps.grid import load_reference_grid
+from ideamaps.isochrones import IsochroneCache, IsochroneClient, ORS_API_URL, attach_locations
+from ideamaps.rules import evaluate_rules
+from ideamaps.storage import IntermediateStore
 
 # %% [markdown]
 # ### Setting up the public API Key from OpenRouteService
@@ -104,7 +111,6 @@ import time
 %load_ext dotenv
 %dotenv
 api_key = os.getenv('OPENROUTESERVICE_API_KEY')
-ors = openrouteservice.Client(key=api_key)
 
 # %% [markdown]
 # ### Setting up relevant processing folders
@@ -124,6 +130,8 @@ ors = openrouteservice.Client(key=api_key)
 # Define directories
 data_inputs = '../scripts/Kano/data-inputs/'
 data_temp = '../scripts/Kano/data-temp/'
+# Intermediate layers are stored as GeoParquet in data-temp, the final outputs as GeoPackage
+temp_store = IntermediateStore(data_temp)
 model_outputs = '../Kano-v2/'
 
 # %% [markdown]
@@ -133,13 +141,11 @@ model_outputs = '../Kano-v2/'
 # ### 1.1 Study area and Administrative level 2
 
 # %%
-study_area = gpd.read_file(data_inputs + 'grid-boundary-kano.gpkg')
+# Reference grid of the study area with stable grid ids, centroids and bounds (built once, see ideamaps.grid)
+reference_grid = load_reference_grid(data_inputs + 'grid-boundary-kano.gpkg')
+study_area = reference_grid.cells
 districts = gpd.read_file(data_inputs + 'administrative_level2.geojson')
 
-# %%
-# Adding a grid_id to the gridcells in the study area
-study_area['grid_id'] = range(len(study_area))
-
 # %% [markdown]
 # ### 1.2 General Healthcare Facilities
 # 
@@ -247,187 +253,48 @@ print(facilities['Local Validation'].unique())
 # ### 1. Calculating the isochrones for 3.3km driving
 
 # %%
-all_features = []
-
-# Initialize request counter
-request_counter = 0
-
-# Create a dictionary to store isochrones by category
-isochrones_by_category = {
-    "Primary": [],
-    "Secondary/Tertiary": []
-}
-
-# Loop through each category
-for category in isochrones_by_category.keys():
-    # Filter facilities by category
-    group = facilities[facilities["Local Validation"] == category]
-
-    for _, row in group.iterrows():
-        loc = row["geometry"]
-        facility_id = row["hcf_id"]
-        facility_name = row["facility_name"]
-
-        # Make sure geometry is a Point and get [lon, lat]
-        if isinstance(loc, Point):
-            coordinates = [loc.x, loc.y]
-        else:
-            print(f"Invalid geometry for: {row.get('facility_name', 'Unknown')} — Skipping")
-            continue
-
-        try:
-            # Prepare request parameters
-            iso_params = {
-                "locations": [coordinates],
-                "profile": "driving-car",
-                "range_type": "distance",
-                "range": [3300],  # 3.3km
-
-                # "range": [600],  # 10 minutes
-                # "attributes": ["area"]
-            }
-
-            # Request isochrone from ORS
-            isochrone = ors.isochrones(**iso_params)
-
-            for feature in isochrone['features']:
-                properties = feature['properties']
-
-                # Convert list fields to strings if needed
-                for key, value in properties.items():
-                    if isinstance(value, list):
-                        properties[key] = ', '.join(map(str, value))
-
-                # Add a new column for the category
-                properties["Local Validation"] = category
-                properties["facility_id"] = facility_id
-                properties["facility_name"] = facility_name
-
-                all_features.append({
-                    'geometry': feature['geometry'],
-                    'properties': properties
-                })
-
-            # Handle rate limiting
-            request_counter += 1
-            if request_counter % 35 == 0:
-                print("Pausing for 60 seconds to respect API rate limits...")
-                # Use this sleep when using the OSR instance hosted by HeiGIT
-                # # time.sleep(60)
-            if request_counter > 2500:
-                print("Reached max request threshold.")
-                break
-
-        except Exception as e:
-            print(f"Request failed for {row.get('facility_name', 'Unknown')}: {e}")
+# Facilities of the categories with a Point geometry, as [lon, lat] locations
+iso_facilities = facilities[
+    facilities["Local Validation"].isin(["Primary", "Secondary/Tertiary"])
+    & (facilities.geometry.geom_type == "Point")
+].reset_index(drop=True)
+locations = shapely.get_coordinates(iso_facilities.geometry.values)
+
+# Isochrones are requested for up to 5 facilities at a time, with concurrent requests limited to the
+# 20 requests per minute of the public API (use requests_per_minute=None for a local ORS instance).
+# Isochrones are cached in data-temp, so that reruns only request new facilities or ranges.
+iso_client = IsochroneClient(ORS_API_URL, api_key, max_locations=5, requests_per_minute=20, workers=4,
+                             cache=IsochroneCache(data_temp + 'isochrone-cache.sqlite'))
+
+# Both layers use the same profile and range type, so the 3.3km and 1km ranges are requested in a single
+# call per batch of facilities and split into one GeoDataFrame per layer
+iso_car, iso_walking = iso_client.compute_specs(locations, [
+    ("driving-car", "distance", [3300]),  # 3.3km
+    ("driving-car", "distance", [1000], ["area"]),  # 1km
+])
+print(f"{len(iso_car)} + {len(iso_walking)} isochrones, {len(iso_client.failed)} failed requests")
 
 # %%
-# Convert to GeoDataFrame if there are valid features
-if all_features:
-    iso_gdf = gpd.GeoDataFrame.from_features(all_features, crs="EPSG:4326")
+# Category, id and name of the facilities attached to their isochrones
+facility_columns = {"Local Validation": "Local Validation", "facility_id": "hcf_id", "facility_name": "facility_name"}
 
-    # Ensure 'Local Validation' is a string column
-    iso_gdf["Local Validation"] = iso_gdf["Local Validation"].astype(str)
-    iso_gdf["facility_id"] = iso_gdf["facility_id"].astype(str)
-    iso_gdf["facility_name"] = iso_gdf["facility_name"].astype(str)
+# Attach the category, id and name of the facilities to their isochrones (list fields as strings)
+iso_gdf = attach_locations(iso_car, iso_facilities, facility_columns)
 
-    # Save to a single GeoPackage file
-    iso_gdf.to_file(data_temp + 'General_healthcare_iso_3_3km_car.gpkg', driver="GPKG")
-    
+# Save to the temporary folder
+if len(iso_gdf) > 0:
+    temp_store.write(iso_gdf, 'General_healthcare_iso_3_3km_car')
 
 # %% [markdown]
 # ### 2. Calculating the isochrones for 1km walking
 
 # %%
-all_features = []
-
-# Initialize request counter
-request_counter = 0
-
-# Create a dictionary to store isochrones by category
-isochrones_by_category = {
-    "Primary": [],
-    "Secondary/Tertiary": []
-}
-
-# Loop through each category
-for category in isochrones_by_category.keys():
-    # Filter facilities by category
-    group = facilities[facilities["Local Validation"] == category]
-
-    for _, row in group.iterrows():
-        loc = row["geometry"]
-        facility_id = row["hcf_id"]
-        facility_name = row["facility_name"]
-
-        # Make sure geometry is a Point and get [lon, lat]
-        if isinstance(loc, Point):
-            coordinates = [loc.x, loc.y]
-        else:
-            print(f"Invalid geometry for: {row.get('facility_name', 'Unknown')} — Skipping")
-            continue
-
-        try:
-            # Prepare request parameters
-            iso_params = {
-                "locations": [coordinates],
-                "profile": "driving-car",
-
-                "range_type": "distance",
-                "range": [1000],  # 1km
-
-               # "range_type": "time",
-               # "range": [900],  # 15 minutes
-
-                "attributes": ["area"]
-            }
-
-            # Request isochrone from ORS
-            isochrone = ors.isochrones(**iso_params)
-
-            for feature in isochrone['features']:
-                properties = feature['properties']
-
-                # Convert list fields to strings if needed
-                for key, value in properties.items():
-                    if isinstance(value, list):
-                        properties[key] = ', '.join(map(str, value))
-
-                # Add a new column for the category
-                properties["Local Validation"] = category
-                properties["facility_id"] = facility_id
-                properties["facility_name"] = facility_name
-
-                all_features.append({
-                    'geometry': feature['geometry'],
-                    'properties': properties
-                })
-
-            # Handle rate limiting
-            request_counter += 1
-            if request_counter % 35 == 0:
-                print("Pausing for 60 seconds to respect API rate limits...")
-                # time.sleep(60)
-            if request_counter > 2500:
-                print("Reached max request threshold.")
-                break
-
-        except Exception as e:
-            print(f"Request failed for {row.get('facility_name', 'Unknown')}: {e}")
-
+# Attach the category, id and name of the facilities to their isochrones (list fields as strings)
+iso_gdf = attach_locations(iso_walking, iso_facilities, facility_columns)
 
-# %%
-# Convert to GeoDataFrame if there are valid features
-if all_features:
-    iso_gdf = gpd.GeoDataFrame.from_features(all_features, crs="EPSG:4326")
-
-    # Ensure 'combination' is a string column
-    iso_gdf["Local Validation"] = iso_gdf["Local Validation"].astype(str)
-    iso_gdf["facility_id"] = iso_gdf["facility_id"].astype(str)
-    iso_gdf["facility_name"] = iso_gdf["facility_name"].astype(str)
-
-    # Save to a single GeoPackage file
-    iso_gdf.to_file(data_temp + 'General_healthcare_iso_1km_walking.gpkg', driver="GPKG")
+# Save to the temporary folder
+if len(iso_gdf) > 0:
+    temp_store.write(iso_gdf, 'General_healthcare_iso_1km_walking')
 
 # %% [markdown]
 # ## Spatial joins for the grid and isochrone layers using geopandas
@@ -436,8 +303,8 @@ if all_features:
 # %%
 # Read grid cells and isochrones from the GeoPackage file
 # Ensure both GeoDataFrames have the same CRS (EPSG:4326)
-isochrones_foot_gdf = gpd.read_file(data_temp + 'General_healthcare_iso_1km_walking.gpkg')
-isochrones_car_gdf = gpd.read_file(data_temp + 'General_healthcare_iso_3_3km_car.gpkg')
+isochrones_foot_gdf = temp_store.read('General_healthcare_iso_1km_walking')
+isochrones_car_gdf = temp_store.read('General_healthcare_iso_3_3km_car')
 
 # %% [markdown]
 # ### Spatial joins for the grid and isochrone layers using geopandas
@@ -458,30 +325,21 @@ isochrones_car_gdf = isochrones_car_gdf.to_crs(target_crs)
 study_area = study_area.to_crs(target_crs)
 
 # %% [markdown]
-# Spatial join to count the number of isochrones for 1km walking distance falling in each grid cell
+# Count the number of isochrones for 1km walking distance falling in each grid cell. Instead of a spatial join of all isochrones with all grid cells, the isochrones are burnt into a raster aligned with the 100 m reference grid (ESRI:54009) that adds up the isochrones touching each cell. Use `count_overlaps(..., exact=True)` to count the cells on the edge of the isochrones with the exact intersects predicate.
 # 
 
 # %%
-joined = gpd.sjoin(isochrones_foot_gdf, study_area, how="inner", predicate="intersects")
-
-isochrone_count = joined.groupby("grid_id").size().reset_index(name='iso_walk_1k_count')
-
-study_area["iso_walk_1k_count"] = 0
-study_area.loc[isochrone_count["grid_id"], "iso_walk_1k_count"] = isochrone_count["iso_walk_1k_count"].values
+grid_lattice = reference_grid.lattice()
+study_area["iso_walk_1k_count"] = count_overlaps(isochrones_foot_gdf, grid_lattice)
 
 study_area
 
 
 # %% [markdown]
-# Spatial join to count the number of isochrones for 3.3km driving distance falling in each grid cell. Values are appended to the previously created grid cells.
+# Count the number of isochrones for 3.3km driving distance falling in each grid cell. Values are appended to the previously created grid cells.
 
 # %%
-joined = gpd.sjoin(isochrones_car_gdf, study_area, how="inner", predicate="intersects")
-
-isochrone_count = joined.groupby("grid_id").size().reset_index(name='iso_3_3km_count')
-
-study_area["iso_3_3km_count"] = 0
-study_area.loc[isochrone_count["grid_id"], "iso_3_3km_count"] = isochrone_count["iso_3_3km_count"].values
+study_area["iso_3_3km_count"] = count_overlaps(isochrones_car_gdf, grid_lattice)
 
 study_area
 
@@ -490,23 +348,23 @@ study_area
 # Save the updated grid cells if needed
 
  # Save to a single GeoPackage file
-study_area.to_file(data_temp + 'grid_count_iso_1km_3_3km.gpkg', driver="GPKG")
+temp_store.write(study_area, 'grid_count_iso_1km_3_3km')
 
 # %% [markdown]
 # ### Define the categories for healtcare access deprivation based on the critera.
 
 # %%
 # If needed, read the gridcells and isochrones from the GeoPackage file
-study_area = gpd.read_file(data_temp + 'grid_count_iso_1km_3_3km.gpkg')
+study_area = temp_store.read('grid_count_iso_1km_3_3km')
 study_area
 
 # %%
-study_area["result"] = study_area.apply(
-    lambda row: 2 if row["iso_walk_1k_count"] <= 1
-    else 1 if (row["iso_walk_1k_count"] < 4) or (row["iso_3_3km_count"] < 15)
-    else 0,
-    axis=1
-)
+# Ordered rules, the first matching rule sets the class: high (2), medium (1), otherwise low (0) deprivation
+result_rules = [
+    {"value": 2, "where": {"iso_walk_1k_count": {"le": 1}}},
+    {"value": 1, "where": [{"iso_walk_1k_count": {"lt": 4}}, {"iso_3_3km_count": {"lt": 15}}]},
+]
+study_area["result"] = evaluate_rules(study_area, result_rules, default=0)
 
 study_area
 
@@ -514,11 +372,10 @@ study_area
 # Define the focus areas
 
 # %%
-study_area["focused"] = study_area.apply(
-    lambda row: 1 if (1 <= row["iso_walk_1k_count"] <= 2) # and (row["iso_3_3km_count"] < 10)
-    else 0,
-    axis=1
-)
+focus_rules = [
+    {"value": 1, "where": {"iso_walk_1k_count": {"between": [1, 2]}}},  # "iso_3_3km_count": {"lt": 10}
+]
+study_area["focused"] = evaluate_rules(study_area, focus_rules, default=0)
 
 # %%
 # Save output as a GeoPackage file
@@ -539,23 +396,17 @@ sns.scatterplot(data=study_area, x='iso_walk_1k_count', y='iso_3_3km_count', hue
 
 # %%
 # 2. Calculate the number of hospitals reachable within a 15-minute walk
-foot_joined = gpd.sjoin(study_area, isochrones_foot_gdf, how="left", predicate="intersects")
-foot_counts = foot_joined.groupby(foot_joined.index)["hcf_id"].nunique()
-study_area["facilities_15min_walk"] = study_area.index.map(foot_counts).fillna(0).astype(int)
+# The coverage index stores the facilities covering each grid cell as a bitset, which also gives counts per
+# category and set queries without joining again, e.g. walk_coverage.covered(primary_ids, min_count=2)
+walk_coverage = CoverageIndex.from_isochrones(isochrones_foot_gdf, "facility_id", grid_lattice)
+study_area["facilities_15min_walk"] = walk_coverage.count()
 
 # %%
 # 3. Classify Access Deprivation Level
-def classify_deprivation(drive, walk):
-    if drive >= 5:
-        return "0" # low deprivation
-    elif walk <= 1:
-        return "2" # high deprivation
-    else:
-        return "1" # medium deprivation
-
-study_area["result"] = study_area.apply(
-    lambda row: classify_deprivation(row["facilities_10min_drive"], row["facilities_15min_walk"]),
-    axis=1
-)
+deprivation_rules = [
+    {"value": "0", "where": {"facilities_10min_drive": {"ge": 5}}},  # low deprivation
+    {"value": "2", "where": {"facilities_15min_walk": {"le": 1}}},  # high deprivation
+]
+study_area["result"] = evaluate_rules(study_area, deprivation_rules, default="1")  # medium deprivation
 
 
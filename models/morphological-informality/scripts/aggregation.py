@@ -1,12 +1,12 @@
 import geopandas as gpd
-from geopandas import GeoDataFrame
 import pandas as pd
 import numpy as np
 from scipy.stats import entropy, gaussian_kde
-import utm
 from pathlib import Path
 import argparse
 from tqdm import tqdm
+from geo_io import read_geo, read_table
+from projection import load_utm_epsg
 
 
 def argument_parser():
@@ -15,6 +15,8 @@ def argument_parser():
     parser.add_argument('-m', "--morphometrics-dir", dest='morphometrics_dir', required=True)
     parser.add_argument('-b', "--building-file", dest='building_file', required=True)
     parser.add_argument('-g', "--grid-file", dest='grid_file', required=True)
+    parser.add_argument('-r', "--road-morphometrics-dir", dest='road_morphometrics_dir', required=False, default=None,
+                        help="dir containing strOri.parquet (defaults to the morphometrics dir)")
     parser.add_argument('-o', "--output-dir", dest='output_dir', default='outputs/', required=False,
                         help="path to output directory")
 
@@ -26,21 +28,6 @@ def argument_parser():
     )
     return parser
 
-def get_utm_epsg(gdf: GeoDataFrame) -> int:
-    gdf = gdf.to_crs(4326)
-
-    # Calculate the centroid of the bounding box
-    bounds = gdf.total_bounds
-    min_lng, min_lat, max_lng, max_lat = bounds
-    lng, lat = (min_lng + max_lng) / 2, (min_lat + max_lat) / 2
-
-    # Convert to UTM and create EPSG code
-    utm_coords = utm.from_latlon(lat, lng)
-    zone_number, zone_letter = utm_coords[2], utm_coords[3]
-    epsg_code = 32600 + zone_number if zone_letter >= 'N' else 32700 + zone_number
-
-    return epsg_code
-
 def compute_entropy(series, areas=None):
     if areas is not None:
         relevant_buildings = areas >= 50
@@ -98,27 +85,24 @@ if __name__ == '__main__':
     args = argument_parser().parse_known_args()[0]
     assert Path(args.output_dir).exists()
 
-    building_file = Path(args.building_file)
-    bmm = gpd.read_parquet(building_file) if building_file.suffix == '.parquet' else gpd.read_file(building_file)
-    bmm = bmm[['uID', 'geometry']]
+    bmm = read_geo(args.building_file, columns=['uID', 'geometry'])
 
     # Loading Urban Morphometrics (UMM)
-    building_metrics = ['sdbAre', 'stbOri', 'mtbAli', 'mtbNDi_log', 'sicCAR', 'mtcWNe', 'mdcAre', 'stcOri', 'strAli']
+    building_metrics = ['sdbAre', 'stbOri', 'mtbAli', 'mtbNDi_log', 'sicCAR', 'mtcWNe', 'sdcAre', 'stcOri', 'strAli']
 
     for metric in building_metrics:
-        metric_values = pd.read_parquet(Path(args.morphometrics_dir) / f'{metric}.parquet')
+        metric_values = read_table(Path(args.morphometrics_dir) / f'{metric}.parquet', columns=['uID', metric])
         bmm = pd.merge(bmm, metric_values, on='uID', how='inner')
     bmm = gpd.GeoDataFrame(bmm, geometry='geometry')
 
     # Loading grid
-    grid_file = Path(args.grid_file)
-    grid = gpd.read_parquet(grid_file) if grid_file.suffix == '.parquet' else gpd.read_file(grid_file)
+    grid = read_geo(args.grid_file, columns=['geometry'])
     grid = grid[['geometry']]
     grid['grid_id'] = range(1, len(grid) + 1)  # create column containing an unique raw numbering for each grid
 
     # Reprojecting buildings and grid to local UTM zone
     grid_crs = grid.crs
-    utm_epsg = get_utm_epsg(grid)
+    utm_epsg = load_utm_epsg(args.output_dir, grid)
     grid, bmm = grid.to_crs(utm_epsg), bmm.to_crs(utm_epsg)
 
     # Perform spatial join based on building centroids and drop grid cells with no buildings
@@ -138,7 +122,7 @@ if __name__ == '__main__':
     # Group by 'grid_id' and calculate median and std
     median_values = grouped_bmm_grid[median].median().add_prefix('md_')
 
-    variation_measures = ['kdes']
+    variation_measures = ['kdes', 'kdesr']
     variation_dict = {f'{measure}_{metric}': [] for metric in variation for measure in variation_measures}
     variation_dict['grid_id'] = []
     for grid_id, values in tqdm(grouped_bmm_grid):
@@ -177,7 +161,8 @@ if __name__ == '__main__':
     # Roads
     road_metrics = ['strOri']
     var_measures_road = ['kdes']
-    rmm = gpd.read_parquet(Path(args.morphometrics_dir) / 'strOri.parquet')
+    road_morphometrics_dir = args.road_morphometrics_dir if args.road_morphometrics_dir else args.morphometrics_dir
+    rmm = read_geo(Path(road_morphometrics_dir) / 'strOri.parquet', columns=road_metrics)
     rmm = rmm.to_crs(utm_epsg)
     rmm_grid = gpd.sjoin(grid, rmm, how='left', predicate='intersects')
     grouped_rmm_grid = rmm_grid.groupby('grid_id')
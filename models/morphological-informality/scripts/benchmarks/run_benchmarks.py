@@ -0,0 +1,91 @@
+from datetime import datetime, timezone
+from pathlib import Path
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SCRIPTS_DIR))
+
+from pipeline import morphological_informality_stages, run_pipeline
+from benchmarks.synthetic_city import generate_city, write_city
+
+HISTORY_FILE = Path(__file__).resolve().parent / 'history.json'
+
+
+def argument_parser():
+    # https://docs.python.org/3/library/argparse.html#the-add-argument-method
+    parser = argparse.ArgumentParser(description="Benchmark the morphological informality pipeline")
+    parser.add_argument('-n', '--n-buildings', dest='n_buildings', default=[10_000, 100_000, 1_000_000], type=int,
+                        nargs='+', help="city sizes (number of buildings)")
+    parser.add_argument('-i', '--informal-share', dest='informal_share', default=0.4, type=float, required=False)
+    parser.add_argument('-s', '--seed', dest='seed', default=0, type=int, required=False)
+    parser.add_argument('-o', '--output-dir', dest='output_dir', default='outputs/benchmarks/', required=False,
+                        help="path to the dir for the synthetic cities and pipeline outputs")
+    parser.add_argument('--history-file', dest='history_file', default=str(HISTORY_FILE), required=False,
+                        help="JSON file the results are appended to")
+    parser.add_argument('--label', dest='label', default=None, required=False, help="label of the benchmark run")
+    return parser
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPTS_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def benchmark_city(n_buildings: int, informal_share: float, seed: int, out_path: Path) -> dict:
+    # Synthetic inputs are generated once per size and seed
+    start = time.perf_counter()
+    city_path = out_path / f'city_n{n_buildings}_s{seed}'
+    files = write_city(generate_city(n_buildings, informal_share, seed), city_path / 'inputs')
+    generation_seconds = time.perf_counter() - start
+
+    # All stages up to clustering are rerun (--force) to time each of them
+    stages = morphological_informality_stages(files['roi'], files['buildings'], files['roads'], files['grid'],
+                                              city_path / 'outputs')
+    report = run_pipeline(stages, city_path / 'outputs', jobs=1, force=True)
+
+    for entry in report:
+        entry['buildings_per_second'] = round(n_buildings / entry['seconds'], 1) if entry['seconds'] > 0 else None
+
+    return {
+        'n_buildings': n_buildings,
+        'informal_share': informal_share,
+        'seed': seed,
+        'generation_seconds': round(generation_seconds, 3),
+        'total_seconds': round(sum(entry['seconds'] for entry in report), 3),
+        'stages': report,
+    }
+
+
+def append_history(history_file: Path, record: dict):
+    history = json.loads(history_file.read_text()) if history_file.exists() else []
+    history.append(record)
+    history_file.write_text(json.dumps(history, indent=2))
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_known_args()[0]
+    out_path = Path(args.output_dir)
+    out_path.mkdir(parents=True, exist_ok=True)
+
+    record = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'label': args.label,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': [],
+    }
+    for n in args.n_buildings:
+        print(f'Benchmarking synthetic city with {n} buildings.')
+        record['results'].append(benchmark_city(n, args.informal_share, args.seed, out_path))
+
+    append_history(Path(args.history_file), record)
+    print(f'Results appended to {args.history_file}.')
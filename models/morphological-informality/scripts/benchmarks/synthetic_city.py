@@ -0,0 +1,158 @@
+import geopandas as gpd
+from geopandas import GeoDataFrame
+import numpy as np
+import shapely
+from pathlib import Path
+from typing import Dict, Tuple
+
+# Parameters of the planned area (metres)
+PARCEL_SIZE = 20
+PARCELS_PER_BLOCK = 5
+STREET_WIDTH = 12
+
+# Parameters of the informal clusters (metres)
+CLUSTER_SIZE = 400
+CLUSTER_SPACING = 10
+PATHS_PER_CLUSTER = 4
+PATH_STEP = 15
+
+
+def _rectangles(cx: np.ndarray, cy: np.ndarray, width: np.ndarray, depth: np.ndarray,
+                angle: np.ndarray) -> np.ndarray:
+    # Corners of rotated rectangles, computed for all footprints at once
+    dx = np.array([-0.5, 0.5, 0.5, -0.5, -0.5])[None, :] * width[:, None]
+    dy = np.array([-0.5, -0.5, 0.5, 0.5, -0.5])[None, :] * depth[:, None]
+    cos, sin = np.cos(angle)[:, None], np.sin(angle)[:, None]
+    x = cx[:, None] + dx * cos - dy * sin
+    y = cy[:, None] + dx * sin + dy * cos
+    return shapely.polygons(np.stack([x, y], axis=-1))
+
+
+def planned_area(n_buildings: int, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Footprints on a regular parcel layout with a street grid between blocks."""
+    block_pitch = PARCELS_PER_BLOCK * PARCEL_SIZE + STREET_WIDTH
+    n_blocks_side = max(int(np.ceil(np.sqrt(n_buildings / PARCELS_PER_BLOCK ** 2))), 1)
+
+    # Parcel centres ordered by block, the last block is only partially built-up
+    bx, by, px, py = np.meshgrid(np.arange(n_blocks_side), np.arange(n_blocks_side), np.arange(PARCELS_PER_BLOCK),
+                                 np.arange(PARCELS_PER_BLOCK), indexing='ij')
+    cx = (bx * block_pitch + px * PARCEL_SIZE + PARCEL_SIZE / 2).ravel()[:n_buildings]
+    cy = (by * block_pitch + py * PARCEL_SIZE + PARCEL_SIZE / 2).ravel()[:n_buildings]
+
+    # Similar sizes and orientations with little jitter
+    footprints = _rectangles(cx + rng.uniform(-1, 1, n_buildings), cy + rng.uniform(-1, 1, n_buildings),
+                             rng.uniform(8, 13, n_buildings), rng.uniform(8, 13, n_buildings),
+                             np.deg2rad(rng.uniform(-3, 3, n_buildings)))
+
+    # Streets along the block edges
+    extent = n_blocks_side * block_pitch
+    offsets = np.arange(n_blocks_side + 1) * block_pitch - STREET_WIDTH / 2
+    vertical = [np.array([[o, -STREET_WIDTH / 2], [o, extent]]) for o in offsets]
+    horizontal = [np.array([[-STREET_WIDTH / 2, o], [extent, o]]) for o in offsets]
+    streets = shapely.linestrings(np.stack(vertical + horizontal))
+
+    return footprints, streets, extent
+
+
+def informal_area(n_buildings: int, x_offset: float, rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """Clusters of small, dense footprints with random orientations and meandering paths."""
+    n_clusters = max(int(np.ceil(n_buildings / CLUSTER_SIZE)), 1)
+    radius = np.sqrt(CLUSTER_SIZE / np.pi) * CLUSTER_SPACING * 1.2
+    pitch = 2.5 * radius
+    n_side = int(np.ceil(np.sqrt(n_clusters)))
+
+    # Cluster centres on a jittered coarse lattice
+    i, j = np.divmod(np.arange(n_clusters), n_side)
+    centres_x = x_offset + radius + i * pitch + rng.uniform(-0.2, 0.2, n_clusters) * radius
+    centres_y = radius + j * pitch + rng.uniform(-0.2, 0.2, n_clusters) * radius
+
+    # Candidate locations on a lattice within the cluster disk, randomly thinned to the cluster size
+    n_lattice = int(np.ceil(radius / CLUSTER_SPACING))
+    lx, ly = np.meshgrid(np.arange(-n_lattice, n_lattice + 1), np.arange(-n_lattice, n_lattice + 1))
+    lx, ly = lx.ravel() * CLUSTER_SPACING, ly.ravel() * CLUSTER_SPACING
+    inside = np.hypot(lx, ly) <= radius
+    lx, ly = lx[inside], ly[inside]
+
+    sizes = np.full(n_clusters, n_buildings // n_clusters)
+    sizes[:n_buildings % n_clusters] += 1
+    cx, cy = [], []
+    for k in range(n_clusters):
+        selected = rng.choice(len(lx), size=min(sizes[k], len(lx)), replace=False)
+        cx.append(centres_x[k] + lx[selected])
+        cy.append(centres_y[k] + ly[selected])
+    cx, cy = np.concatenate(cx), np.concatenate(cy)
+    n = len(cx)
+
+    # Small footprints with random orientations (jitter and size keep neighbouring footprints disjoint)
+    footprints = _rectangles(cx + rng.uniform(-1, 1, n), cy + rng.uniform(-1, 1, n), rng.uniform(3, 5.5, n),
+                             rng.uniform(3, 5.5, n), np.deg2rad(rng.uniform(0, 90, n)))
+
+    # Meandering paths leaving the cluster centres (random walks with a persistent heading)
+    n_steps = int(np.ceil(radius * 1.2 / PATH_STEP))
+    n_paths = n_clusters * PATHS_PER_CLUSTER
+    heading = rng.uniform(0, 2 * np.pi, n_paths)[:, None] + np.cumsum(rng.normal(0, 0.35, (n_paths, n_steps)), axis=1)
+    x = np.repeat(centres_x, PATHS_PER_CLUSTER)[:, None] + np.cumsum(PATH_STEP * np.cos(heading), axis=1)
+    y = np.repeat(centres_y, PATHS_PER_CLUSTER)[:, None] + np.cumsum(PATH_STEP * np.sin(heading), axis=1)
+    x = np.hstack([np.repeat(centres_x, PATHS_PER_CLUSTER)[:, None], x])
+    y = np.hstack([np.repeat(centres_y, PATHS_PER_CLUSTER)[:, None], y])
+    paths = shapely.linestrings(np.stack([x, y], axis=-1))
+
+    # Access roads connecting the clusters to the planned street grid
+    connectors = shapely.linestrings(np.stack([np.stack([centres_x, centres_y], axis=-1),
+                                               np.stack([np.full(n_clusters, x_offset - STREET_WIDTH),
+                                                         centres_y], axis=-1)], axis=1))
+
+    return footprints, np.concatenate([paths, connectors])
+
+
+def generate_city(n_buildings: int, informal_share: float = 0.4, seed: int = 0, utm_epsg: int = 32632,
+                  origin: Tuple[float, float] = (460_000, 1_320_000)) -> Dict[str, GeoDataFrame]:
+    """
+    Generate a deterministic synthetic city with planned and informal areas.
+
+    Parameters:
+    - n_buildings: number of building footprints
+    - informal_share: share of buildings located in informal clusters
+    - seed: seed of the random number generator (same seed and parameters give the same city)
+    - utm_epsg: projected CRS the city is laid out in (default UTM zone 32N, i.e. Kano)
+    - origin: lower left corner of the city in utm_epsg coordinates
+
+    Returns:
+    - dict with buildings, roads, roi and grid (100 m cells), all in EPSG:4326 like the Overture downloads
+    """
+    rng = np.random.default_rng(seed)
+    n_informal = int(round(n_buildings * informal_share))
+    n_planned = n_buildings - n_informal
+
+    planned, streets, extent = planned_area(n_planned, rng) if n_planned > 0 else (np.array([]), np.array([]), 0)
+    informal, paths = informal_area(n_informal, extent + 200, rng) if n_informal > 0 else (np.array([]), np.array([]))
+
+    translate = np.array(origin)
+    footprints = shapely.transform(np.concatenate([planned, informal]), lambda coords: coords + translate)
+    road_geoms = shapely.transform(np.concatenate([streets, paths]), lambda coords: coords + translate)
+
+    buildings = gpd.GeoDataFrame({'class': ['planned'] * len(planned) + ['informal'] * len(informal)},
+                                 geometry=footprints, crs=utm_epsg)
+    road_class = ['residential'] * len(streets) + ['unclassified'] * len(paths)
+    roads = gpd.GeoDataFrame({'subtype': 'road', 'class': road_class, 'highway': road_class},
+                             geometry=road_geoms, crs=utm_epsg)
+
+    # Region of interest and 100 m grid covering all buildings
+    min_x, min_y, max_x, max_y = shapely.total_bounds(footprints)
+    roi = gpd.GeoDataFrame(geometry=[shapely.box(min_x, min_y, max_x, max_y)], crs=utm_epsg)
+    gx, gy = np.meshgrid(np.arange(np.floor(min_x / 100) * 100, max_x, 100),
+                         np.arange(np.floor(min_y / 100) * 100, max_y, 100))
+    grid = gpd.GeoDataFrame(geometry=shapely.box(gx.ravel(), gy.ravel(), gx.ravel() + 100, gy.ravel() + 100),
+                            crs=utm_epsg)
+
+    return {name: gdf.to_crs(4326) for name, gdf in
+            [('buildings', buildings), ('roads', roads), ('roi', roi), ('grid', grid)]}
+
+
+def write_city(city: Dict[str, GeoDataFrame], out_path: Path) -> Dict[str, Path]:
+    out_path.mkdir(parents=True, exist_ok=True)
+    files = {}
+    for name, gdf in city.items():
+        files[name] = out_path / f'{name}.parquet'
+        gdf.to_parquet(files[name])
+    return files
@@ -3,33 +3,8 @@ from geopandas import GeoDataFrame
 import momepy as mm
 from pathlib import Path
 import argparse
-import utm
-
-
-def get_utm_epsg(gdf: GeoDataFrame) -> int:
-    gdf = gdf.to_crs(4326)
-
-    bounds = gdf.total_bounds
-    min_lng, min_lat, max_lng, max_lat = bounds
-
-    # Calculate the centroid of the bounding box
-    lng = (min_lng + max_lng) / 2
-    lat = (min_lat + max_lat) / 2
-
-    # Convert to UTM
-    utm_coords = utm.from_latlon(lat, lng)
-
-    # Extract UTM Zone information
-    zone_number = utm_coords[2]
-    zone_letter = utm_coords[3]
-
-    # Determine the EPSG code
-    if zone_letter >= 'N':  # Northern hemisphere
-        epsg_code = 32600 + zone_number
-    else:  # Southern hemisphere
-        epsg_code = 32700 + zone_number
-
-    return epsg_code
+from geo_io import read_geo, get_columns
+from projection import get_utm_epsg, load_utm_epsg
 
 
 def argument_parser():
@@ -51,9 +26,9 @@ def argument_parser():
     return parser
 
 
-def preprocess_edges(edges: GeoDataFrame, extent: GeoDataFrame) -> GeoDataFrame:
-    extent = extent.to_crs(4326)
-    utm_epsg = get_utm_epsg(extent)
+def preprocess_edges(edges: GeoDataFrame, extent: GeoDataFrame, utm_epsg: int = None) -> GeoDataFrame:
+    if utm_epsg is None:
+        utm_epsg = get_utm_epsg(extent)
     edges = edges.to_crs(utm_epsg)
     extent_utm = extent.to_crs(utm_epsg)
 
@@ -95,20 +70,21 @@ if __name__ == '__main__':
     assert Path(args.output_dir).exists()
 
     # Region of interest
-    roi = gpd.read_file(args.roi_file)
+    roi = read_geo(args.roi_file)
 
     # Buildings
     building_file = Path(args.building_file)
-    buildings = gpd.read_parquet(building_file) if building_file.suffix == '.parquet' else gpd.read_file(building_file)
+    buildings = read_geo(building_file, columns=['uID', 'geometry'])
 
     # Tessellation
     tess_file = Path(args.tessellation_file)
-    tess = gpd.read_parquet(tess_file) if tess_file.suffix == '.parquet' else gpd.read_file(tess_file)
+    tess = read_geo(tess_file, columns=['uID', 'geometry'])
 
-    # Roads
+    # Roads (only attributes used for filtering and roads within the extent of the region of interest)
     edge_file = Path(args.edge_file)
-    edges = gpd.read_parquet(edge_file) if edge_file.suffix == '.parquet' else gpd.read_file(edge_file)
-    edges = preprocess_edges(edges, roi)
+    edge_columns = [column for column in ['subtype', 'class'] if column in get_columns(edge_file)]
+    edges = read_geo(edge_file, columns=edge_columns, bbox=roi)
+    edges = preprocess_edges(edges, roi, load_utm_epsg(args.output_dir, roi))
     edges = edges[['nID', 'geometry']]
     edges.to_parquet(Path(args.output_dir) / 'edges.parquet')
 
@@ -117,7 +93,7 @@ if __name__ == '__main__':
     blocks.to_parquet(Path(args.output_dir) / 'blocks.parquet')
 
     # Reload buildings
-    buildings = gpd.read_parquet(building_file) if building_file.suffix == '.parquet' else gpd.read_file(building_file)
+    buildings = read_geo(building_file, columns=['uID', 'geometry'])
 
     # Add network ID of closest road to buildings
     buildings['nID'] = mm.get_nearest_street(buildings, edges, max_distance=500)
@@ -140,8 +116,9 @@ if __name__ == '__main__':
             buildings.loc[index, 'bID'] = row['bID']
     assert buildings['bID'].isna().sum() == 0
 
+    buildings = buildings.set_geometry('geometry')
     buildings[['uID', 'nID', 'bID', 'geometry']].to_parquet(Path(args.output_dir) / 'buildings.parquet')
 
-    tess = gpd.read_parquet(tess_file) if tess_file.suffix == '.parquet' else gpd.read_file(tess_file)
+    tess = read_geo(tess_file)
     tess = tess.merge(buildings[['uID', 'bID']], on='uID', how='left')
     tess.to_parquet(Path(args.output_dir) / 'tessellation.parquet')
@@ -1,4 +1,3 @@
-import geopandas as gpd
 from geopandas import GeoDataFrame
 import pandas as pd
 from pandas import DataFrame
@@ -8,6 +7,7 @@ from pathlib import Path
 import argparse
 import pickle
 import numpy as np
+from geo_io import read_geo, read_table
 
 
 def argument_parser():
@@ -51,7 +51,7 @@ def compute_metric(metric: str, buildings: GeoDataFrame, tessellation: GeoDataFr
     out_file = out_path / f'{metric}.parquet'
     if out_file.exists():
         print(f'{metric} has already been computed. Loading data from {out_file}.')
-        values = pd.read_parquet(out_file)
+        values = read_table(out_file)
         return values
 
     if metric == 'sdbAre':
@@ -69,7 +69,6 @@ def compute_metric(metric: str, buildings: GeoDataFrame, tessellation: GeoDataFr
         values = values['sdbAre'] / values['sdcAre']
     elif metric == 'mtbAli':
         queen_1 = compute_queen_graph(tessellation, 1, out_path)
-        # TODO: Key error with 'all' when running it for the first time
         stbOri = compute_metric('stbOri', buildings, tessellation, out_path)
         buildings = buildings.merge(stbOri[['stbOri', 'uID']], on='uID')
         values = mm.alignment(buildings['stbOri'], queen_1)
@@ -86,7 +85,7 @@ def compute_metric(metric: str, buildings: GeoDataFrame, tessellation: GeoDataFr
         values = mm.neighbors(tessellation, queen_1, weighted=True)
     elif metric == 'strAli':
         assert args.edge_file is not None
-        roads = gpd.read_parquet(args.edge_file)
+        roads = read_geo(args.edge_file, columns=['geometry'])
         roads_orient = mm.orientation(roads)
         blg_orient = compute_metric('stbOri', buildings, tessellation, out_path)
         buildings = buildings.merge(blg_orient[['uID', 'stbOri']], on='uID', how='left')
@@ -98,22 +97,18 @@ def compute_metric(metric: str, buildings: GeoDataFrame, tessellation: GeoDataFr
     else:
         raise Exception('Unkown metric.')
 
-    if building_metric:
-        buildings[metric] = values
-        buildings[['uID', metric]].to_parquet(out_file)
-        return buildings[['uID', metric]]
-    else:
-        tessellation[metric] = values
-        tessellation[['uID', metric]].to_parquet(out_file)
-        return tessellation[['uID', metric]]
+    # The metric is stored in a new frame to avoid adding columns to the caller's buildings/tessellation
+    values = (buildings if building_metric else tessellation)[['uID']].assign(**{metric: values})
+    values.to_parquet(out_file)
+    return values
 
 
 if __name__ == '__main__':
     args = argument_parser().parse_known_args()[0]
     assert Path(args.output_dir).exists()
 
-    blg = gpd.read_parquet(args.building_file)
-    tess = gpd.read_parquet(args.tessellation_file)
+    blg = read_geo(args.building_file)
+    tess = read_geo(args.tessellation_file, columns=['uID', 'geometry'])
 
     assert blg['uID'].is_unique
     blg = blg.sort_values(by='uID')
@@ -1,12 +1,13 @@
-import geopandas as gpd
 import pandas as pd
 import matplotlib
-matplotlib.use('TkAgg')
+import os
+matplotlib.use(os.environ.get('MPLBACKEND', 'TkAgg'))
 import matplotlib.pyplot as plt
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler, RobustScaler
 from pathlib import Path
 import argparse
+from geo_io import read_geo
 
 
 def argument_parser():
@@ -31,8 +32,7 @@ if __name__ == '__main__':
     output_dir = Path(args.output_dir)
     assert output_dir.exists()
 
-    mm_file = Path(args.morphometrics_file)
-    gdf = gpd.read_parquet(mm_file) if mm_file.suffix == '.parquet' else gpd.read_file(mm_file)
+    gdf = read_geo(args.morphometrics_file)
     print(gdf.isna().sum())
     gdf = gdf.fillna(0)
 
@@ -0,0 +1,258 @@
+import geopandas as gpd
+from geopandas import GeoDataFrame
+import pandas as pd
+from pandas import DataFrame
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import pyarrow.compute as pc
+import pyogrio
+from pyproj import CRS
+from pathlib import Path
+import json
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+BBox = Tuple[float, float, float, float]
+
+
+def _geo_metadata(file: Path) -> dict:
+    # GeoParquet stores the geometry encoding, CRS and bbox covering in the 'geo' key of the schema metadata
+    metadata = pq.read_schema(file).metadata or {}
+    if b'geo' not in metadata:
+        raise ValueError(f'{file} is not a GeoParquet file (missing "geo" metadata).')
+    return json.loads(metadata[b'geo'].decode('utf-8'))
+
+
+def _primary_column(geo_metadata: dict) -> str:
+    # A primary column without metadata points to a writer bug (e.g. the active geometry was switched to a column
+    # that was dropped before writing), so it is reported instead of guessing another geometry column
+    primary_column = geo_metadata['primary_column']
+    if primary_column not in geo_metadata['columns']:
+        raise ValueError(f'The primary geometry column "{primary_column}" is not one of the geometry columns '
+                         f'{list(geo_metadata["columns"])} of the GeoParquet metadata.')
+    return primary_column
+
+
+def _geometry_crs(geo_metadata: dict, geometry_column: str) -> Optional[CRS]:
+    column_metadata = geo_metadata['columns'][geometry_column]
+    if 'crs' not in column_metadata:
+        # The GeoParquet spec defaults to OGC:CRS84 if the crs is omitted
+        return CRS.from_user_input('OGC:CRS84')
+    if column_metadata['crs'] is None:
+        return None
+    crs = column_metadata['crs']
+    return CRS.from_json_dict(crs) if isinstance(crs, dict) else CRS.from_user_input(crs)
+
+
+def _bbox_fields(file: Path, geo_metadata: dict) -> Optional[dict]:
+    # Bbox covering column (GeoParquet 1.1), e.g. {'xmin': ['bbox', 'xmin'], ...}
+    column_metadata = geo_metadata['columns'][_primary_column(geo_metadata)]
+    covering = column_metadata.get('covering', {}).get('bbox')
+    if covering is not None:
+        return covering
+
+    # Overture files ship a 'bbox' struct column without covering metadata
+    schema = pq.read_schema(file)
+    if 'bbox' in schema.names:
+        bbox_type = schema.field('bbox').type
+        names = [bbox_type.field(i).name for i in range(bbox_type.num_fields)] if bbox_type.num_fields else []
+        if {'xmin', 'ymin', 'xmax', 'ymax'}.issubset(names):
+            return {key: ['bbox', key] for key in ['xmin', 'ymin', 'xmax', 'ymax']}
+    return None
+
+
+def _bbox_expression(bbox_fields: dict, bbox: BBox):
+    # Envelope intersection test on the covering column, pushed down to the row group statistics
+    minx, miny, maxx, maxy = bbox
+    return ((pc.field(*bbox_fields['xmin']) <= maxx) & (pc.field(*bbox_fields['xmax']) >= minx) &
+            (pc.field(*bbox_fields['ymin']) <= maxy) & (pc.field(*bbox_fields['ymax']) >= miny))
+
+
+def _combine_filters(filters, bbox_filter):
+    if filters is not None and not isinstance(filters, pc.Expression):
+        filters = pq.filters_to_expression(filters)
+    if filters is None:
+        return bbox_filter
+    if bbox_filter is None:
+        return filters
+    return filters & bbox_filter
+
+
+def _envelope_mask(gdf: GeoDataFrame, bbox: BBox):
+    minx, miny, maxx, maxy = bbox
+    bounds = gdf.geometry.bounds
+    return ((bounds['minx'] <= maxx) & (bounds['maxx'] >= minx) &
+            (bounds['miny'] <= maxy) & (bounds['maxy'] >= miny)).to_numpy()
+
+
+def _select_columns(columns: Optional[Sequence[str]], geometry_column: str) -> Optional[list]:
+    if columns is None:
+        return None
+    columns = list(columns)
+    if geometry_column not in columns:
+        columns.append(geometry_column)
+    return columns
+
+
+def _to_geodataframe(df: DataFrame, geometry_column: str, crs: Optional[CRS]) -> GeoDataFrame:
+    df[geometry_column] = gpd.GeoSeries.from_wkb(df[geometry_column], index=df.index, crs=crs)
+    return gpd.GeoDataFrame(df, geometry=geometry_column, crs=crs)
+
+
+def get_crs(file: Union[str, Path]) -> Optional[CRS]:
+    """Read the CRS of a vector file without loading any features."""
+    file = Path(file)
+    if file.suffix == '.parquet':
+        geo_metadata = _geo_metadata(file)
+        return _geometry_crs(geo_metadata, _primary_column(geo_metadata))
+    crs = pyogrio.read_info(file)['crs']
+    return CRS.from_user_input(crs) if crs is not None else None
+
+
+def get_columns(file: Union[str, Path]) -> list:
+    """List the attribute and geometry columns of a vector file without loading any features."""
+    file = Path(file)
+    if file.suffix == '.parquet':
+        return [name for name in pq.read_schema(file).names if not name.startswith('__index_level_')]
+    return list(pyogrio.read_info(file)['fields']) + ['geometry']
+
+
+def resolve_bbox(file: Union[str, Path], bbox: Union[BBox, GeoDataFrame, None]) -> Optional[BBox]:
+    """Convert a region of interest to a bbox in the CRS of the file."""
+    if bbox is None or isinstance(bbox, tuple):
+        return bbox
+    crs = get_crs(file)
+    extent = bbox.to_crs(crs) if crs is not None and bbox.crs is not None else bbox
+    return tuple(extent.total_bounds)
+
+
+def read_geo(file: Union[str, Path], columns: Optional[Sequence[str]] = None,
+             bbox: Union[BBox, GeoDataFrame, None] = None, filters=None) -> GeoDataFrame:
+    """
+    Read a GeoParquet or OGR vector file, pushing column selection and spatial filters down to the reader.
+
+    Parameters:
+    - file: path to a .parquet file or any file readable by pyogrio (.gpkg, .geojson, .shp)
+    - columns: columns to read, the geometry column is always included (default reads all columns)
+    - bbox: (minx, miny, maxx, maxy) in the CRS of the file, or a GeoDataFrame whose total bounds are used
+    - filters: pyarrow filters (expression or DNF list) for GeoParquet files, used to prune row groups
+
+    Returns:
+    - GeoDataFrame with the features whose envelope intersects the bbox
+    """
+    file = Path(file)
+    bbox = resolve_bbox(file, bbox)
+
+    if file.suffix != '.parquet':
+        if filters is not None:
+            raise ValueError('Attribute filters are only supported for GeoParquet files.')
+        read_columns = [c for c in columns if c != 'geometry'] if columns is not None else None
+        return pyogrio.read_dataframe(file, columns=read_columns, bbox=bbox)
+
+    geo_metadata = _geo_metadata(file)
+    geometry_column = _primary_column(geo_metadata)
+    bbox_fields = _bbox_fields(file, geo_metadata) if bbox is not None else None
+    bbox_filter = _bbox_expression(bbox_fields, bbox) if bbox_fields is not None else None
+
+    table = pq.read_table(file, columns=_select_columns(columns, geometry_column),
+                          filters=_combine_filters(filters, bbox_filter), use_pandas_metadata=True)
+    gdf = _to_geodataframe(table.to_pandas(), geometry_column, _geometry_crs(geo_metadata, geometry_column))
+
+    # Files without a bbox covering are filtered after decoding the geometries
+    if bbox is not None and bbox_fields is None:
+        gdf = gdf[_envelope_mask(gdf, bbox)]
+    return gdf
+
+
+def iter_geo_batches(file: Union[str, Path], columns: Optional[Sequence[str]] = None,
+                     bbox: Union[BBox, GeoDataFrame, None] = None, filters=None,
+                     batch_size: int = 65_536) -> Iterator[GeoDataFrame]:
+    """Iterate over a vector file in record batches of at most batch_size features (see read_geo)."""
+    file = Path(file)
+    bbox = resolve_bbox(file, bbox)
+
+    if file.suffix != '.parquet':
+        if filters is not None:
+            raise ValueError('Attribute filters are only supported for GeoParquet files.')
+        read_columns = [c for c in columns if c != 'geometry'] if columns is not None else None
+        n_features = pyogrio.read_info(file)['features']
+        for skip in range(0, n_features, batch_size):
+            batch = pyogrio.read_dataframe(file, columns=read_columns, bbox=bbox, skip_features=skip,
+                                           max_features=batch_size)
+            if len(batch) > 0:
+                yield batch
+        return
+
+    geo_metadata = _geo_metadata(file)
+    geometry_column = _primary_column(geo_metadata)
+    crs = _geometry_crs(geo_metadata, geometry_column)
+    bbox_fields = _bbox_fields(file, geo_metadata) if bbox is not None else None
+    bbox_filter = _bbox_expression(bbox_fields, bbox) if bbox_fields is not None else None
+
+    dataset = ds.dataset(file, format='parquet')
+    scanner = dataset.scanner(columns=_select_columns(columns, geometry_column),
+                              filter=_combine_filters(filters, bbox_filter), batch_size=batch_size)
+    for record_batch in scanner.to_batches():
+        if record_batch.num_rows == 0:
+            continue
+        gdf = _to_geodataframe(record_batch.to_pandas(), geometry_column, crs)
+        if bbox is not None and bbox_fields is None:
+            gdf = gdf[_envelope_mask(gdf, bbox)]
+        if len(gdf) > 0:
+            yield gdf
+
+
+def read_table(file: Union[str, Path], columns: Optional[Sequence[str]] = None, filters=None) -> DataFrame:
+    """Read a (non-spatial) Parquet table, e.g. a morphometric, with column and row group pruning."""
+    return pd.read_parquet(file, columns=list(columns) if columns is not None else None, filters=filters)
+
+
+class GeoParquetWriter:
+    """
+    Write a GeoParquet file batch by batch, so that large outputs never have to be held in memory.
+
+    Parameters:
+    - file: path to the output .parquet file
+    - crs: CRS of the geometries (default EPSG:4326)
+    - geometry_types: GeoParquet geometry types, e.g. ['LineString'] (default leaves them unspecified)
+
+    All batches must have the same columns and dtypes; the schema is taken from the first batch.
+    """
+
+    def __init__(self, file: Union[str, Path], crs=4326, geometry_types: Optional[List[str]] = None):
+        self.file = Path(file)
+        self.crs = CRS.from_user_input(crs) if crs is not None else None
+        self.geometry_types = geometry_types or []
+        self.writer = None
+        self.n_features = 0
+
+    def _geo_metadata(self, geometry_column: str) -> bytes:
+        column_metadata = {'encoding': 'WKB', 'geometry_types': self.geometry_types,
+                           'crs': self.crs.to_json_dict() if self.crs is not None else None}
+        return json.dumps({'version': '1.0.0', 'primary_column': geometry_column,
+                           'columns': {geometry_column: column_metadata}}).encode('utf-8')
+
+    def write(self, gdf: GeoDataFrame):
+        if len(gdf) == 0:
+            return
+        geometry_column = gdf.geometry.name
+        df = pd.DataFrame(gdf.drop(columns=geometry_column))
+        df[geometry_column] = gdf.geometry.to_wkb()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+        if self.writer is None:
+            metadata = {**(table.schema.metadata or {}), b'geo': self._geo_metadata(geometry_column)}
+            self.schema = table.schema.with_metadata(metadata)
+            self.writer = pq.ParquetWriter(self.file, self.schema)
+        self.writer.write_table(table.cast(self.schema))
+        self.n_features += len(gdf)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,7 +1,6 @@
-import geopandas as gpd
-import numpy as np
 from pathlib import Path
 import argparse
+from geo_io import read_geo
 
 
 def argument_parser():
@@ -27,13 +26,12 @@ def argument_parser():
 if __name__ == '__main__':
     args = argument_parser().parse_known_args()[0]
 
-    cluster_file = Path(args.cluster_file)
-    gdf = gpd.read_parquet(cluster_file) if cluster_file.suffix == '.parquet' else gpd.read_file(cluster_file)
-
     n_isl_clusters = int(args.isl_n_clusters)
+    n_sds_clusters = int(args.sds_n_clusters)
+    gdf = read_geo(args.cluster_file, columns=[f'isl_c{n_isl_clusters}', f'sds_c{n_sds_clusters}'])
+
     gdf['isl'] = gdf[f'isl_c{n_isl_clusters}'].isin(args.isl_clusters)
     gdf['isl'] = gdf['isl'].astype(int)
-    n_sds_clusters = int(args.sds_n_clusters)
     gdf['sds'] = gdf[f'sds_c{n_sds_clusters}'].isin(args.sds_clusters)
     gdf['sds'] = gdf['sds'].astype(int)
 
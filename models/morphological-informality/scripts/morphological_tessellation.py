@@ -1,25 +1,8 @@
-import geopandas as gpd
 from geopandas import GeoDataFrame
 import momepy as mm
 from pathlib import Path
 import argparse
-import utm
-
-
-def get_utm_epsg(gdf: GeoDataFrame) -> int:
-    gdf = gdf.to_crs(4326)
-
-    # Calculate the centroid of the bounding box
-    bounds = gdf.total_bounds
-    min_lng, min_lat, max_lng, max_lat = bounds
-    lng, lat = (min_lng + max_lng) / 2, (min_lat + max_lat) / 2
-
-    # Convert to UTM and create EPSG code
-    utm_coords = utm.from_latlon(lat, lng)
-    zone_number, zone_letter = utm_coords[2], utm_coords[3]
-    epsg_code = 32600 + zone_number if zone_letter >= 'N' else 32700 + zone_number
-
-    return epsg_code
+from geo_io import read_geo
 
 
 def argument_parser():
@@ -55,8 +38,7 @@ if __name__ == '__main__':
     args = argument_parser().parse_known_args()[0]
 
     # Loading preprocessed buildings
-    building_file = Path(args.building_file)
-    buildings = gpd.read_parquet(building_file) if building_file.suffix == '.parquet' else gpd.read_file(building_file)
+    buildings = read_geo(args.building_file, columns=['uID', 'geometry'])
 
     # Morphological tessellation
     tess = get_morphological_tessellation(buildings, 'uID')
@@ -77,7 +59,8 @@ if __name__ == '__main__':
         tess = tess.reset_index()
         buildings['uID'] = range(len(buildings))
         tess['uID'] = range(len(tess))
-        buildings[['uID', 'geometry']].to_parquet(Path(args.output_dir) / 'buildings.parquet')
+
+    buildings[['uID', 'geometry']].to_parquet(Path(args.output_dir) / 'buildings.parquet')
 
     tess.index.name = None
     tess.to_parquet(Path(args.output_dir) / 'tessellation.parquet')
@@ -1,8 +1,16 @@
+import geopandas as gpd
 from geopandas import GeoDataFrame
 from shapely.geometry import box
-import osmnx as ox
+import shapely
+import osmium
+from geo_io import GeoParquetWriter
+from pathlib import Path
 import argparse
 
+# Highway values and service types excluded by osmnx for network_type='all'
+EXCLUDED_HIGHWAYS = {'abandoned', 'construction', 'no', 'planned', 'platform', 'proposed', 'raceway', 'razed'}
+EXCLUDED_SERVICES = {'private'}
+
 
 def argument_parser():
     # https://docs.python.org/3/library/argparse.html#the-add-argument-method
@@ -13,6 +21,12 @@ def argument_parser():
     parser.add_argument('-s', '--south', dest='south', required=True)
     parser.add_argument('-o', '--output-dir', dest='output_dir', default='outputs/', required=False,
                         help="path to output directory")
+    parser.add_argument('-p', '--pbf-file', dest='pbf_file', default=None, required=False,
+                        help="local .osm.pbf extract, roads are read from it instead of the Overpass API")
+    parser.add_argument('--node-index', dest='node_index', default='flex_mem', required=False,
+                        help="osmium node location index, e.g. 'sparse_file_array,nodes.bin' for large extracts")
+    parser.add_argument('--batch-size', dest='batch_size', default=50_000, type=int, required=False,
+                        help="number of roads written to the output file at once")
 
     parser.add_argument(
         "opts",
@@ -25,6 +39,9 @@ def argument_parser():
 
 # Download road network from OpenStreetMap
 def get_osm_roads(east: float, west: float, north: float, south: float) -> GeoDataFrame:
+    # osmnx is only needed when downloading from the Overpass API
+    import osmnx as ox
+
     # Create bounding box (shapely box)
     bbox = box(west, south, east, north)
 
@@ -38,10 +55,69 @@ def get_osm_roads(east: float, west: float, north: float, south: float) -> GeoDa
     return edges
 
 
+def is_road(tags) -> bool:
+    # Same tag filter as the osmnx 'all' network type
+    return (tags.get('highway') not in EXCLUDED_HIGHWAYS and tags.get('area') != 'yes'
+            and tags.get('service') not in EXCLUDED_SERVICES)
+
+
+def write_pbf_roads(pbf_file: str, east: float, west: float, north: float, south: float, out_file: str,
+                    node_index: str = 'flex_mem', batch_size: int = 50_000) -> int:
+    """
+    Extract the roads within a bounding box from a local OSM PBF extract and write them to GeoParquet.
+
+    The file is streamed once (nodes before ways): node locations are kept in the osmium index and ways
+    are written in batches, so memory is bounded by the index and batch_size. Unlike osmnx, ways are not
+    split at intersections; roads intersecting the bbox are kept in full.
+
+    Returns:
+    - number of roads written (highway and geometry columns, EPSG:4326)
+    """
+    bbox = box(west, south, east, north)
+    processor = (osmium.FileProcessor(pbf_file, osmium.osm.NODE | osmium.osm.WAY)
+                 .with_locations(storage=node_index)
+                 .with_filter(osmium.filter.EntityFilter(osmium.osm.WAY))
+                 .with_filter(osmium.filter.KeyFilter('highway')))
+    wkb_factory = osmium.geom.WKBFactory()
+
+    highways, geometries = [], []
+    with GeoParquetWriter(out_file, crs=4326, geometry_types=['LineString']) as writer:
+        for way in processor:
+            if not is_road(way.tags):
+                continue
+            try:
+                geometries.append(wkb_factory.create_linestring(way))
+            except (osmium.InvalidLocationError, RuntimeError):
+                # Ways with nodes missing from the extract or with less than two distinct nodes
+                continue
+            highways.append(way.tags['highway'])
+
+            if len(highways) == batch_size:
+                writer.write(roads_batch(highways, geometries, bbox))
+                highways, geometries = [], []
+        writer.write(roads_batch(highways, geometries, bbox))
+
+    if writer.n_features == 0:
+        raise ValueError(f'No roads found in {pbf_file} within the bounding box.')
+    return writer.n_features
+
+
+def roads_batch(highways: list, geometries: list, bbox) -> GeoDataFrame:
+    # Vectorized bbox filter, applied to all roads of a batch at once
+    roads = gpd.GeoDataFrame({'highway': highways}, geometry=shapely.from_wkb(geometries), crs=4326)
+    return roads[shapely.intersects(roads.geometry.values, bbox)].reset_index(drop=True)
+
+
 if __name__ == '__main__':
     args = argument_parser().parse_known_args()[0]
-    roads = get_osm_roads(float(args.east), float(args.west), float(args.north), float(args.south))
-    roads.to_parquet(args.output_dir)
+    if args.pbf_file is not None:
+        Path(args.output_dir).parent.mkdir(parents=True, exist_ok=True)
+        n_roads = write_pbf_roads(args.pbf_file, float(args.east), float(args.west), float(args.north),
+                                  float(args.south), args.output_dir, args.node_index, args.batch_size)
+        print(f'{n_roads} roads written to {args.output_dir}.')
+    else:
+        roads = get_osm_roads(float(args.east), float(args.west), float(args.north), float(args.south))
+        roads.to_parquet(args.output_dir)
 
 
 
@@ -0,0 +1,304 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+import argparse
+import ast
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import psutil
+import xxhash
+from projection import read_metadata, write_metadata
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+STATE_FILE = 'pipeline_state.json'
+REPORT_FILE = 'timing_report.json'
+
+
+@dataclass
+class Stage:
+    name: str
+    script: str
+    args: List[str]
+    inputs: List[Path]
+    outputs: List[Path]
+    depends: List[str] = field(default_factory=list)
+
+    @property
+    def output_dir(self) -> Path:
+        return self.outputs[0].parent
+
+
+def argument_parser():
+    # https://docs.python.org/3/library/argparse.html#the-add-argument-method
+    parser = argparse.ArgumentParser(description="Morphological informality pipeline")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="run all stages that are not up-to-date")
+    run_parser.add_argument('-r', '--roi-file', dest='roi_file', required=True)
+    run_parser.add_argument('-b', '--building-file', dest='building_file', required=True)
+    run_parser.add_argument('-e', '--edge-file', dest='edge_file', required=True)
+    run_parser.add_argument('-g', '--grid-file', dest='grid_file', required=True)
+    run_parser.add_argument('-o', '--output-dir', dest='output_dir', default='outputs/', required=False,
+                            help="path to output directory")
+    run_parser.add_argument('-s', '--seed', dest='seed', default=7, type=int, required=False,
+                            help="seed for clustering")
+    run_parser.add_argument('--isl-clusters', dest='isl_clusters', required=False, default=None, metavar='N',
+                            type=int, nargs='+', help="clusters of irregular layout (runs the indicator model)")
+    run_parser.add_argument('--sds-clusters', dest='sds_clusters', required=False, default=None, metavar='N',
+                            type=int, nargs='+', help="clusters of small, dense structures (runs the indicator model)")
+    run_parser.add_argument('--isl-n-clusters', dest='isl_n_clusters', required=False, default=10, type=int)
+    run_parser.add_argument('--sds-n-clusters', dest='sds_n_clusters', required=False, default=10, type=int)
+    run_parser.add_argument('-j', '--jobs', dest='jobs', default=2, type=int, required=False,
+                            help="number of stages run concurrently")
+    run_parser.add_argument('-f', '--force', dest='force', action='store_true', help="rerun all stages")
+    return parser
+
+
+def morphological_informality_stages(roi_file: str, building_file: str, edge_file: str, grid_file: str,
+                                     output_dir: str, seed: int = 7, isl_clusters: Sequence[int] = None,
+                                     sds_clusters: Sequence[int] = None, isl_n_clusters: int = 10,
+                                     sds_n_clusters: int = 10) -> List[Stage]:
+    """Define the stages of the model as a DAG, each stage writing to its own sub dir of output_dir."""
+    # Stages run from the scripts dir, hence all paths are made absolute
+    roi_file, building_file = Path(roi_file).resolve(), Path(building_file).resolve()
+    edge_file, grid_file = Path(edge_file).resolve(), Path(grid_file).resolve()
+    out = Path(output_dir).resolve()
+    preprocess_dir, tess_dir, blocks_dir = out / 'preprocess', out / 'tessellation', out / 'blocks'
+    bmm_dir, rmm_dir = out / 'morphometrics', out / 'road_morphometrics'
+    agg_dir, cluster_dir = out / 'aggregation', out / 'clustering'
+    metrics = ['sdbAre', 'stbOri', 'mtbNDi_log', 'sdcAre', 'stcOri', 'sicCAR', 'mtcWNe', 'strAli', 'mtbAli']
+
+    stages = [
+        Stage('preprocess', 'preprocess_buildings.py',
+              ['-r', roi_file, '-b', building_file, '-o', preprocess_dir],
+              inputs=[roi_file, building_file],
+              outputs=[preprocess_dir / 'buildings.parquet']),
+        Stage('tessellation', 'morphological_tessellation.py',
+              ['-b', preprocess_dir / 'buildings.parquet', '-o', tess_dir],
+              inputs=[preprocess_dir / 'buildings.parquet'],
+              outputs=[tess_dir / 'buildings.parquet', tess_dir / 'tessellation.parquet'],
+              depends=['preprocess']),
+        # Road morphometrics only need the UTM zone of the preprocessing and run alongside the tessellation
+        Stage('road_morphometrics', 'road_morphometrics.py',
+              ['-m', 'strOri', '-r', edge_file, '-o', rmm_dir],
+              inputs=[edge_file],
+              outputs=[rmm_dir / 'strOri.parquet'],
+              depends=['preprocess']),
+        Stage('blocks', 'building_blocks.py',
+              ['-r', roi_file, '-b', tess_dir / 'buildings.parquet', '-t', tess_dir / 'tessellation.parquet',
+               '-e', edge_file, '-o', blocks_dir],
+              inputs=[roi_file, edge_file, tess_dir / 'buildings.parquet', tess_dir / 'tessellation.parquet'],
+              outputs=[blocks_dir / 'buildings.parquet', blocks_dir / 'tessellation.parquet',
+                       blocks_dir / 'edges.parquet', blocks_dir / 'blocks.parquet'],
+              depends=['tessellation']),
+        Stage('building_morphometrics', 'building_morphometrics.py',
+              ['-m', 'all', '-b', blocks_dir / 'buildings.parquet', '-t', blocks_dir / 'tessellation.parquet',
+               '-e', blocks_dir / 'edges.parquet', '-o', bmm_dir],
+              inputs=[blocks_dir / 'buildings.parquet', blocks_dir / 'tessellation.parquet',
+                      blocks_dir / 'edges.parquet'],
+              outputs=[bmm_dir / f'{metric}.parquet' for metric in metrics],
+              depends=['blocks']),
+        Stage('aggregation', 'aggregation.py',
+              ['-m', bmm_dir, '-r', rmm_dir, '-b', blocks_dir / 'buildings.parquet', '-g', grid_file, '-o', agg_dir],
+              inputs=[grid_file, blocks_dir / 'buildings.parquet', rmm_dir / 'strOri.parquet'] +
+                     [bmm_dir / f'{metric}.parquet' for metric in metrics],
+              outputs=[agg_dir / 'morphometrics_grid.parquet'],
+              depends=['building_morphometrics', 'road_morphometrics']),
+        Stage('clustering', 'clustering.py',
+              ['-m', agg_dir / 'morphometrics_grid.parquet', '-s', seed, '-o', cluster_dir],
+              inputs=[agg_dir / 'morphometrics_grid.parquet'],
+              outputs=[cluster_dir / 'clusters.parquet'],
+              depends=['aggregation']),
+    ]
+
+    # The indicator model requires the selection of clusters, which is done based on the clustering outputs
+    if isl_clusters and sds_clusters:
+        model_dir = out / 'model'
+        stages.append(Stage('model', 'indicatorbasedmodel.py',
+                            ['-c', cluster_dir / 'clusters.parquet', '--isl-clusters', *isl_clusters,
+                             '--sds-clusters', *sds_clusters, '--isl-n-clusters', isl_n_clusters,
+                             '--sds-n-clusters', sds_n_clusters, '-o', model_dir],
+                            inputs=[cluster_dir / 'clusters.parquet'],
+                            outputs=[model_dir / 'model.parquet'],
+                            depends=['clustering']))
+
+    return stages
+
+
+def file_hash(file: Path, cache: Dict[str, dict]) -> str:
+    # Content hash of a file, reusing the cached hash if size and modification time are unchanged
+    stat = file.stat()
+    cached = cache.get(str(file))
+    if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        return cached['hash']
+
+    hasher = xxhash.xxh3_128()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b''):
+            hasher.update(chunk)
+    cache[str(file)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': hasher.hexdigest()}
+    return cache[str(file)]['hash']
+
+
+def local_imports(script: Path) -> List[Path]:
+    # Modules of SCRIPTS_DIR imported by the script, directly or through other local modules (not the other stages,
+    # which are run as scripts and never imported)
+    modules, pending = set(), [script]
+    while pending:
+        tree = ast.parse(pending.pop().read_text())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = SCRIPTS_DIR / (name.split('.')[0] + '.py')
+                if module.exists() and module != script and module not in modules:
+                    modules.add(module)
+                    pending.append(module)
+    return sorted(modules)
+
+
+def stage_key(stage: Stage, cache: Dict[str, dict]) -> str:
+    # The key changes whenever the script, the local modules it imports (e.g. geo_io.py, projection.py), its
+    # arguments or the content of any input changes
+    hasher = xxhash.xxh3_128()
+    hasher.update(file_hash(SCRIPTS_DIR / stage.script, cache).encode())
+    for module in local_imports(SCRIPTS_DIR / stage.script):
+        hasher.update(module.name.encode())
+        hasher.update(file_hash(module, cache).encode())
+    hasher.update(json.dumps([str(arg) for arg in stage.args]).encode())
+    for input_file in stage.inputs:
+        hasher.update(file_hash(Path(input_file), cache).encode())
+    return hasher.hexdigest()
+
+
+def is_up_to_date(stage: Stage, key: str, state: dict, cache: Dict[str, dict]) -> bool:
+    stage_state = state['stages'].get(stage.name)
+    if stage_state is None or stage_state['key'] != key:
+        return False
+    for output in stage.outputs:
+        if not output.exists() or file_hash(output, cache) != stage_state['outputs'].get(str(output)):
+            return False
+    return True
+
+
+def run_stage(stage: Stage, utm: Optional[dict], interval: float = 0.05) -> Tuple[float, float]:
+    # Start from an empty output dir so that no cached intermediate of a previous run is reused
+    if stage.output_dir.exists():
+        shutil.rmtree(stage.output_dir)
+    stage.output_dir.mkdir(parents=True)
+    if utm is not None and utm.get('utm_epsg') is not None:
+        write_metadata(stage.output_dir, **utm)
+
+    cmd = [sys.executable, str(SCRIPTS_DIR / stage.script)] + [str(arg) for arg in stage.args]
+    env = dict(os.environ, MPLBACKEND='Agg')
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd, cwd=SCRIPTS_DIR, env=env)
+
+    # Sample the resident memory of the stage until it finishes
+    peak_rss = 0
+    monitor = psutil.Process(process.pid)
+    while process.poll() is None:
+        try:
+            peak_rss = max(peak_rss, monitor.memory_info().rss)
+        except psutil.Error:
+            pass
+        time.sleep(interval)
+    seconds = time.perf_counter() - start
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return seconds, peak_rss / 1024 ** 2
+
+
+def run_pipeline(stages: List[Stage], output_dir: str, jobs: int = 2, force: bool = False) -> List[dict]:
+    """
+    Run the stages in dependency order, skipping up-to-date stages and running independent stages concurrently.
+
+    Returns:
+    - timing report with one entry per stage (name, status, seconds, peak_rss_mb)
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    state_file = output_dir / STATE_FILE
+    state = json.loads(state_file.read_text()) if state_file.exists() else {'stages': {}, 'files': {}}
+    cache = state['files']
+
+    stage_names = {stage.name for stage in stages}
+    for stage in stages:
+        assert set(stage.depends).issubset(stage_names), f'Unknown dependency of stage {stage.name}.'
+
+    report = {}
+    pending = {stage.name: stage for stage in stages}
+    rerun = set()
+    running = {}
+    pipeline_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            ready = [stage for stage in pending.values() if all(dep in report for dep in stage.depends)]
+            for stage in ready:
+                del pending[stage.name]
+                key = stage_key(stage, cache)
+                upstream_rerun = any(dep in rerun for dep in stage.depends)
+                if not force and not upstream_rerun and is_up_to_date(stage, key, state, cache):
+                    report[stage.name] = {'stage': stage.name, 'status': 'skipped', 'seconds': 0.0,
+                                          'peak_rss_mb': 0.0}
+                    print(f'{stage.name}: up-to-date, skipping.')
+                    continue
+                # The UTM zone chosen by the preprocessing is passed on to all downstream stages
+                # (with the bounds it was chosen for)
+                metadata = read_metadata(output_dir / 'preprocess') if stage.depends else {}
+                utm = {key: metadata.get(key) for key in ('utm_epsg', 'utm_bounds')} if stage.depends else None
+                print(f'{stage.name}: running {stage.script}.')
+                running[executor.submit(run_stage, stage, utm)] = (stage, key)
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, key = running.pop(future)
+                try:
+                    seconds, peak_rss_mb = future.result()
+                except subprocess.CalledProcessError as err:
+                    state_file.write_text(json.dumps(state, indent=2))
+                    raise RuntimeError(f'Stage {stage.name} failed ({err}).') from err
+                rerun.add(stage.name)
+                state['stages'][stage.name] = {
+                    'key': key,
+                    'outputs': {str(output): file_hash(output, cache) for output in stage.outputs},
+                }
+                state_file.write_text(json.dumps(state, indent=2))
+                report[stage.name] = {'stage': stage.name, 'status': 'ran', 'seconds': round(seconds, 3),
+                                      'peak_rss_mb': round(peak_rss_mb, 1)}
+                print(f'{stage.name}: done in {seconds:.1f} s.')
+
+    timing_report = [report[stage.name] for stage in stages]
+    total = round(time.perf_counter() - pipeline_start, 3)
+    (output_dir / REPORT_FILE).write_text(json.dumps({'total_seconds': total, 'stages': timing_report}, indent=2))
+
+    print(f'{"stage":<24}{"status":<10}{"seconds":>10}{"peak MB":>10}')
+    for entry in timing_report:
+        print(f'{entry["stage"]:<24}{entry["status"]:<10}{entry["seconds"]:>10.1f}{entry["peak_rss_mb"]:>10.0f}')
+    print(f'{"total (wall time)":<34}{total:>10.1f}')
+
+    return timing_report
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_known_args()[0]
+
+    if args.command == 'run':
+        stages = morphological_informality_stages(args.roi_file, args.building_file, args.edge_file, args.grid_file,
+                                                  args.output_dir, args.seed, args.isl_clusters, args.sds_clusters,
+                                                  args.isl_n_clusters, args.sds_n_clusters)
+        run_pipeline(stages, args.output_dir, jobs=args.jobs, force=args.force)
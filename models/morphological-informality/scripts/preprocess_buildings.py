@@ -1,25 +1,9 @@
-import geopandas as gpd
 from geopandas import GeoDataFrame
 import momepy as mm
 from pathlib import Path
 import argparse
-import utm
-
-
-def get_utm_epsg(gdf: GeoDataFrame) -> int:
-    gdf = gdf.to_crs(4326)
-
-    # Calculate the centroid of the bounding box
-    bounds = gdf.total_bounds
-    min_lng, min_lat, max_lng, max_lat = bounds
-    lng, lat = (min_lng + max_lng) / 2, (min_lat + max_lat) / 2
-
-    # Convert to UTM and create EPSG code
-    utm_coords = utm.from_latlon(lat, lng)
-    zone_number, zone_letter = utm_coords[2], utm_coords[3]
-    epsg_code = 32600 + zone_number if zone_letter >= 'N' else 32700 + zone_number
-
-    return epsg_code
+from geo_io import read_geo
+from projection import geographic_bounds, get_utm_epsg, save_utm_epsg
 
 
 def argument_parser():
@@ -87,13 +71,15 @@ if __name__ == '__main__':
     assert Path(args.output_dir).exists()
 
     # Region of interest
-    roi = gpd.read_file(args.roi_file)
+    roi = read_geo(args.roi_file)
 
-    # Buildings
-    building_file = Path(args.building_file)
-    buildings = gpd.read_parquet(building_file) if building_file.suffix == '.parquet' else gpd.read_file(building_file)
+    # Buildings (only geometries within the extent of the region of interest)
+    buildings = read_geo(args.building_file, columns=['geometry'], bbox=roi)
     buildings = preprocess_buildings(buildings, roi, 'uID')
 
+    # Persist the UTM zone so that downstream stages reuse it
+    save_utm_epsg(args.output_dir, buildings.crs.to_epsg(), geographic_bounds(roi.total_bounds, roi.crs))
+
     buildings = buildings[['uID', 'geometry']]
     buildings.index.name = None
     buildings.to_parquet(Path(args.output_dir) / 'buildings.parquet')
@@ -0,0 +1,93 @@
+from geopandas import GeoDataFrame
+from pyproj import CRS, Transformer
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Optional, Sequence, Union
+import json
+import utm
+
+METADATA_FILE = 'pipeline.json'
+
+
+@lru_cache(maxsize=None)
+def _cached_transformer(crs_from: str, crs_to: str) -> Transformer:
+    return Transformer.from_crs(CRS.from_wkt(crs_from), CRS.from_wkt(crs_to), always_xy=True)
+
+
+def get_transformer(crs_from, crs_to) -> Transformer:
+    """Return a (cached) transformer between two CRS, with axis order x, y (lng, lat)."""
+    return _cached_transformer(CRS.from_user_input(crs_from).to_wkt(), CRS.from_user_input(crs_to).to_wkt())
+
+
+def geographic_bounds(bounds: Sequence[float], crs) -> List[float]:
+    """Bounds (min_lng, min_lat, max_lng, max_lat) in EPSG:4326 of bounds in crs."""
+    min_x, min_y, max_x, max_y = bounds
+
+    # Transform the 4 corners of the bounding box instead of reprojecting all geometries
+    if crs is not None and not CRS.from_user_input(crs).equals(CRS.from_epsg(4326), ignore_axis_order=True):
+        lngs, lats = get_transformer(crs, 4326).transform([min_x, max_x, max_x, min_x], [min_y, min_y, max_y, max_y])
+        min_x, max_x, min_y, max_y = min(lngs), max(lngs), min(lats), max(lats)
+    return [float(min_x), float(min_y), float(max_x), float(max_y)]
+
+
+def utm_epsg_from_bounds(bounds: Sequence[float], crs) -> int:
+    min_x, min_y, max_x, max_y = geographic_bounds(bounds, crs)
+
+    # Calculate the centroid of the bounding box
+    lng, lat = (min_x + max_x) / 2, (min_y + max_y) / 2
+
+    # Convert to UTM and create EPSG code
+    utm_coords = utm.from_latlon(lat, lng)
+    zone_number, zone_letter = utm_coords[2], utm_coords[3]
+    epsg_code = 32600 + zone_number if zone_letter >= 'N' else 32700 + zone_number
+
+    return epsg_code
+
+
+def get_utm_epsg(gdf: GeoDataFrame) -> int:
+    return utm_epsg_from_bounds(gdf.total_bounds, gdf.crs)
+
+
+def read_metadata(out_path: Union[str, Path]) -> dict:
+    metadata_file = Path(out_path) / METADATA_FILE
+    if not metadata_file.exists():
+        return {}
+    with open(metadata_file, 'r') as f:
+        return json.load(f)
+
+
+def write_metadata(out_path: Union[str, Path], **entries) -> dict:
+    metadata = read_metadata(out_path)
+    metadata.update(entries)
+    with open(Path(out_path) / METADATA_FILE, 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+
+def save_utm_epsg(out_path: Union[str, Path], utm_epsg: int, bounds: Optional[Sequence[float]] = None) -> int:
+    """Persist the UTM EPSG code with the bounds (EPSG:4326) of the data it was chosen for."""
+    write_metadata(out_path, utm_epsg=int(utm_epsg), utm_bounds=list(bounds) if bounds is not None else None)
+    return utm_epsg
+
+
+def load_utm_epsg(out_path: Union[str, Path], gdf: Optional[GeoDataFrame] = None) -> int:
+    """
+    Load the UTM EPSG code chosen by an upstream stage, or derive (and persist) it from gdf.
+
+    The stored code is only reused for data overlapping the bounds it was chosen for, so that a run on another
+    area with the same output dir does not reuse the UTM zone of the previous area.
+    """
+    metadata = read_metadata(out_path)
+    if gdf is None:
+        assert 'utm_epsg' in metadata, f'No UTM EPSG code found in {Path(out_path) / METADATA_FILE}.'
+        return int(metadata['utm_epsg'])
+
+    bounds = geographic_bounds(gdf.total_bounds, gdf.crs)
+    stored_bounds = metadata.get('utm_bounds')
+    if 'utm_epsg' in metadata and stored_bounds is not None and bounds_overlap(bounds, stored_bounds):
+        return int(metadata['utm_epsg'])
+    return save_utm_epsg(out_path, utm_epsg_from_bounds(bounds, 4326), bounds)
+
+
+def bounds_overlap(bounds: Sequence[float], other: Sequence[float]) -> bool:
+    return bounds[0] <= other[2] and other[0] <= bounds[2] and bounds[1] <= other[3] and other[1] <= bounds[3]
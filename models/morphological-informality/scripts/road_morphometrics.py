@@ -2,10 +2,11 @@ import geopandas as gpd
 from geopandas import GeoDataFrame
 import pandas as pd
 from shapely.geometry import LineString
-import utm
 import numpy as np
 from pathlib import Path
 import argparse
+from geo_io import read_geo, get_columns
+from projection import load_utm_epsg
 
 
 def argument_parser():
@@ -24,21 +25,6 @@ def argument_parser():
     )
     return parser
 
-def get_utm_epsg(gdf: GeoDataFrame) -> int:
-    gdf = gdf.to_crs(4326)
-
-    # Calculate the centroid of the bounding box
-    bounds = gdf.total_bounds
-    min_lng, min_lat, max_lng, max_lat = bounds
-    lng, lat = (min_lng + max_lng) / 2, (min_lat + max_lat) / 2
-
-    # Convert to UTM and create EPSG code
-    utm_coords = utm.from_latlon(lat, lng)
-    zone_number, zone_letter = utm_coords[2], utm_coords[3]
-    epsg_code = 32600 + zone_number if zone_letter >= 'N' else 32700 + zone_number
-
-    return epsg_code
-
 # Subset for OSM road attributes
 def preprocess(roads: GeoDataFrame) -> GeoDataFrame:
     if 'subtype' in roads.columns:
@@ -111,8 +97,9 @@ if __name__ == '__main__':
     args = argument_parser().parse_known_args()[0]
     assert Path(args.output_dir).exists()
 
-    roads = gpd.read_parquet(args.road_file)
-    utm_epsg = get_utm_epsg(roads)
+    road_columns = [column for column in ['subtype', 'class'] if column in get_columns(args.road_file)]
+    roads = read_geo(args.road_file, columns=road_columns)
+    utm_epsg = load_utm_epsg(args.output_dir, roads)
     roads = roads.to_crs(utm_epsg)
     roads = preprocess(roads)
     out_road_file = Path(args.output_dir) / 'roads.parquet'
@@ -5,6 +5,8 @@ from shapely.ops import nearest_points
 from shapely.geometry import LineString
 import momepy as mm
 import dask_geopandas
+from pyproj import CRS, Transformer
+from functools import lru_cache
 import utm
 import argparse
 
@@ -31,6 +33,22 @@ def argument_parser():
     return parser
 
 
+@lru_cache(maxsize=None)
+def get_transformer(crs_wkt: str) -> Transformer:
+    return Transformer.from_crs(CRS.from_wkt(crs_wkt), CRS.from_epsg(4326), always_xy=True)
+
+
+def get_utm_epsg(gdf: gpd.GeoDataFrame) -> int:
+    # Transform the 4 corners of the bounding box instead of reprojecting (and dissolving) all geometries
+    min_x, min_y, max_x, max_y = gdf.total_bounds
+    lngs, lats = get_transformer(gdf.crs.to_wkt()).transform([min_x, max_x, max_x, min_x],
+                                                             [min_y, min_y, max_y, max_y])
+    lng, lat = (min(lngs) + max(lngs)) / 2, (min(lats) + max(lats)) / 2
+
+    _, _, zone_number, zone_letter = utm.from_latlon(lat, lng)
+    return 32600 + zone_number if zone_letter >= 'N' else 32700 + zone_number
+
+
 def compute_model_parameters(roads_file: str, road_type_attribute: str, road_type_key: str, buildings_file: str,
                              out_file: str):
 
@@ -42,11 +60,7 @@ def compute_model_parameters(roads_file: str, road_type_attribute: str, road_typ
     roads['paved'] = roads[road_type_attribute].apply(lambda x: 0 if x == road_type_key else 1)
 
     # Reproject to UTM zone
-    roads = roads.to_crs(epsg=4326)
-    centroid = roads.unary_union.centroid
-    lon, lat = centroid.x, centroid.y
-    _, _, zone_number, zone_letter = utm.from_latlon(lat, lon)
-    utm_epsg = 32600 + zone_number if zone_letter >= 'N' else 32700 + zone_number
+    utm_epsg = get_utm_epsg(roads)
     roads = roads.to_crs(epsg=utm_epsg)
 
     # Load buildings data
@@ -0,0 +1,215 @@
+from typing import Optional, Sequence, Union
+
+from affine import Affine
+from geopandas import GeoDataFrame, GeoSeries
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from pyproj import CRS
+from rasterio.enums import MergeAlg
+from rasterio.features import rasterize
+import shapely
+
+# CRS of the GHS-POP reference grid (World Mollweide), in which the grid cells are axis-aligned 100 m squares
+REFERENCE_GRID_CRS = 'ESRI:54009'
+
+# Number of set bits of each byte value
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+class GridLattice:
+    """
+    Position (row, col) of the grid cells in a raster aligned with them, for grids of equally sized,
+    axis-aligned square cells in crs (e.g. the reference grid in ESRI:54009, also when stored in EPSG:4326).
+    """
+
+    def __init__(self, cells: np.ndarray, rows: np.ndarray, cols: np.ndarray, transform: Affine,
+                 shape: tuple, crs: CRS):
+        self.cells = cells
+        self.rows = rows
+        self.cols = cols
+        self.transform = transform
+        self.shape = shape
+        self.crs = crs
+
+    @classmethod
+    def from_grid(cls, grid: Union[GeoDataFrame, GeoSeries], crs=None, tolerance: float = 0.01) -> 'GridLattice':
+        """
+        Lattice of the grid cells in crs (default: the CRS of the grid).
+
+        Raises ValueError if the cells are not squares of the same size on a regular lattice, within tolerance
+        (fraction of the cell size).
+        """
+        crs = CRS.from_user_input(crs) if crs is not None else grid.crs
+        cells = grid.geometry.to_crs(crs).values
+        bounds = shapely.bounds(cells)
+        size = np.median(bounds[:, 2] - bounds[:, 0])
+        x_min, y_max = bounds[:, 0].min(), bounds[:, 3].max()
+
+        # Cells are placed by their centre, and must be aligned with the lattice at their corners
+        centroids = (bounds[:, :2] + bounds[:, 2:]) / 2
+        cols = np.floor((centroids[:, 0] - x_min) / size).astype(np.int64)
+        rows = np.floor((y_max - centroids[:, 1]) / size).astype(np.int64)
+        corners = np.c_[x_min + cols * size, y_max - (rows + 1) * size, x_min + (cols + 1) * size, y_max - rows * size]
+        if len(cells) > 0 and np.abs(bounds - corners).max() > tolerance * size:
+            raise ValueError(f'The grid cells are not aligned on a regular lattice in {crs.to_string()}.')
+
+        transform = Affine(size, 0, x_min, 0, -size, y_max)
+        return cls(cells, rows, cols, transform, (int(rows.max(initial=-1)) + 1, int(cols.max(initial=-1)) + 1),
+                   crs)
+
+    def __len__(self):
+        return len(self.cells)
+
+
+def boundary_cells(geometries: np.ndarray, lattice: GridLattice) -> tuple:
+    """
+    Pairs of polygons and grid cells crossed by the polygon boundary (positions in geometries and in the grid),
+    found segment by segment so that each query only tests the few cells along a boundary segment.
+    """
+    parts, part_polygon = shapely.get_parts(shapely.boundary(geometries), return_index=True)
+    coords, coord_part = shapely.get_coordinates(parts, return_index=True)
+    starts = np.flatnonzero(coord_part[1:] == coord_part[:-1])
+    segments = shapely.linestrings(np.stack([coords[starts], coords[starts + 1]], axis=1))
+    segment_index, cell_index = shapely.STRtree(lattice.cells).query(segments, predicate='intersects')
+    pairs = np.unique(part_polygon[coord_part[starts]][segment_index] * len(lattice) + cell_index)
+    return pairs // len(lattice), pairs % len(lattice)
+
+
+def count_overlaps(polygons: Union[GeoDataFrame, GeoSeries], lattice: GridLattice, exact: bool = False,
+                   all_touched: bool = True) -> np.ndarray:
+    """
+    Number of polygons (e.g. isochrones) intersecting each grid cell, with the polygons burnt into an integer
+    raster aligned with the grid (merge_alg add) instead of a spatial join of all polygons with all cells.
+
+    Parameters:
+    - polygons: polygons, in any CRS
+    - lattice: lattice of the grid cells, see GridLattice.from_grid
+    - exact: exact intersects counts; the raster counts the cells with their centre inside a polygon, which is
+      exact for all cells but those crossed by the polygon boundary (edge cells), and the edge cells of each
+      polygon are counted with the geometries instead
+    - all_touched: (fast mode only) count all cells touched by a polygon, which approximates intersects, otherwise
+      only the cells with their centre inside the polygon
+
+    Returns:
+    - counts per grid cell, in the order of the grid
+    """
+    geometries = polygons.geometry.to_crs(lattice.crs).values
+    geometries = geometries[~(shapely.is_missing(geometries) | shapely.is_empty(geometries))]
+    if len(geometries) == 0 or len(lattice) == 0:
+        return np.zeros(len(lattice), dtype=np.int64)
+
+    raster = rasterize(((geometry, 1) for geometry in geometries), out_shape=lattice.shape,
+                       transform=lattice.transform, fill=0, merge_alg=MergeAlg.add,
+                       all_touched=all_touched and not exact, dtype='int32')
+    counts = raster[lattice.rows, lattice.cols].astype(np.int64)
+    if not exact:
+        return counts
+
+    # Edge cells intersect their polygon, whether their centre (counted by the raster or not) is inside or not
+    polygon_index, cell_index = boundary_cells(geometries, lattice)
+    x = lattice.transform.c + (lattice.cols[cell_index] + 0.5) * lattice.transform.a
+    y = lattice.transform.f + (lattice.rows[cell_index] + 0.5) * lattice.transform.e
+    centre_inside = shapely.contains_xy(geometries[polygon_index], x, y)
+    counts += np.bincount(cell_index[~centre_inside], minlength=len(lattice))
+    return counts
+
+
+def covered_cells(geometries: np.ndarray, lattice: GridLattice, exact: bool = False,
+                  all_touched: bool = True) -> tuple:
+    """
+    Pairs of polygons and the grid cells they cover (positions in geometries and in the grid), see
+    count_overlaps for the modes. In the raster modes each polygon is burnt into a window of its own bounds.
+    """
+    if exact:
+        polygon_index, cell_index = shapely.STRtree(lattice.cells).query(geometries, predicate='intersects')
+        return polygon_index, cell_index
+
+    cell_at = np.full(lattice.shape, -1, dtype=np.int64)
+    cell_at[lattice.rows, lattice.cols] = np.arange(len(lattice))
+    size, x_min, y_max = lattice.transform.a, lattice.transform.c, lattice.transform.f
+
+    # Raster window (rows and columns) of the polygon bounds, with a margin of one cell for all_touched
+    bounds = shapely.bounds(geometries)
+    col_start = np.clip(np.floor((bounds[:, 0] - x_min) / size).astype(np.int64) - 1, 0, lattice.shape[1])
+    col_stop = np.clip(np.ceil((bounds[:, 2] - x_min) / size).astype(np.int64) + 1, 0, lattice.shape[1])
+    row_start = np.clip(np.floor((y_max - bounds[:, 3]) / size).astype(np.int64) - 1, 0, lattice.shape[0])
+    row_stop = np.clip(np.ceil((y_max - bounds[:, 1]) / size).astype(np.int64) + 1, 0, lattice.shape[0])
+
+    polygon_index, cell_index = [], []
+    for i, geometry in enumerate(geometries):
+        if row_stop[i] <= row_start[i] or col_stop[i] <= col_start[i]:
+            continue
+        transform = Affine(size, 0, x_min + col_start[i] * size, 0, -size, y_max - row_start[i] * size)
+        window = rasterize([(geometry, 1)], out_shape=(row_stop[i] - row_start[i], col_stop[i] - col_start[i]),
+                           transform=transform, fill=0, all_touched=all_touched, dtype='uint8')
+        cells = cell_at[row_start[i]:row_stop[i], col_start[i]:col_stop[i]][window == 1]
+        cells = cells[cells >= 0]
+        polygon_index.append(np.full(len(cells), i))
+        cell_index.append(cells)
+    if len(cell_index) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(polygon_index), np.concatenate(cell_index)
+
+
+class CoverageIndex:
+    """
+    Facilities covering each grid cell (e.g. with their walking isochrones), stored as one bitset per grid cell
+    with bit i set for the facility facility_ids[i]. Distinct counts, counts per category and set queries are
+    computed on the bitsets, without joining the isochrones with the grid again.
+    """
+
+    def __init__(self, bits: np.ndarray, facility_ids: np.ndarray):
+        self.bits = bits  # uint8 (grid cells x bytes)
+        self.facility_ids = facility_ids
+        self.positions = pd.Index(facility_ids)
+
+    @classmethod
+    def from_isochrones(cls, isochrones: GeoDataFrame, facility_column: str, lattice: GridLattice,
+                        exact: bool = False, all_touched: bool = True) -> 'CoverageIndex':
+        """Coverage index of the isochrones (several isochrones of a facility are merged)."""
+        isochrones = isochrones[~(isochrones.geometry.is_empty | isochrones.geometry.isna())]
+        facility_position, facility_ids = pd.factorize(isochrones[facility_column])
+        polygon_index, cell_index = covered_cells(isochrones.geometry.to_crs(lattice.crs).values, lattice,
+                                                  exact, all_touched)
+        bits = np.zeros((len(lattice), (len(facility_ids) + 7) // 8), dtype=np.uint8)
+        position = facility_position[polygon_index]
+        np.bitwise_or.at(bits, (cell_index, position >> 3), (0x80 >> (position & 7)).astype(np.uint8))
+        return cls(bits, np.asarray(facility_ids))
+
+    def mask(self, facility_ids: Optional[Sequence] = None) -> np.ndarray:
+        """Bitset of a set of facilities (all facilities by default), facilities not in the index are ignored."""
+        if facility_ids is None:
+            return np.full(self.bits.shape[1], 0xFF, dtype=np.uint8)
+        position = self.positions.get_indexer(pd.unique(np.asarray(facility_ids, dtype=self.facility_ids.dtype)))
+        selected = np.zeros(self.bits.shape[1] * 8, dtype=bool)
+        selected[position[position >= 0]] = True
+        return np.packbits(selected)
+
+    def count(self, facility_ids: Optional[Sequence] = None) -> np.ndarray:
+        """Number of distinct facilities (of a set of facilities) covering each grid cell."""
+        return POPCOUNT[self.bits & self.mask(facility_ids)].sum(axis=1, dtype=np.int64)
+
+    def count_by(self, categories: pd.Series) -> DataFrame:
+        """Number of distinct facilities covering each grid cell, per category (categories indexed by facility)."""
+        return DataFrame({category: self.count(ids.index) for category, ids in categories.groupby(categories)})
+
+    def covered(self, facility_ids: Optional[Sequence] = None, min_count: int = 1) -> np.ndarray:
+        """Grid cells covered by at least min_count facilities (of a set of facilities)."""
+        return self.count(facility_ids) >= min_count
+
+    def facilities(self, cell: int) -> np.ndarray:
+        """Facilities covering a grid cell (position in the grid)."""
+        covering = np.unpackbits(self.bits[cell])[:len(self.facility_ids)].astype(bool)
+        return self.facility_ids[covering]
+
+
+def within_any(geometries: np.ndarray, polygons: np.ndarray) -> np.ndarray:
+    """
+    Geometries (e.g. grid cells) within any of the polygons (e.g. the polygons of an isochrone union), from a
+    single STRtree bulk query of the (prepared) polygons against the geometries.
+    """
+    within = np.zeros(len(geometries), dtype=bool)
+    if len(geometries) > 0 and len(polygons) > 0:
+        within[shapely.STRtree(geometries).query(polygons, predicate='contains')[1]] = True
+    return within
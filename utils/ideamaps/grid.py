@@ -0,0 +1,239 @@
+from pathlib import Path
+from typing import Optional, Sequence, Union
+import argparse
+import json
+import os
+
+from affine import Affine
+from geopandas import GeoDataFrame
+import geopandas as gpd
+import numpy as np
+from pandas import DataFrame
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import shapely
+from shapely.geometry.base import BaseGeometry
+
+from ideamaps.coverage import REFERENCE_GRID_CRS, GridLattice
+
+# Schema metadata key of the grid parameters (UTM EPSG, lattice) in the grid artefact
+GRID_METADATA_KEY = b'ideamaps_grid'
+
+# Version of the grid artefact layout, artefacts of other versions are rebuilt
+GRID_FORMAT_VERSION = 3
+
+# Suffix of the grid artefact built next to a grid file, e.g. 100mGrid.grid.arrow for 100mGrid.gpkg (or
+# 100mGrid.<layer>.grid.arrow for a layer of it)
+ARTEFACT_SUFFIX = '.grid.arrow'
+
+# Centroid and bounds columns of the grid cells in EPSG:4326, added to grid files without them
+CELL_COLUMNS = ['longitude', 'latitude', 'lon_min', 'lat_min', 'lon_max', 'lat_max']
+
+
+def argument_parser():
+    # https://docs.python.org/3/library/argparse.html#the-add-argument-method
+    parser = argparse.ArgumentParser(description="Build the reference grid artefact of a city")
+    parser.add_argument('-g', '--grid-file', dest='grid_file', required=True,
+                        help='IDEAMAPS 100 x 100 m grid file (e.g. 100mGrid.gpkg, grid-boundary-kano.gpkg)')
+    parser.add_argument('-l', '--layer', dest='layer', default=None, help='layer of the grid file')
+    parser.add_argument('-o', '--out-file', dest='out_file', default=None,
+                        help=f'grid artefact (default: <grid file>[.<layer>]{ARTEFACT_SUFFIX} next to the grid file)')
+    return parser
+
+
+class ReferenceGrid:
+    """
+    100 m reference grid of a city, built once from the grid file so that all models share the same cells:
+    - grid ids (grid_id), numbering the cells in the order of the grid file, as the models did before
+    - the columns and order of the grid file, with the centroid (longitude, latitude) and bounds (lon_min, lat_min,
+      lon_max, lat_max) of the cells in EPSG:4326 added if the grid file has none (bbox midpoints and bounds)
+    - the UTM EPSG of the city
+    - if the cells are on a regular lattice in REFERENCE_GRID_CRS, their position (lattice_row, lattice_col) and
+      the lattice parameters (transform and shape), see lattice
+
+    The grid is stored as an uncompressed Arrow IPC file, which is memory-mapped on read.
+    """
+
+    def __init__(self, cells: Union[GeoDataFrame, DataFrame], utm_epsg: int, transform: Optional[Affine] = None,
+                 shape: Optional[tuple] = None, lattice_crs: str = REFERENCE_GRID_CRS, layer: Optional[str] = None):
+        self.cells = cells  # ordered by grid_id (0, 1, ...)
+        self.utm_epsg = utm_epsg
+        self.transform = transform  # None if the cells are not on a regular lattice
+        self.shape = shape
+        self.lattice_crs = lattice_crs
+        self.layer = layer  # layer of the grid file the cells were read from (None: default layer)
+
+    @classmethod
+    def build(cls, grid_file: Union[str, Path], layer: Optional[str] = None) -> 'ReferenceGrid':
+        """Reference grid of the cells of a grid file (any format of geopandas.read_file)."""
+        cells = gpd.read_file(grid_file, layer=layer).drop(columns=['grid_id'], errors='ignore')
+        cells.insert(0, 'grid_id', np.arange(len(cells)))
+
+        # Centroid and bounds columns of the grid file are kept as they are, missing ones are added
+        bounds = shapely.bounds(cells.geometry.to_crs(4326).values)
+        computed = {
+            'longitude': (bounds[:, 0] + bounds[:, 2]) / 2,
+            'latitude': (bounds[:, 1] + bounds[:, 3]) / 2,
+            'lon_min': bounds[:, 0],
+            'lat_min': bounds[:, 1],
+            'lon_max': bounds[:, 2],
+            'lat_max': bounds[:, 3],
+        }
+        for column in CELL_COLUMNS:
+            if column not in cells.columns:
+                cells.insert(cells.columns.get_loc(cells.geometry.name), column, computed[column])
+        utm_epsg = cells.estimate_utm_crs().to_epsg()
+
+        # The lattice is optional, grids that are not aligned with the reference grid still get ids and UTM EPSG
+        try:
+            lattice = GridLattice.from_grid(cells, REFERENCE_GRID_CRS)
+        except ValueError:
+            return cls(cells, utm_epsg, layer=layer)
+        cells.insert(1, 'lattice_row', lattice.rows)
+        cells.insert(2, 'lattice_col', lattice.cols)
+        return cls(cells, utm_epsg, lattice.transform, lattice.shape, layer=layer)
+
+    def metadata(self) -> dict:
+        return {
+            'version': GRID_FORMAT_VERSION,
+            'utm_epsg': int(self.utm_epsg),
+            'transform': [self.transform.a, self.transform.b, self.transform.c, self.transform.d, self.transform.e,
+                          self.transform.f] if self.transform is not None else None,
+            'shape': [int(size) for size in self.shape] if self.shape is not None else None,
+            'lattice_crs': self.lattice_crs,
+            'layer': self.layer,
+        }
+
+    def write(self, file: Union[str, Path]) -> Path:
+        if isinstance(self.cells, GeoDataFrame):
+            table = pa.table(self.cells.to_arrow(geometry_encoding='geoarrow'))
+        else:
+            table = pa.Table.from_pandas(self.cells, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                               GRID_METADATA_KEY: json.dumps(self.metadata())})
+        file = Path(file)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        # Written next to the artefact and renamed, so that grids still memory-mapping a previous version keep it
+        temp_file = file.with_name(file.name + '.tmp')
+        with pa.OSFile(str(temp_file), 'wb') as sink, ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(temp_file, file)
+        return file
+
+    @classmethod
+    def read(cls, file: Union[str, Path], columns: Optional[Sequence[str]] = None,
+             geometry: bool = True) -> 'ReferenceGrid':
+        """
+        Reference grid written by write, with only the given columns (grid_id and the geometry are always read)
+        and without the cell geometries if geometry is False (cells is then a DataFrame).
+        """
+        # The columns are read from the memory-mapped file without copies, only the geometries are decoded
+        table = ipc.open_file(pa.memory_map(str(file), 'r')).read_all()
+        metadata = json.loads(table.schema.metadata[GRID_METADATA_KEY])
+        geometry_column = next(field.name for field in table.schema
+                               if (field.metadata or {}).get(b'ARROW:extension:name', b'').startswith(b'geoarrow'))
+        if columns is not None:
+            table = table.select(['grid_id'] + [column for column in columns
+                                                if column not in ('grid_id', geometry_column)]
+                                 + [geometry_column])
+        if geometry:
+            cells = GeoDataFrame.from_arrow(table)
+        else:
+            cells = table.drop_columns([geometry_column]).to_pandas()
+        if metadata['transform'] is None:
+            return cls(cells, metadata['utm_epsg'], lattice_crs=metadata['lattice_crs'], layer=metadata['layer'])
+        return cls(cells, metadata['utm_epsg'], Affine(*metadata['transform']), tuple(metadata['shape']),
+                   metadata['lattice_crs'], metadata['layer'])
+
+    def lattice(self) -> GridLattice:
+        """
+        Lattice of the cells (see coverage.GridLattice), with the cells rebuilt as squares in the lattice CRS.
+
+        Raises ValueError if the cells of the grid file are not on a regular lattice in the lattice CRS.
+        """
+        if self.transform is None:
+            raise ValueError(f'The grid cells are not aligned on a regular lattice in {self.lattice_crs}.')
+        rows, cols = self.cells['lattice_row'].to_numpy(), self.cells['lattice_col'].to_numpy()
+        size, x_min, y_max = self.transform.a, self.transform.c, self.transform.f
+        squares = shapely.box(x_min + cols * size, y_max - (rows + 1) * size, x_min + (cols + 1) * size,
+                              y_max - rows * size)
+        return GridLattice(squares, rows, cols, self.transform, self.shape, self.lattice_crs)
+
+
+def raster_cells(image: np.ndarray, transform: Affine, nodata=None, boundary: Optional[BaseGeometry] = None,
+                 crs=None) -> GeoDataFrame:
+    """
+    Grid cells of the pixels with data of a raster band (e.g. the GHS-POP 100 m grid masked with a study area),
+    with the centroid (longitude, latitude) and bounds (lon_min, lon_max, lat_min, lat_max) of the cells in the
+    CRS of the raster. The pixel bounds, cells and boundary test are computed for all pixels at once.
+
+    Parameters:
+    - image: raster band (rows x cols)
+    - transform: transform of the raster (north up)
+    - nodata: value of the pixels without data, which are skipped
+    - boundary: only keep the cells intersecting the boundary (e.g. the buffered FUA), in the CRS of the raster
+    - crs: CRS of the raster
+
+    Returns:
+    - GeoDataFrame of the cells, row by row
+    """
+    rows, cols = np.nonzero(image != nodata) if nodata is not None else np.indices(image.shape).reshape(2, -1)
+    x_min = transform.c + cols * transform.a
+    y_max = transform.f + rows * transform.e
+    x_max, y_min = x_min + transform.a, y_max + transform.e
+
+    # Cells with their centre in the (prepared) boundary intersect it, only the other cells are tested as boxes
+    if boundary is not None:
+        shapely.prepare(boundary)
+        keep = shapely.intersects_xy(boundary, (x_min + x_max) / 2, (y_min + y_max) / 2)
+        edge = np.flatnonzero(~keep)
+        keep[edge] = shapely.intersects(boundary, shapely.box(x_min[edge], y_min[edge], x_max[edge], y_max[edge]))
+        x_min, y_min, x_max, y_max = x_min[keep], y_min[keep], x_max[keep], y_max[keep]
+
+    cells = shapely.box(x_min, y_min, x_max, y_max)
+    return GeoDataFrame({
+        'geometry': cells,
+        'longitude': (x_min + x_max) / 2,
+        'latitude': (y_min + y_max) / 2,
+        'lon_min': x_min,
+        'lon_max': x_max,
+        'lat_min': y_min,
+        'lat_max': y_max,
+    }, crs=crs)
+
+
+def artefact_file(grid_file: Union[str, Path], layer: Optional[str] = None) -> Path:
+    grid_file = Path(grid_file)
+    name = grid_file.stem if layer is None else f'{grid_file.stem}.{layer}'
+    return grid_file.with_name(name + ARTEFACT_SUFFIX)
+
+
+def artefact_metadata(file: Union[str, Path]) -> dict:
+    metadata = ipc.open_file(pa.memory_map(str(file), 'r')).schema.metadata or {}
+    return json.loads(metadata[GRID_METADATA_KEY]) if GRID_METADATA_KEY in metadata else {}
+
+
+def load_reference_grid(grid_file: Union[str, Path], layer: Optional[str] = None,
+                        columns: Optional[Sequence[str]] = None, geometry: bool = True,
+                        out_file: Optional[Union[str, Path]] = None) -> ReferenceGrid:
+    """
+    Reference grid of a layer of a grid file, read from its artefact (default: next to the grid file, see
+    artefact_file), which is built first if it does not exist, is older than the grid file, was written with
+    another GRID_FORMAT_VERSION or from another layer.
+    """
+    out_file = Path(out_file) if out_file is not None else artefact_file(grid_file, layer)
+    if not out_file.exists() or out_file.stat().st_mtime < Path(grid_file).stat().st_mtime:
+        ReferenceGrid.build(grid_file, layer).write(out_file)
+    else:
+        metadata = artefact_metadata(out_file)
+        if metadata.get('version') != GRID_FORMAT_VERSION or metadata.get('layer') != layer:
+            ReferenceGrid.build(grid_file, layer).write(out_file)
+    return ReferenceGrid.read(out_file, columns, geometry)
+
+
+if __name__ == '__main__':
+    args = argument_parser().parse_known_args()[0]
+    out_file = args.out_file if args.out_file is not None else artefact_file(args.grid_file, args.layer)
+    reference_grid = ReferenceGrid.build(args.grid_file, args.layer)
+    reference_grid.write(out_file)
+    print(f'{len(reference_grid.cells)} cells (UTM EPSG:{reference_grid.utm_epsg}) written to {out_file}')
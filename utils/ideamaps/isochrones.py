@@ -0,0 +1,410 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+import json
+import sqlite3
+import threading
+import time
+
+import geopandas as gpd
+from geopandas import GeoDataFrame
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+import requests
+from requests.adapters import HTTPAdapter
+
+ORS_API_URL = 'https://api.openrouteservice.org'
+
+# HTTP status codes worth retrying (rate limit, server overload)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# ORS error codes of locations without an isochrone (no routable point near the location, isochrone not built):
+# the only errors for which a batch is split into single locations and a missing isochrone is cached
+NO_ISOCHRONE_ERROR_CODES = {2010, 2099, 3099}
+
+# Coordinates are rounded to 1e-6 degrees (about 0.1 m) before they are used as cache keys
+COORDINATE_PRECISION = 6
+
+
+def location_keys(coords: np.ndarray) -> np.ndarray:
+    """Encode (lon, lat) coordinates as exact int64 keys (rounded lon and lat packed in 29 + 28 bits)."""
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    scale = 10 ** COORDINATE_PRECISION
+    lon = np.rint((coords[:, 0] + 180) * scale).astype(np.int64)
+    lat = np.rint((coords[:, 1] + 90) * scale).astype(np.int64)
+    return (lon << 28) | lat
+
+
+def no_isochrone(response: requests.Response) -> bool:
+    """
+    Whether an ORS error response means that there is no isochrone for a location (e.g. far from the road
+    network), as opposed to errors of the request itself (bad API key, quota exceeded, invalid body).
+    """
+    if response.status_code not in (400, 404):
+        return False
+    try:
+        error = response.json().get('error', {})
+    except ValueError:
+        return False
+    if isinstance(error, dict):
+        code, message = error.get('code'), str(error.get('message', ''))
+    else:
+        code, message = None, str(error)
+    return code in NO_ISOCHRONE_ERROR_CODES or 'routable point' in message.lower()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter: rate tokens are added per second up to capacity, and every request
+    takes one token, waiting until one is available.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class IsochroneCache:
+    """
+    On-disk isochrone cache (SQLite) with one GeoJSON feature per location, profile, range type, range and
+    attributes. Locations without an isochrone (e.g. too far from the road network) are cached as NULL.
+    """
+
+    def __init__(self, file: Union[str, Path]):
+        self.file = Path(file)
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.file), check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS isochrone (
+                location INTEGER NOT NULL,
+                profile TEXT NOT NULL,
+                range_type TEXT NOT NULL,
+                range REAL NOT NULL,
+                attributes TEXT NOT NULL,
+                feature TEXT,
+                PRIMARY KEY (profile, range_type, range, attributes, location)
+            ) WITHOUT ROWID
+        """)
+        self.connection.commit()
+
+    def get(self, keys: np.ndarray, profile: str, range_type: str, range_value: float,
+            attributes: str) -> Dict[int, Optional[dict]]:
+        """Cached features by location key (None for locations without isochrone), missing keys are not returned."""
+        unique_keys = np.unique(keys).tolist()
+        result = []
+        with self.lock:
+            # Keys are queried in chunks under the SQLite variable limit
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                result += self.connection.execute(
+                    f'SELECT location, feature FROM isochrone WHERE profile = ? AND range_type = ? AND range = ? '
+                    f'AND attributes = ? AND location IN ({",".join("?" * len(chunk))})',
+                    (profile, range_type, float(range_value), attributes, *chunk)).fetchall()
+        return {location: None if feature is None else json.loads(feature) for location, feature in result}
+
+    def put(self, keys: Sequence[int], profile: str, range_type: str, range_value: float, attributes: str,
+            features: Sequence[Optional[dict]]):
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO isochrone VALUES (?, ?, ?, ?, ?, ?)',
+                [(int(key), profile, range_type, float(range_value), attributes,
+                  None if feature is None else json.dumps(feature)) for key, feature in zip(keys, features)])
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class IsochroneSpec(NamedTuple):
+    """Isochrones of a routing profile for one or more ranges, e.g. ('driving-car', 'distance', [1000, 3300])."""
+    profile: str
+    range_type: str
+    ranges: Sequence[float]
+    attributes: Sequence[str] = ()
+
+
+class IsochroneClient:
+    """
+    Client for the openrouteservice isochrones endpoint (public API or a local ORS instance) that batches
+    locations into requests, sends them concurrently under a rate limit and retries with exponential backoff.
+
+    Parameters:
+    - base_url: ORS base url, e.g. https://api.openrouteservice.org or http://localhost:8080/ors
+    - api_key: ORS API key (not required for local instances)
+    - max_locations: maximum number of locations per request (public API: 5)
+    - requests_per_minute: rate limit of the endpoint (public API: 20), None for no limit (local instances)
+    - workers: number of concurrent requests
+    - retries: number of retries per request
+    - backoff: initial delay (s) between retries, doubled after each retry
+    - timeout: request timeout (s)
+    - cache: isochrone cache, only locations and ranges missing from the cache are requested
+    """
+
+    def __init__(self, base_url: str = ORS_API_URL, api_key: Optional[str] = None, max_locations: int = 5,
+                 requests_per_minute: Optional[float] = 20, workers: int = 4, retries: int = 5,
+                 backoff: float = 1.0, timeout: float = 120, cache: Optional[IsochroneCache] = None):
+        self.base_url = base_url.rstrip('/')
+        self.max_locations = max_locations
+        self.limiter = TokenBucket(requests_per_minute / 60, capacity=workers) \
+            if requests_per_minute is not None else None
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.failed = []  # locations without isochrone (see no_isochrone)
+
+        # Pooled session shared by the worker threads
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.session.headers.update({
+            'Accept': 'application/json, application/geo+json, application/gpx+xml, img/png; charset=utf-8',
+            'Content-Type': 'application/json; charset=utf-8',
+        })
+        if api_key is not None:
+            self.session.headers['Authorization'] = api_key
+
+    def post(self, profile: str, body: dict) -> dict:
+        url = f'{self.base_url}/v2/isochrones/{profile}'
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                response = self.session.post(url, json=body, timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(f'{response.status_code} from {url}: {response.text[:200]}',
+                                           response=response)
+                # Rate limited requests tell us how long to wait
+                retry_after = response.headers.get('Retry-After')
+                wait = float(retry_after) if retry_after is not None and retry_after.isdigit() else delay
+            except (requests.ConnectionError, requests.Timeout) as err:
+                error, wait = err, delay
+            if attempt == self.retries:
+                raise error
+            time.sleep(wait)
+            delay *= 2
+
+    def request_batch(self, coords: np.ndarray, profile: str, range_type: str, ranges: Sequence[float],
+                      attributes: Sequence[str]) -> List[List[Optional[dict]]]:
+        """
+        Isochrones of a batch of locations, one list of features (one per range, None if missing) per location.
+
+        A batch rejected because a location has no isochrone (e.g. far from the road network, see no_isochrone)
+        is split into single location requests, so that only these locations are dropped. Other errors (e.g. an
+        invalid API key or an exhausted quota) are raised.
+        """
+        body = {'locations': coords.tolist(), 'range_type': range_type, 'range': list(ranges)}
+        if len(attributes) > 0:
+            body['attributes'] = list(attributes)
+        try:
+            result = self.post(profile, body)
+        except requests.HTTPError as err:
+            if err.response is None or not no_isochrone(err.response):
+                raise
+            if len(coords) > 1:
+                return [self.request_batch(coords[i:i + 1], profile, range_type, ranges, attributes)[0]
+                        for i in range(len(coords))]
+            self.failed.append((tuple(coords[0]), profile, range_type, tuple(ranges), str(err)))
+            return [[None] * len(ranges)]
+
+        features = [[None] * len(ranges) for _ in range(len(coords))]
+        range_index = {float(value): i for i, value in enumerate(ranges)}
+        for feature in result['features']:
+            properties = feature['properties']
+            features[properties['group_index']][range_index[float(properties['value'])]] = feature
+        return features
+
+    def compute(self, locations: Sequence[Tuple[float, float]], profile: str = 'driving-car',
+                range_type: str = 'time', ranges: Sequence[float] = (600,),
+                attributes: Sequence[str] = ()) -> GeoDataFrame:
+        """
+        Isochrones of all locations for all ranges.
+
+        Parameters:
+        - locations: (lon, lat) coordinates
+        - profile: routing profile, e.g. driving-car or foot-walking
+        - range_type: 'time' (s) or 'distance' (m)
+        - ranges: range values, requested in one call per location batch
+        - attributes: additional isochrone attributes, e.g. ['area']
+
+        Returns:
+        - GeoDataFrame (EPSG:4326) with one isochrone per location and range, with the position of the
+          location (location_index), the range (value) and the properties returned by ORS; locations without
+          isochrone are missing
+        """
+        return self.compute_specs(locations, [IsochroneSpec(profile, range_type, ranges, attributes)])[0]
+
+    def compute_specs(self, locations: Sequence[Tuple[float, float]],
+                      specs: Sequence[Union[IsochroneSpec, tuple]]) -> List[GeoDataFrame]:
+        """
+        Isochrones of all locations for several (profile, range_type, ranges[, attributes]) specs.
+
+        The ranges (and attributes) of all specs with the same profile and range type are requested in a
+        single call per location batch, and the batches of all profiles share the workers and the rate limit.
+
+        Returns:
+        - one GeoDataFrame per spec, see compute
+        """
+        frames = [[] for _ in specs]
+        for spec_index, isochrones in self.iter_specs(locations, specs):
+            frames[spec_index].append(isochrones)
+        results = []
+        for spec_frames in frames:
+            if len(spec_frames) == 0:
+                results.append(isochrone_frame(np.empty((0, 0), dtype=object), []))
+                continue
+            isochrones = pd.concat(spec_frames, ignore_index=True)
+            results.append(isochrones.sort_values(['location_index', 'value'], kind='stable').reset_index(drop=True))
+        return results
+
+    def iter_specs(self, locations: Sequence[Tuple[float, float]],
+                   specs: Sequence[Union[IsochroneSpec, tuple]]) -> Iterator[Tuple[int, GeoDataFrame]]:
+        """
+        Isochrones of all locations for several specs (see compute_specs), yielded as the requests complete:
+        (position of the spec, GeoDataFrame of the isochrones of a batch of locations, see compute), the cached
+        isochrones first. The isochrones are not kept once yielded, e.g. to merge them in a union.CascadedUnion
+        as they arrive instead of collecting all of them first.
+        """
+        specs = [IsochroneSpec(*spec) for spec in specs]
+        coords = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+        keys = location_keys(coords)
+
+        # Specs are merged by profile and range type
+        groups = {}
+        for spec in specs:
+            ranges, attributes = groups.setdefault((spec.profile, spec.range_type), ([], set()))
+            ranges += [float(value) for value in spec.ranges if float(value) not in ranges]
+            attributes.update(spec.attributes)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            submitted, pending = [], {}
+            for (profile, range_type), (ranges, attributes) in groups.items():
+                features, futures = self.submit(executor, coords, keys, profile, range_type, ranges,
+                                                sorted(attributes))
+                submitted.append((profile, range_type, ranges, attributes, features, list(futures.values())))
+                for future, (batch, request_ranges) in futures.items():
+                    pending[future] = (profile, range_type, ranges, attributes, features, batch, request_ranges)
+
+            # Locations with all ranges cached are yielded while the requests run, the others with their request
+            for profile, range_type, ranges, attributes, features, batches in submitted:
+                requested = np.isin(keys, [keys[position] for batch, _ in batches for position in batch])
+                cached = np.flatnonzero(~requested)
+                yield from fan_out(specs, profile, range_type, attributes,
+                                   isochrone_frame(features[cached], ranges, cached))
+
+            for future in as_completed(pending):
+                profile, range_type, ranges, attributes, features, batch, request_ranges = pending.pop(future)
+                batch_features = future.result()
+                # Duplicated locations get the isochrones of the requested one
+                positions = np.flatnonzero(np.isin(keys, keys[batch]))
+                block = features[positions]
+                for j, value in enumerate(request_ranges):
+                    column = [location_features[j] for location_features in batch_features]
+                    if self.cache is not None:
+                        self.cache.put(keys[batch], profile, range_type, value, ','.join(sorted(attributes)), column)
+                    for position, feature in zip(batch, column):
+                        block[keys[positions] == keys[position], ranges.index(value)] = feature
+                yield from fan_out(specs, profile, range_type, attributes, isochrone_frame(block, ranges, positions))
+
+    def submit(self, executor: ThreadPoolExecutor, coords: np.ndarray, keys: np.ndarray, profile: str,
+               range_type: str, ranges: List[float], attributes: List[str]) -> Tuple[np.ndarray, dict]:
+        """
+        Submit the requests of the locations and ranges missing from the cache, returns the cached features
+        (locations x ranges, None if missing) and the futures of the requests with their batch of locations and
+        requested ranges.
+        """
+        attributes_key = ','.join(attributes)
+        features = np.full((len(coords), len(ranges)), None, dtype=object)
+
+        # Cached locations and ranges
+        missing = np.ones(features.shape, dtype=bool)
+        if self.cache is not None:
+            for j, value in enumerate(ranges):
+                cached = self.cache.get(keys, profile, range_type, value, attributes_key)
+                for i, key in enumerate(keys.tolist()):
+                    if key in cached:
+                        features[i, j], missing[i, j] = cached[key], False
+
+        # Locations missing any range are requested for all missing ranges, once per unique location
+        to_request = np.flatnonzero(missing.any(axis=1))
+        _, unique_position = np.unique(keys[to_request], return_index=True)
+        to_request = to_request[np.sort(unique_position)]
+        request_ranges = [value for j, value in enumerate(ranges) if missing[to_request, j].any()]
+        batches = [to_request[i:i + self.max_locations] for i in range(0, len(to_request), self.max_locations)]
+        return features, {executor.submit(self.request_batch, coords[batch], profile, range_type, request_ranges,
+                                          attributes): (batch, request_ranges) for batch in batches}
+
+
+def fan_out(specs: List[IsochroneSpec], profile: str, range_type: str, attributes: set,
+            isochrones: GeoDataFrame) -> Iterator[Tuple[int, GeoDataFrame]]:
+    """Isochrones of each spec of the profile and range type, from the isochrones of all their ranges."""
+    if len(isochrones) == 0:
+        return
+    for spec_index, spec in enumerate(specs):
+        if (spec.profile, spec.range_type) != (profile, range_type):
+            continue
+        spec_isochrones = isochrones[isochrones['value'].isin([float(value) for value in spec.ranges])]
+        spec_isochrones = spec_isochrones.drop(columns=sorted(attributes - set(spec.attributes)), errors='ignore')
+        if len(spec_isochrones) > 0:
+            yield spec_index, spec_isochrones.reset_index(drop=True)
+
+
+def isochrone_frame(features: np.ndarray, ranges: Sequence[float],
+                    locations: Optional[np.ndarray] = None) -> GeoDataFrame:
+    """
+    GeoDataFrame of the features (locations x ranges), see IsochroneClient.compute, with the positions of the
+    locations of the rows of features (default: 0, 1, ...).
+    """
+    rows = [(i, feature) for i, feature in np.ndenumerate(features) if feature is not None]
+    if len(rows) == 0:
+        return gpd.GeoDataFrame({'location_index': [], 'value': []}, geometry=[], crs=4326)
+    isochrones = gpd.GeoDataFrame.from_features([feature for _, feature in rows], crs=4326)
+    isochrones.insert(0, 'location_index', [i if locations is None else int(locations[i]) for (i, _), _ in rows])
+    # Ranges are sorted per location, the position of a location within its request is replaced by location_index
+    isochrones['value'] = isochrones['value'].astype(np.float64)
+    isochrones = isochrones.sort_values(['location_index', 'value'], kind='stable')
+    return isochrones.drop(columns='group_index', errors='ignore').reset_index(drop=True)
+
+
+def attach_locations(isochrones: GeoDataFrame, locations: DataFrame, columns: Dict[str, str]) -> GeoDataFrame:
+    """
+    Isochrones (see IsochroneClient.compute) with columns of their locations (e.g. the category, id and name of
+    the facilities) as strings instead of location_index, and the list properties of ORS joined as strings, e.g.
+    to write them to a file.
+
+    Parameters:
+    - isochrones: isochrones of the locations, with their position (location_index)
+    - locations: rows of the locations, in the order of the requested locations
+    - columns: {isochrone column: location column}
+    """
+    location = locations.iloc[isochrones['location_index'].to_numpy()]
+    isochrones = isochrones.drop(columns='location_index')
+    for column, location_column in columns.items():
+        isochrones[column] = location[location_column].astype(str).to_numpy()
+    for column in isochrones.columns.drop(isochrones.geometry.name):
+        if isochrones[column].map(lambda value: isinstance(value, list)).any():
+            isochrones[column] = isochrones[column].map(
+                lambda value: ', '.join(map(str, value)) if isinstance(value, list) else value)
+    return isochrones
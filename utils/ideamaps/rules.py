@@ -0,0 +1,55 @@
+from typing import List, Union
+
+import numpy as np
+from pandas import DataFrame, Series
+
+# Comparison operators of the rule conditions
+RULE_OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'lt': lambda column, value: column < value,
+    'le': lambda column, value: column <= value,
+    'gt': lambda column, value: column > value,
+    'ge': lambda column, value: column >= value,
+    'in': lambda column, value: np.isin(column, value),
+    'not_in': lambda column, value: ~np.isin(column, value),
+    'between': lambda column, value: (column >= value[0]) & (column <= value[1]),  # inclusive
+}
+
+
+def rule_condition(frame: DataFrame, where: Union[dict, List[dict]]) -> np.ndarray:
+    """
+    Rows matching the conditions of a rule, either column tests that must all hold, e.g.
+    {"iso_walk_1k_count": {"ge": 1, "le": 2}}, or a list of such tests of which any must hold.
+    """
+    if isinstance(where, list):
+        condition = np.zeros(len(frame), dtype=bool)
+        for alternative in where:
+            condition |= rule_condition(frame, alternative)
+        return condition
+
+    condition = np.ones(len(frame), dtype=bool)
+    for column, tests in where.items():
+        values = frame[column].to_numpy()
+        for operator, value in tests.items():
+            condition &= RULE_OPERATORS[operator](values, value)
+    return condition
+
+
+def evaluate_rules(frame: DataFrame, rules: List[dict], default=0, name: str = None) -> Series:
+    """
+    Value of each row from ordered rules, the first matching rule sets the value, e.g. for the result classes
+    [{"value": 2, "where": {"iso_walk_1k_count": {"le": 1}}},
+     {"value": 1, "where": [{"iso_walk_1k_count": {"lt": 4}}, {"iso_3_3km_count": {"lt": 15}}]}]
+
+    Parameters:
+    - frame: rows (e.g. grid cells) with the columns of the conditions
+    - rules: rules with a value and conditions (where), see rule_condition
+    - default: value of the rows not matching any rule
+
+    Returns:
+    - Series indexed as frame, computed with a single np.select over the condition arrays
+    """
+    conditions = [rule_condition(frame, rule['where']) for rule in rules]
+    values = np.select(conditions, [rule['value'] for rule in rules], default=default)
+    return Series(values, index=frame.index, name=name)
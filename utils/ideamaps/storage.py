@@ -0,0 +1,95 @@
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+import json
+
+import geopandas as gpd
+from geopandas import GeoDataFrame
+import pandas as pd
+from pandas import DataFrame
+import pyarrow.parquet as pq
+
+# Compression of the GeoParquet files (zstd: about the size of a zipped GeoPackage, fast to decode)
+PARQUET_COMPRESSION = 'zstd'
+
+# Formats of intermediate layers written before GeoParquet, read as a fallback
+LEGACY_SUFFIXES = ('.gpkg', '.shp', '.geojson')
+
+
+def geo_metadata(file: Union[str, Path]) -> Optional[dict]:
+    """GeoParquet metadata of a Parquet file (None for plain Parquet tables)."""
+    metadata = pq.read_schema(file).metadata or {}
+    return json.loads(metadata[b'geo']) if b'geo' in metadata else None
+
+
+def write_geo(frame: Union[GeoDataFrame, DataFrame], file: Union[str, Path], layer: Optional[str] = None):
+    """
+    Write a layer in the format of the file suffix: GeoParquet for .parquet (compressed, with a bbox covering
+    column for spatial filters, plain Parquet for tables without geometry), otherwise GeoDataFrame.to_file
+    (e.g. GeoPackage for the final deliverables).
+    """
+    file = Path(file)
+    file.parent.mkdir(parents=True, exist_ok=True)
+    if file.suffix != '.parquet':
+        frame.to_file(file, layer=layer)
+    elif isinstance(frame, GeoDataFrame):
+        frame.to_parquet(file, compression=PARQUET_COMPRESSION, write_covering_bbox=True)
+    else:
+        frame.to_parquet(file, compression=PARQUET_COMPRESSION)
+
+
+def read_geo(file: Union[str, Path], columns: Optional[Sequence[str]] = None,
+             bbox: Optional[Tuple[float, float, float, float]] = None) -> Union[GeoDataFrame, DataFrame]:
+    """
+    Read a layer written by write_geo, only reading the given columns (the geometry column is always read)
+    and the features intersecting the bbox (in the CRS of the layer).
+    """
+    file = Path(file)
+    if file.suffix != '.parquet':
+        read_columns = [column for column in columns if column != 'geometry'] if columns is not None else None
+        return gpd.read_file(file, columns=read_columns, bbox=bbox)
+    metadata = geo_metadata(file)
+    if metadata is None:
+        return pd.read_parquet(file, columns=list(columns) if columns is not None else None)
+    if columns is not None and metadata['primary_column'] not in columns:
+        columns = list(columns) + [metadata['primary_column']]
+    return gpd.read_parquet(file, columns=columns, bbox=bbox)
+
+
+class IntermediateStore:
+    """
+    Intermediate layers of a model (e.g. in data-temp), stored by name as compressed GeoParquet: much faster to
+    write and read than GeoPackage or shapefiles, with column projection and bbox filters on read. Final
+    deliverables are still written as GeoPackage with write_geo.
+
+    Layers written by earlier runs as GeoPackage (or shapefile, GeoJSON) with the same name are read if there is
+    no GeoParquet version yet.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+
+    def path(self, name: str) -> Path:
+        return self.directory / f'{name}.parquet'
+
+    def find(self, name: str) -> Path:
+        """File of a layer, the GeoParquet file or else a legacy file."""
+        for file in [self.path(name)] + [self.directory / f'{name}{suffix}' for suffix in LEGACY_SUFFIXES]:
+            if file.exists():
+                return file
+        raise FileNotFoundError(f'No intermediate layer {name} in {self.directory}.')
+
+    def exists(self, name: str) -> bool:
+        try:
+            self.find(name)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def write(self, frame: Union[GeoDataFrame, DataFrame], name: str) -> Path:
+        file = self.path(name)
+        write_geo(frame, file)
+        return file
+
+    def read(self, name: str, columns: Optional[Sequence[str]] = None,
+             bbox: Optional[Tuple[float, float, float, float]] = None) -> Union[GeoDataFrame, DataFrame]:
+        return read_geo(self.find(name), columns, bbox)
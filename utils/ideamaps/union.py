@@ -0,0 +1,74 @@
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import geopandas as gpd
+from geopandas import GeoDataFrame
+import numpy as np
+import shapely
+from shapely.geometry.base import BaseGeometry
+
+from ideamaps.storage import write_geo
+
+
+class CascadedUnion:
+    """
+    Incremental union of geometries (e.g. isochrones as they are computed) in a balanced tree: the geometries
+    are unioned by chunks, and partial unions of the same size are merged as soon as there are two of them, so
+    that only one partial union per tree level is kept in memory instead of all geometries. Geometries covered
+    by a partial union are skipped.
+
+    Parameters:
+    - chunk_size: number of geometries unioned at once at the leaves of the tree
+    - grid_size: precision grid of the union (see shapely.union), None for full precision
+    """
+
+    def __init__(self, chunk_size: int = 512, grid_size: Optional[float] = None):
+        self.chunk_size = chunk_size
+        self.grid_size = grid_size
+        self.pending: List[BaseGeometry] = []
+        self.levels: List[Optional[BaseGeometry]] = []  # levels[k]: union of chunk_size * 2 ** k geometries
+        self.count = 0  # geometries added
+
+    def add(self, geometry: BaseGeometry):
+        if geometry is None or geometry.is_empty:
+            return
+        self.count += 1
+        # Geometries within a partial union do not change the union (common with overlapping isochrones)
+        if any(shapely.covers(partial, geometry) for partial in self.levels if partial is not None):
+            return
+        self.pending.append(geometry)
+        if len(self.pending) == self.chunk_size:
+            self.push(shapely.union_all(self.pending, grid_size=self.grid_size))
+            self.pending = []
+
+    def extend(self, geometries: Iterable[BaseGeometry]):
+        for geometry in geometries:
+            self.add(geometry)
+
+    def push(self, geometry: BaseGeometry, level: int = 0):
+        # Like a binary counter, merging carries the partial union up until a free level
+        while level < len(self.levels) and self.levels[level] is not None:
+            geometry = shapely.union(self.levels[level], geometry, grid_size=self.grid_size)
+            self.levels[level] = None
+            level += 1
+        if level == len(self.levels):
+            self.levels.append(None)
+        shapely.prepare(geometry)
+        self.levels[level] = geometry
+
+    def result(self) -> BaseGeometry:
+        """Union of all geometries added so far (an empty GeometryCollection if none)."""
+        parts = self.pending + [geometry for geometry in self.levels if geometry is not None]
+        return shapely.union_all(parts, grid_size=self.grid_size)
+
+
+def write_polygons(geometry: BaseGeometry, file: Union[str, Path], crs=4326, layer: Optional[str] = None) -> GeoDataFrame:
+    """
+    Write the polygons of a (multi)polygon with an id (1, 2, ...) in a single call, as GeoParquet (.parquet)
+    or any format of GeoDataFrame.to_file (e.g. GeoPackage), see storage.write_geo.
+    """
+    polygons = shapely.get_parts(shapely.get_parts(geometry))
+    polygons = polygons[shapely.get_type_id(polygons) == shapely.GeometryType.POLYGON]
+    frame = gpd.GeoDataFrame({'id': np.arange(1, len(polygons) + 1)}, geometry=polygons, crs=crs)
+    write_geo(frame, file, layer)
+    return frame